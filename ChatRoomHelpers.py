@@ -1,19 +1,57 @@
-import os
-from socket import socket
+from contextlib import contextmanager
+from socket import socket, MSG_PEEK, SHUT_RDWR
 import json
-import sys
-from tkinter import BOTH, PhotoImage, X, LEFT
-from tkinter.constants import END
-from tkinter.ttk import Frame, Label, Entry, Button
+import struct
+import threading
+import time
+import zlib
+
+# What the server sends most often, kept here so that the compression
+# dictionary holds exactly the text sent
+DISCONNECT = '/disconnect'
+DISSCONNECT_MESSAGE = f'{DISCONNECT} - To disconnect from server'
+HELP = '/help'
+HELP_MESSAGE = f'{HELP} - To see this message again'
+MOVE_ROOM = '/move'
+MOVE_ROOM_MESSAGE = (f'{MOVE_ROOM} Name - To create/move into a'
+                     ' room called "Name"')
+LEAVE_ROOM = '/leave'
+LEAVE_ROOM_MESSAGE = (f'{LEAVE_ROOM} - To leave the current room and move'
+                      ' into General room')
+ROOM_DETAILS = '/rooms'
+ROOM_DETAILS_MESSGAE = f'{ROOM_DETAILS} - To get a list of available rooms'
+ROOM_SEARCH_MESSAGE = (f'{ROOM_DETAILS} Prefix 2 - To get page 2 of the rooms'
+                       ' starting with "Prefix"')
+WHO = '/who'
+WHO_MESSAGE = f'{WHO} Name - To get a list of the clients in room "Name"'
+SEND_FILE = '/send'     # Handled by clients that can send files
+SEND_FILE_MESSAGE = f'{SEND_FILE} Path - To share a file with the room'
+GET_FILE = '/get'
+GET_FILE_MESSAGE = (f'{GET_FILE} Id - To download a file shared in the'
+                    ' room')
+WELCOME_MESSAGE = ('Welcome to ChatRooms. The following commands'
+                   ' are currently supported:\n')
+HELP_LINES = (HELP_MESSAGE, DISSCONNECT_MESSAGE, MOVE_ROOM_MESSAGE,
+              LEAVE_ROOM_MESSAGE, ROOM_DETAILS_MESSGAE, ROOM_SEARCH_MESSAGE,
+              WHO_MESSAGE)
+FILE_HELP = (SEND_FILE_MESSAGE, GET_FILE_MESSAGE)  # For clients with files
+ENTERED = ' has entered the chat'   # After the name of a client
+LEFT = ' has left the chat'
+
 
 class ClientList:
     """
-    Class to represent the client list that the server maintains
+    Class to represent the client list that the server maintains.
+
+    Clients are indexed by connection and each room keeps the set of
+    connections in it, so lookups do not scan the whole list. A lock guards
+    both indexes so the list can be shared by many handler threads.
     """
-    client_list = []
 
     def __init__(self):
-        self.client_list = []
+        self._lock = threading.RLock()
+        self._sessions = {}     # Connection -> entry dict
+        self._rooms = {}        # Room -> connections in it (ordered set)
 
     def addToList(self, conn: socket, name: str, chat_room: str):
         """
@@ -28,12 +66,13 @@ class ClientList:
         Returns:
             (boolean): True if item was successfully added
         """
-        temp_dict = {'Connection': conn, 'Name': name, 'Room': chat_room}
-        for entry in self.client_list:
-            if (entry['Connection'] == conn and entry['Name'] == name
-                    and entry['Room'] == chat_room):
+        with self._lock:
+            if conn in self._sessions:
                 return False
-        self.client_list.append(temp_dict)
+            self._sessions[conn] = {'Connection': conn, 'Name': name,
+                                    'Room': chat_room}
+            self._rooms.setdefault(chat_room, {})[conn] = None
+            return True
 
     def removeFromList(self, conn: socket):
         """
@@ -45,17 +84,19 @@ class ClientList:
         Returns:
             (boolean): True if item was removed successfully
         """
-        for entry in self.client_list:
-            if entry['Connection'] == conn:
-                self.client_list.remove(entry)
-                return True
-        return False
+        with self._lock:
+            entry = self._sessions.pop(conn, None)
+            if entry is None:
+                return False
+            self._leaveRoom(conn, entry['Room'])
+            return True
 
     def getList(self):
         """
         Returns a copy of the list of clients
         """
-        return self.client_list.copy()
+        with self._lock:
+            return [entry.copy() for entry in self._sessions.values()]
 
     def connectionsInRoom(self, chat_room: str):
         """
@@ -68,11 +109,8 @@ class ClientList:
         Returns:
             (list): A list of connections in that room
         """
-        connections = []
-        for entry in self.client_list:
-            if entry['Room'] == chat_room:
-                connections.append(entry['Connection'])
-        return connections
+        with self._lock:
+            return list(self._rooms.get(chat_room, ()))
 
     def connections(self):
         """
@@ -84,10 +122,8 @@ class ClientList:
         Returns:
             (list): List of all connections
         """
-        connections = []
-        for entry in self.client_list:
-            connections.append(entry['Connection'])
-        return connections
+        with self._lock:
+            return list(self._sessions)
 
     def getConnRoom(self, conn: socket):
         """
@@ -100,10 +136,9 @@ class ClientList:
         Returns:
             (str): The current chat room of this connection
         """
-        for entry in self.client_list:
-            if entry['Connection'] == conn:
-                return entry['Room']
-        return None
+        # A single dict lookup is atomic, so readers do not take the lock
+        entry = self._sessions.get(conn)
+        return entry['Room'] if entry else None
 
     def getName(self, conn: socket):
         """
@@ -116,10 +151,8 @@ class ClientList:
         Returns:
             (str): The name of the user of that connection
         """
-        for entry in self.client_list:
-            if entry['Connection'] == conn:
-                return entry['Name']
-        return None
+        entry = self._sessions.get(conn)
+        return entry['Name'] if entry else None
 
     def updateChatRoom(self, conn: socket, chat_room: str):
         """
@@ -133,30 +166,90 @@ class ClientList:
         Returns:
             (boolean): True if client has left the room
         """
-        for entry in self.client_list:
-            if entry['Connection'] == conn:
-                entry['Room'] = chat_room
-                return True
-        return False
+        with self._lock:
+            entry = self._sessions.get(conn)
+            if entry is None:
+                return False
+            self._leaveRoom(conn, entry['Room'])
+            entry['Room'] = chat_room
+            self._rooms.setdefault(chat_room, {})[conn] = None
+            return True
+
+    def _leaveRoom(self, conn: socket, chat_room: str):
+        """
+        Removes a connection from a room's members, dropping the room once
+        it is empty. Must be called with the lock held.
+
+        Parameters:
+            self (ClientList): This instance
+            conn (socket): The connection leaving
+            chat_room (str): The room it is leaving
+        """
+        members = self._rooms[chat_room]
+        del members[conn]
+        if not members:
+            del self._rooms[chat_room]
 
 class MessageProtocol:
     """
     Class providing helper functions for the message protocol. Contains the
     header_len variable which is the max length of the header file (8 bytes).
 
-    The protocol uses fixed length headers. A header of lenght 8 bytes is first
-    sent. It contains the message length and senders name to the client. The
-    message is then sent.
+    Version 1 of the protocol uses fixed length headers. A header of lenght
+    8 bytes is first sent. It contains the message length and senders name
+    to the client. The message is then sent.
+
+    Version 2 replaces the header with a 9 byte binary prefix holding the
+    message length, frame type and the id of the sender.
+
+    Every connection starts on version 1. The client's first message (its
+    name) lists the versions it supports in the header. A server that
+    understands this replies with the version to use and both sides switch
+    to it. Older servers ignore the list and older clients never send it,
+    so either side can be upgraded on its own. Compression is agreed the
+    same way, and only used with version 2 (see Compression). A client
+    that answers pings says so in its first message, and the server then
+    pings it when it has been quiet for a while, to find clients that have
+    gone away without closing the connection.
+
+    Files are sent in frames of their own type, so a client that says it
+    can recieve files can be sent them between its messages. An upload
+    starts with an UPLOAD frame describing the file, the server answers
+    with the offset to send from and the file then follows in CHUNK
+    frames. The server offers a file with a FILE frame, followed by its
+    contents in FILE_DATA frames whose sender is the id of the file. The
+    contents of CHUNK and FILE_DATA frames are left as bytes, and never
+    compressed.
+
+    The recent messages of a room, sent to a client joining it, are sent
+    as HISTORY frames, or in version 1 with history set in their header,
+    so they can be told apart from messages sent since. Clients that do
+    not know about them show them like any other message.
     """
     header_len = 8  # Max length of header in bytes
+    prefix = struct.Struct('!IBI')  # Length, type and sender of a v2 frame
+    supported_versions = (1, 2)
 
-    def create_header(msg: str, name: str):
+    MSG = 0         # Frame types for version 2
+    PING = 1        # Asks the other side to show it is still there
+    PONG = 2        # Answers a ping
+    UPLOAD = 3      # Client is about to send a file
+    UPLOAD_READY = 4    # Server is ready for it, or refuses it
+    CHUNK = 5       # Next part of the file being uploaded
+    FILE = 6        # Server is about to send a file
+    FILE_DATA = 7   # Next part of a file being sent
+    HISTORY = 8     # Message sent to the room before the client joined it
+    BINARY = (CHUNK, FILE_DATA)     # Frame types that are not text
+    COMPRESSED = 0x80   # Added to the type of a frame that is compressed
+
+    def create_header(msg: str, name: str, **extra):
         """
         Creates the header for the inputted message.
 
         Parameters:
             msg (str): The message to be sent
             name (str): The name of the client sending the message
+            extra: Any other fields to put in the header
 
         Returns:
             (str): A json object representing the header for the message
@@ -164,8 +257,25 @@ class MessageProtocol:
         Errors:
             ValueError: If header lenght is too long
         """
-        header_dict = {'content-length': len(msg.encode()),
-                       'name': name}
+        return MessageProtocol.encode_header(len(msg.encode()), name,
+                                             **extra)
+
+    def encode_header(length: int, name: str, **extra):
+        """
+        Creates the header for a message of a known length in bytes.
+
+        Parameters:
+            length (int): Length of the encoded message
+            name (str): The name of the client sending the message
+            extra: Any other fields to put in the header
+
+        Returns:
+            (str): A json object representing the header for the message
+
+        Errors:
+            ValueError: If header lenght is too long
+        """
+        header_dict = {'content-length': length, 'name': name, **extra}
         header = json.dumps(header_dict)
         if (len(header) >= 2**MessageProtocol.header_len):
             raise ValueError('Header too large')
@@ -183,22 +293,170 @@ class MessageProtocol:
         """
         return (json.loads(header))
 
-    def send_msg_protocol(conn: socket, msg: str, name: str):
+    def create_frame(msg: str, name: str, version: int = 1,
+                     sender_id: int = 0, msg_type: int = MSG,
+                     codec=None, **extra):
         """
-        Function to send the message, including headers. It will first send the
-        header for the message. Then sends the actual message.
+        Creates the bytes to send for a message, header included.
+
+        Parameters:
+            msg (str): The message to be sent
+            name (str): Name of sending process, only sent in version 1
+            version (int): Protocol version to use
+            sender_id (int): Id of sending process, only sent in version 2
+            msg_type (int): Frame type, only sent in version 2
+            codec (Compression): Compression agreed for the connection, or
+                None. Only used in version 2
+            extra: Other header fields, only sent in version 1
+
+        Returns:
+            (bytes): The frame
+        """
+        return MessageProtocol.encode_frame(msg.encode(), name, version,
+                                            sender_id, msg_type, codec,
+                                            **extra)
+
+    def encode_frame(body: bytes, name: str, version: int = 1,
+                     sender_id: int = 0, msg_type: int = MSG,
+                     codec=None, **extra):
+        """
+        Same as create_frame, for a message that is already encoded.
+
+        Parameters:
+            body (bytes): The encoded message
+            name (str): Name of sending process, only sent in version 1
+            version (int): Protocol version to use
+            sender_id (int): Id of sending process, only sent in version 2
+            msg_type (int): Frame type, only sent in version 2
+            codec (Compression): Compression agreed for the connection, or
+                None. Only used in version 2
+            extra: Other header fields, only sent in version 1
+
+        Returns:
+            (bytes): The frame
+        """
+        if version >= 2:
+            if codec is not None:
+                body, msg_type = codec.encode(body, msg_type)
+            return MessageProtocol.prefix.pack(len(body), msg_type,
+                                               sender_id) + body
+        header = MessageProtocol.encode_header(len(body), name,
+                                               **extra).encode()
+        return header.ljust(2**MessageProtocol.header_len) + body
+
+    def send_msg_protocol(conn: socket, msg: str, name: str,
+                          version: int = 1, sender_id: int = 0,
+                          codec=None):
+        """
+        Function to send the message, including headers. The header and
+        message are sent in one write.
 
         Parameters:
             conn (socket): Connection to send message down
             msg (str): Message to send
             name (str): Name of sending process
+            version (int): Protocol version to use
+            sender_id (int): Id of sending process
+            codec (Compression): Compression agreed for the connection
+        """
+        conn.sendall(MessageProtocol.create_frame(msg, name, version,
+                                                  sender_id, codec=codec))
+
+    def header_size(version: int = 1):
         """
-        header = MessageProtocol.create_header(msg, name).encode()
-        header += b' ' * ((2**MessageProtocol.header_len) - len(header))
-        conn.sendall(header)           # Send header
-        conn.sendall(msg.encode())     # Send message
+        Returns the size in bytes of the header used by a version.
+        """
+        if version >= 2:
+            return MessageProtocol.prefix.size
+        return 2**MessageProtocol.header_len
 
-    def recv_msg_protocol(conn: socket):
+    def read_header(header, version: int = 1):
+        """
+        Reads the header of a frame. For version 2 the header is the
+        unpacked prefix as a dictionary.
+
+        Parameters:
+            header (bytes-like): The header_size(version) bytes of header
+            version (int): Protocol version in use
+
+        Returns:
+            (dict): The header, or None if it was invalid
+        """
+        if version >= 2:
+            length, msg_type, sender_id = \
+                MessageProtocol.prefix.unpack(header)
+            return {'content-length': length, 'type': msg_type,
+                    'sender': sender_id}
+        try:
+            return json.loads(str(header, 'utf-8'))
+        except (json.decoder.JSONDecodeError, UnicodeDecodeError):
+            # Malformed header, do nothing
+            return None
+
+    def decode_body(msg_header: dict, msg):
+        """
+        Turns the message of a frame into text, unless it is one of the
+        frame types holding bytes.
+
+        Parameters:
+            msg_header (dict): Header of the frame
+            msg (bytes-like): The message
+
+        Returns:
+            (str or bytes): The message
+        """
+        if msg_header.get('type') in MessageProtocol.BINARY:
+            return bytes(msg)
+        return str(msg, 'utf-8')
+
+    def recv_exactly(conn: socket, size: int):
+        """
+        Recieves exactly size bytes, calling recv as many times as needed.
+
+        Parameters:
+            conn (socket): Socket to recieve from
+            size (int): Number of bytes to recieve
+
+        Returns:
+            (bytearray): The data
+
+        Errors:
+            ConnectionResetError: If the connection closes first
+        """
+        data = bytearray(size)
+        view = memoryview(data)
+        received = 0
+        while received < size:
+            n = conn.recv_into(view[received:])
+            if n == 0:
+                raise ConnectionResetError('Connection closed')
+            received += n
+        return data
+
+    def recv_frame(conn: socket, version: int = 1):
+        """
+        Recieves one frame, returning its header and message. Only suitable
+        for one off reads, as anything sent after the frame is left on the
+        socket. Connections should use a FrameDecoder instead.
+
+        Parameters:
+            conn (socket): Socket to recieve message from
+            version (int): Protocol version in use
+
+        Returns:
+            (dict, str): The header and message, or (None, None) if the
+                header was invalid
+        """
+        msg_header = MessageProtocol.read_header(
+            MessageProtocol.recv_exactly(
+                conn, MessageProtocol.header_size(version)), version)
+        if msg_header is None:
+            return (None, None)
+        msg = MessageProtocol.recv_exactly(conn,
+                                           msg_header['content-length'])
+        return (msg_header, MessageProtocol.decode_body(msg_header, msg))
+
+    def recv_msg_protocol(conn: socket, version: int = 1):
         """
         Handles the recieving of messages using the protocol where the
         header is sent first, then the message. Returns nothing if header
@@ -206,143 +464,696 @@ class MessageProtocol:
 
         Parameters:
             conn (socket): Socket to recieve message from
+            version (int): Protocol version in use
 
         Returns:
             (str): The message sent from socket
         """
-        try:
-            msg_header = json.loads(conn
-                                    .recv(2**MessageProtocol.header_len)
-                                    .decode())
-            msg = conn.recv(msg_header['content-length']).decode()
-            return msg
-        except json.decoder.JSONDecodeError:
-            # Malformed header, do nothing
-            return None
+        return MessageProtocol.recv_frame(conn, version)[1]
+
+    def create_hello(name: str, versions=supported_versions,
+                     compression=None, heartbeat: bool = False,
+                     files: bool = False):
+        """
+        Creates the first message a client sends. It is a version 1 message
+        holding the client's name, with the versions and compression it
+        supports added to the header.
+
+        Parameters:
+            name (str): Name of the client
+            versions (tuple): Versions the client supports
+            compression (tuple): Compression the client supports, defaults
+                to Compression.name
+            heartbeat (bool): Whether the client answers pings
+            files (bool): Whether the client can recieve files
+
+        Returns:
+            (bytes): The frame
+        """
+        if compression is None:
+            compression = (Compression.name,)
+        extra = {'heartbeat': True} if heartbeat else {}
+        if files:
+            extra['files'] = True
+        return MessageProtocol.create_frame(
+            name, name, versions=list(versions),
+            compression=list(compression), **extra)
+
+    def negotiate(versions):
+        """
+        Picks the newest version supported by both sides.
+
+        Parameters:
+            versions (list): Versions supported by the client, or None if
+                it did not send any
+
+        Returns:
+            (int): The version to use
+        """
+        common = set(versions or ()) & set(MessageProtocol.supported_versions)
+        return max(common, default=1)
+
+    def negotiate_compression(offered, version: int):
+        """
+        Picks the compression to use, if the client offered one the server
+        supports. Frames are only flagged as compressed in version 2.
+
+        Parameters:
+            offered (list): Compression the client supports, or None if it
+                did not send any
+            version (int): The version agreed
+
+        Returns:
+            (str): Name of the compression to use, or None
+        """
+        if version >= 2 and Compression.name in (offered or ()):
+            return Compression.name
+        return None
+
+    def create_ping(version: int, pong: bool = False):
+        """
+        Creates a ping, or the pong answering one. Both are version 2
+        frames with no content.
+
+        Parameters:
+            version (int): Protocol version in use, at least 2
+            pong (bool): Create a pong instead of a ping
+
+        Returns:
+            (bytes): The frame
+        """
+        return MessageProtocol.encode_frame(
+            b'', '', version, msg_type=(MessageProtocol.PONG if pong
+                                        else MessageProtocol.PING))
+
+    def create_accept(version: int, name: str, compression: str = None,
+                      heartbeat: float = None, files: int = None):
+        """
+        Creates the server's reply to a client that listed its versions. The
+        reply is a version 1 message with no content.
+
+        Parameters:
+            version (int): The version both sides will use
+            name (str): Name of the server
+            compression (str): The compression both sides will use, if any
+            heartbeat (float): Seconds of quiet after which the server
+                pings the client, if it will
+            files (int): Largest file the client may send, if the server
+                will send and recieve files
+
+        Returns:
+            (bytes): The frame
+        """
+        extra = {'compression': compression} if compression else {}
+        if heartbeat:
+            extra['heartbeat'] = heartbeat
+        if files:
+            extra['files'] = files
+        header = MessageProtocol.create_header('', name, version=version,
+                                               **extra)
+        return header.encode().ljust(2**MessageProtocol.header_len)
+
+    def create_control(version: int, msg_type: int, sender_id: int = 0,
+                       **fields):
+        """
+        Creates one of the frames describing a file, UPLOAD, UPLOAD_READY
+        or FILE, which hold their fields as json.
+
+        Parameters:
+            version (int): Protocol version in use, at least 2
+            msg_type (int): Frame type
+            sender_id (int): Id of the sender, or of the file for FILE
+            fields: Fields of the frame
+
+        Returns:
+            (bytes): The frame
+        """
+        return MessageProtocol.encode_frame(json.dumps(fields).encode(), '',
+                                            version, sender_id, msg_type)
+
+    def create_file_data(file_id: int, length: int):
+        """
+        Creates the prefix of a FILE_DATA frame, to be followed by length
+        bytes of the file.
+
+        Parameters:
+            file_id (int): Id of the file
+            length (int): Bytes of the file in the frame
+
+        Returns:
+            (bytes): The prefix
+        """
+        return MessageProtocol.prefix.pack(length, MessageProtocol.FILE_DATA,
+                                           file_id)
+
+    def client_handshake(conn: socket, name: str):
+        """
+        Sends the client's name and waits for the server to pick a version.
+        An older server does not reply, so the first message it sends is
+        returned to be shown to the user.
+
+        Parameters:
+            conn (Connection): Connection to the server
+            name (str): Name of the client
+
+        Returns:
+            (int, str): The version to use, and the first message from an
+                older server or None
+        """
+        conn.sendall(MessageProtocol.create_hello(name))
+        msg_header, msg = conn.recv_frame()
+        if msg_header and 'version' in msg_header:
+            if msg_header.get('compression') == Compression.name:
+                conn.compression = Compression()
+            return (msg_header['version'], None)
+        return (1, msg)
 
-class ClientSetUp(Frame):
+
+class Compression:
     """
-    Dialog box that presents 3 inputs to the user:
-        Username
-        Server IP
-        Port
+    Deflate compression agreed for one connection. Frames of at least
+    threshold bytes are compressed on their own, using a preset dictionary
+    of text the server sends often so that short messages still shrink,
+    and are sent with COMPRESSED added to their type. A frame that would
+    not get smaller is sent as it is.
 
-    Extends the Frame class in tkinter.
+    As no state is carried between frames, a frame sent to a whole room is
+    only compressed once and frames can still be dropped from a queue.
+    The bytes sent before and after compression and the CPU time spent are
+    counted so the saving can be reported for each connection.
     """
+    # The dictionary is part of what the name stands for, so the name
+    # changes whenever it does
+    name = 'zlib2'
+    wbits = -15     # Raw deflate, the frame already holds the length
+    # Most likely text last, as it is the cheapest to refer back to
+    dictionary = (
+        ' the and you to is it that for what have this with are was not'
+        ' but just can will know from about there they when think like'
+        '\n------  -------------------  -----------\n'
+        'Name    Room\n  General  '
+        + WELCOME_MESSAGE
+        + ''.join(line + '\n' for line in HELP_LINES + FILE_HELP)
+        + LEFT + ENTERED
+    ).encode()
 
-    def __init__(self):
-        super().__init__()
-        self.name = ''
-        self.ip = ''
-        self.port = ''
-        self.initUI()
+    def __init__(self, threshold: int = 512, level: int = 6):
+        self.threshold = threshold
+        self.level = level
+        # Counted without a lock, so totals are close rather than exact
+        # when several threads send to the connection at once
+        self.raw_bytes = 0          # Bytes of messages sent
+        self.wire_bytes = 0         # The same messages as sent
+        self.frames = 0             # Messages sent compressed
+        self.compress_seconds = 0.0
+        self.inflated_bytes = 0     # Bytes recieved once decompressed
+        self.decompress_seconds = 0.0
+
+    def compress(self, body: bytes):
+        """
+        Compresses a message if it is large enough and gets smaller.
 
-    def initUI(self):
+        Parameters:
+            body (bytes): The message
+
+        Returns:
+            (bytes): The compressed message, or None to send it as it is
         """
-        Initialises the dialog box. The box will contain fields for the
-        username, server ip and server port. A button is used to submit
-        the data.
+        if len(body) < self.threshold:
+            return None
+        start = time.thread_time()
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, self.wbits,
+                                      zdict=self.dictionary)
+        data = compressor.compress(body) + compressor.flush()
+        self.compress_seconds += time.thread_time() - start
+        return data if len(data) < len(body) else None
+
+    def count(self, raw: int, wire: int):
         """
-        self.master.title("Connection Details")
-        self.pack(fill=BOTH, expand=True)
-        # Prepare the username field
-        frame1 = Frame(self)
-        frame1.pack(fill=X)
+        Records a message being sent.
 
-        lbl1 = Label(frame1, text="Username", width=14)
-        lbl1.pack(side=LEFT, padx=5, pady=10)
+        Parameters:
+            raw (int): Length of the message
+            wire (int): Length as sent
+        """
+        self.raw_bytes += raw
+        self.wire_bytes += wire
+        if wire != raw:
+            self.frames += 1
 
-        self.entry1 = Entry(frame1, textvariable=self.name)
-        self.entry1.pack(fill=X, padx=5, expand=True)
-        # Prepare the server address field
-        frame2 = Frame(self)
-        frame2.pack(fill=X)
+    def encode(self, body: bytes, msg_type: int):
+        """
+        Compresses a message for a version 2 frame if it is worth it.
 
-        lbl2 = Label(frame2, text="Server Address", width=14)
-        lbl2.pack(side=LEFT, padx=5, pady=10)
+        Parameters:
+            body (bytes): The message
+            msg_type (int): Frame type
 
-        self.entry2 = Entry(frame2, textvariable=self.ip)
-        self.entry2.pack(fill=X, padx=5, expand=True)
-        # Prepare the server port field
-        frame3 = Frame(self)
-        frame3.pack(fill=X)
+        Returns:
+            (bytes, int): The message and frame type to send
+        """
+        data = self.compress(body)
+        if data is None:
+            self.count(len(body), len(body))
+            return (body, msg_type)
+        self.count(len(body), len(data))
+        return (data, msg_type | MessageProtocol.COMPRESSED)
 
-        lbl3 = Label(frame3, text="Server Port", width=14)
-        lbl3.pack(side=LEFT, padx=5, pady=10)
+    def decompress(self, data, max_size: int):
+        """
+        Decompresses a message that was sent compressed.
 
-        self.entry3 = Entry(frame3, textvariable=self.port)
-        self.entry3.pack(fill=X, padx=5, expand=True)
+        Parameters:
+            data (bytes): The compressed message
+            max_size (int): Largest message accepted once decompressed
 
-        frame4 = Frame(self)
-        frame4.pack(fill=X)
+        Returns:
+            (bytes): The message
 
-        # Command tells the form what to do when the button is clicked
-        btn = Button(frame4, text="Submit", command=self.onSubmit)
-        btn.pack(padx=5, pady=10)
+        Errors:
+            ValueError: If the data is not valid or decompresses to more
+                than max_size bytes
+        """
+        start = time.thread_time()
+        decompressor = zlib.decompressobj(self.wbits, zdict=self.dictionary)
+        try:
+            body = decompressor.decompress(data, max_size)
+        except zlib.error as e:
+            raise ValueError(f'Invalid compressed frame: {e}') from e
+        if decompressor.unconsumed_tail:
+            raise ValueError('Frame too large')
+        if not decompressor.eof:
+            raise ValueError('Invalid compressed frame: truncated')
+        self.inflated_bytes += len(body)
+        self.decompress_seconds += time.thread_time() - start
+        return body
 
-        # Give entry1 focus
-        self.entry1.focus()
+    def stats(self):
+        """
+        Returns how well compression has worked for the connection.
 
-        # Set up what happens when Return is pressed
-        # All entries will move onto the next except port which will submit
-        # Note: These didn't work if they weren't lambdas (don't know why)
-        self.entry1.bind('<Return>', lambda event: self.entry2.focus())
-        self.entry2.bind('<Return>', lambda event: self.entry3.focus())
-        self.entry3.bind('<Return>', lambda event: self.onSubmit())
+        Returns:
+            (dict): Counters keyed by name, with the ratio of bytes before
+                compression to bytes sent
+        """
+        return {'raw_bytes': self.raw_bytes,
+                'wire_bytes': self.wire_bytes,
+                'ratio': (self.raw_bytes / self.wire_bytes
+                          if self.wire_bytes else 1.0),
+                'frames': self.frames,
+                'compress_seconds': self.compress_seconds,
+                'inflated_bytes': self.inflated_bytes,
+                'decompress_seconds': self.decompress_seconds}
 
-        photo = PhotoImage(file=resource_path('icon.png'))
-        self.master.iconphoto(False, photo)
 
-    def onSubmit(self):
+class SharedFrame:
+    """
+    A message that is sent to many connections, such as a broadcast to a
+    room. The message is encoded once and the frame for each protocol
+    version is built the first time a connection using it needs it. Every
+    connection on the same version is given the same bytes object. The
+    message is compressed at most once, by the first connection using
+    compression that it is sent to.
+    """
+    _unset = object()
+
+    def __init__(self, msg: str, name: str, sender_id: int = 0):
+        self.body = msg.encode()
+        self.name = name
+        self.sender_id = sender_id
+        self._frames = {}
+        self._compressed = self._unset
+
+    def for_version(self, version: int, codec=None):
         """
-        When clicked, the user input is stored in the instance variables
-        and the boxes are cleared. The widget is then destroyed.
+        Returns the frame for a protocol version.
+
+        Parameters:
+            version (int): Protocol version of the recipient
+            codec (Compression): Compression agreed with the recipient
+
+        Returns:
+            (bytes): The frame
+        """
+        compressed = None
+        if codec is not None and version >= 2:
+            if self._compressed is self._unset:
+                self._compressed = codec.compress(self.body)
+            compressed = self._compressed
+            codec.count(len(self.body), len(compressed or self.body))
+        key = (version, compressed is not None)
+        frame = self._frames.get(key)
+        if frame is None:
+            if compressed is None:
+                frame = MessageProtocol.encode_frame(self.body, self.name,
+                                                     version, self.sender_id)
+            else:
+                frame = MessageProtocol.encode_frame(
+                    compressed, self.name, version, self.sender_id,
+                    MessageProtocol.MSG | MessageProtocol.COMPRESSED)
+            self._frames[key] = frame
+        return frame
+
+    def send_to(self, conn):
         """
-        self.name = self.entry1.get()
-        self.ip = self.entry2.get()
-        self.port = self.entry3.get()
+        Sends the frame to a connection.
+
+        Parameters:
+            conn (Connection): Connection to send to
+        """
+        conn.sendall(self.for_version(conn.version, conn.compression))
+
+
+class FrameDecoder:
+    """
+    Incremental decoder for the frames sent down one connection. Data is
+    read straight into a reusable buffer with recv_into and complete frames
+    are taken out of it without copying, so reads that split a frame or
+    hold several frames are both handled.
+
+    The version can be changed between frames, which is how a connection
+    moves to the version agreed in the handshake, and so can the
+    compression used to read compressed frames.
+    """
+    max_frame_size = 2**24  # Largest message accepted, in bytes
 
-        self.entry1.delete(0, END)
-        self.entry2.delete(0, END)
-        self.entry3.delete(0, END)
-        self.quit()
+    def __init__(self, version: int = 1, buffer_size: int = 2**16):
+        self.version = version
+        self.compression = None
+        self._buf = bytearray(buffer_size)
+        self._view = memoryview(self._buf)
+        self._start = 0     # Start of data not yet decoded
+        self._end = 0       # End of data in the buffer
 
-    def retry(self, name='', ip='', port=''):
+    def recv_into(self, sock: socket):
         """
-        Used if the user enters incorrect data. It will repopulate
-        the fields where the data was correct. The mainloop is started
-        once the fields are populated.
+        Reads whatever the socket has into the free end of the buffer.
 
         Parameters:
-            name (str): Name of client
-            ip (str): IP of server
-            port (str): Port of server
+            sock (socket): Socket to read from
+
+        Returns:
+            (int): Number of bytes read, 0 if the connection was closed
+        """
+        self._reserve(len(self._buf) // 2)
+        n = sock.recv_into(self._view[self._end:])
+        self._end += n
+        return n
+
+    def feed(self, data: bytes):
+        """
+        Adds data that has already been read to the buffer.
+
+        Parameters:
+            data (bytes): The data to add
         """
-        self.entry1.insert(0, name)
-        self.entry2.insert(0, ip)
-        self.entry3.insert(0, port)
+        self._reserve(len(data))
+        self._view[self._end:self._end + len(data)] = data
+        self._end += len(data)
 
-        self.mainloop()
-        self.quit()
+    def next_frame(self):
+        """
+        Takes the next complete frame out of the buffer. The message is a
+        view into the buffer, so it is only valid until the decoder is used
+        again.
+
+        Returns:
+            (dict, memoryview): The header and message, (None, None) if the
+                header was invalid, or None if a frame is not complete yet
 
-    def on_close(self):
-        self.destroy()
-        sys.exit()
+        Errors:
+            ValueError: If the frame's length is not a whole number of
+                bytes, or larger than max_frame_size, or the frame is
+                compressed when no compression was agreed
+        """
+        header_size = MessageProtocol.header_size(self.version)
+        if self._end - self._start < header_size:
+            return None
+        header_end = self._start + header_size
+        msg_header = MessageProtocol.read_header(
+            self._view[self._start:header_end], self.version)
+        if msg_header is None:
+            # Skip the malformed header
+            self._start = header_end
+            return (None, None)
+        length = (msg_header.get('content-length')
+                  if isinstance(msg_header, dict) else None)
+        if type(length) is not int or length < 0:
+            # A length that does not move past the header would decode the
+            # same frame forever
+            raise ValueError('Bad content-length')
+        if length > self.max_frame_size:
+            raise ValueError('Frame too large')
+        if self._end - header_end < length:
+            self._reserve(header_size + length - (self._end - self._start))
+            return None
+        self._start = header_end + length
+        msg = self._view[header_end:self._start]
+        if (self.version >= 2
+                and msg_header['type'] & MessageProtocol.COMPRESSED):
+            if self.compression is None:
+                raise ValueError('Compressed frame without compression')
+            msg_header['type'] &= ~MessageProtocol.COMPRESSED
+            msg = memoryview(self.compression.decompress(
+                msg, self.max_frame_size))
+        return (msg_header, msg)
 
-def resource_path(relative_path: str):
+    def take_pending(self):
+        """
+        Takes the data that has been recieved but not yet decoded out of
+        the buffer, so another decoder can carry on from it.
+
+        Returns:
+            (bytes): The data
+        """
+        data = bytes(self._view[self._start:self._end])
+        self._start = self._end = 0
+        return data
+
+    def frames(self):
+        """
+        Yields every complete frame in the buffer, decoding each with the
+        version current when it is reached.
+
+        Yields:
+            (dict, memoryview): The header and message of each frame
+        """
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+    def _reserve(self, size: int):
+        """
+        Makes room for size more bytes after the data in the buffer. Data is
+        moved to the front first, and the buffer only grows if that is not
+        enough.
+
+        Parameters:
+            size (int): Number of free bytes needed
+        """
+        if len(self._buf) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if pending + size > len(self._buf):
+            buf = bytearray(max(pending + size, 2 * len(self._buf)))
+            buf[:pending] = self._view[self._start:self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
+        elif pending:
+            self._view[:pending] = self._view[self._start:self._end]
+        self._start = 0
+        self._end = pending
+
+
+class HandedOff(Exception):
+    """
+    Raised in the thread reading from a connection once the connection has
+    been handed to another process, which now reads from it instead.
     """
-    Utility to get the absolute path of the file. Assumes file is in
-    current directory. Needed for when scirpts are converted into executables.
 
-    Parameters:
-        relative_path (str): Name of file to find
 
-    Returns:
-        (str): Absolute path of file in current directory
+class Connection:
+    """
+    Wraps a socket with the protocol version and compression agreed for it,
+    the decoder for the frames it recieves and an id used to identify the
+    sender of messages in version 2. If the connection is given an outbound
+    queue, frames are put on it for a writer to send instead of being sent
+    straight away.
+
+    If the connection is given a handoff lock, the thread reading from it
+    holds the lock except while it waits for data, which it peeks at
+    without taking it off the socket. Whoever takes the lock then knows
+    the connection is between frames and can hand it to another process.
     """
-    try:
-        base_path = sys._MEIPASS
-    except Exception:
-        base_path = os.path.abspath(".")
 
-    return os.path.join(base_path, relative_path)
+    def __init__(self, sock: socket, conn_id: int = 0):
+        self.sock = sock
+        self.id = conn_id
+        self.decoder = FrameDecoder()
+        self.outbound = None
+        self.last_heard = None  # time.monotonic() of its last frame
+        self.rate_buckets = {}  # Kind of message -> TokenBucket
+        self.paused_until = 0.0     # Not read from until, when over a limit
+        self.throttle_noticed = False
+        self.files = False      # Whether it can recieve files
+        self.upload = None      # Upload of the file it is sending
+        self.accepted = time.monotonic()
+        self.handoff_lock = None
+        self.handed_off = False
+
+    @property
+    def version(self):
+        return self.decoder.version
+
+    @version.setter
+    def version(self, version: int):
+        self.decoder.version = version
+
+    @property
+    def compression(self):
+        return self.decoder.compression
+
+    @compression.setter
+    def compression(self, compression):
+        self.decoder.compression = compression
+
+    @contextmanager
+    def unlocked(self):
+        """
+        Releases the handoff lock, if the connection has one, while the
+        thread reading from it waits.
+
+        Errors:
+            HandedOff: If the connection was handed off meanwhile
+        """
+        if self.handoff_lock is None:
+            yield
+            return
+        self.handoff_lock.release()
+        try:
+            yield
+        finally:
+            self.handoff_lock.acquire()
+            if self.handed_off:
+                raise HandedOff()
+
+    def send_msg(self, msg: str, name: str, sender_id: int = 0):
+        """
+        Sends a message using the version agreed for this connection.
+
+        Parameters:
+            msg (str): Message to send
+            name (str): Name of sending process
+            sender_id (int): Id of sending process
+        """
+        MessageProtocol.send_msg_protocol(self, msg, name, self.version,
+                                          sender_id, self.compression)
+
+    def recv_frame(self, deadline: float = None):
+        """
+        Recieves the next frame, reading from the socket only when the
+        decoder does not already hold a complete one.
+
+        Parameters:
+            deadline (float): time.monotonic() by which the whole frame
+                must have arrived, or None to use the socket's timeout for
+                each read
+
+        Returns:
+            (dict, str): The header and message, or (None, None) if the
+                header was invalid
+
+        Errors:
+            ConnectionResetError: If the connection closes
+            socket.timeout: If the deadline passes first
+            HandedOff: If the connection was handed off while waiting
+        """
+        frame = self.decoder.next_frame()
+        while frame is None:
+            if deadline is not None:
+                # A client sending a byte at a time cannot extend the wait
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError('Deadline passed')
+                self.sock.settimeout(remaining)
+            if self.handoff_lock is not None:
+                # Wait without taking the data, so it is still there for
+                # the process the connection is handed to
+                with self.unlocked():
+                    self.sock.recv(1, MSG_PEEK)
+            if self.decoder.recv_into(self.sock) == 0:
+                raise ConnectionResetError('Connection closed')
+            frame = self.decoder.next_frame()
+        msg_header, msg = frame
+        if msg_header is None:
+            return frame
+        return (msg_header, MessageProtocol.decode_body(msg_header, msg))
+
+    def recv_msg(self):
+        """
+        Recieves a message using the version agreed for this connection.
+
+        Returns:
+            (str): The message sent, or None if the header was invalid
+        """
+        return self.recv_frame()[1]
+
+    def sendall(self, data: bytes):
+        if self.outbound is None:
+            self.sock.sendall(data)
+        else:
+            self.outbound.put(data)
+
+    def send_file(self, transfer):
+        """
+        Sends a file. With an outbound queue it is sent a slice at a time
+        between the other frames, otherwise all of it is sent straight
+        away.
+
+        Parameters:
+            transfer (FileTransfer): The file
+        """
+        if self.outbound is not None:
+            self.outbound.put_file(transfer)
+            return
+        try:
+            while transfer.remaining:
+                piece = transfer.next_slice()
+                self.sock.sendall(piece.prefix)
+                self.sock.sendfile(piece.file, piece.offset, piece.count)
+        finally:
+            transfer.close()
+
+    def shutdown(self, how: int):
+        self.sock.shutdown(how)
+
+    def abort(self):
+        """
+        Drops the connection from any thread, waking the thread reading
+        from it, which is left to clean up.
+        """
+        try:
+            self.sock.shutdown(SHUT_RDWR)
+        except OSError:
+            # Already closed
+            pass
+
+    def close(self):
+        if self.outbound is not None:
+            self.outbound.close()
+        self.sock.close()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+def __getattr__(name: str):
+    """
+    ClientSetUp and resource_path live in gui, which needs tkinter, so that
+    the server can run without it. They can still be imported from here.
+    """
+    if name in ('ClientSetUp', 'resource_path'):
+        import gui
+        return getattr(gui, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,457 @@
+import asyncio
+import json
+import os
+from collections import deque, namedtuple
+from ChatRoomHelpers import (Compression, FrameDecoder, MessageProtocol as mp,
+                             DISCONNECT, HELP, MOVE_ROOM, LEAVE_ROOM,
+                             ROOM_DETAILS, WHO, GET_FILE)
+
+READ_SIZE = 2**16   # Most bytes taken from the stream per read
+CHUNK_SIZE = 2**17  # Bytes of a file sent in each frame
+SEPARATOR = ':\n '  # Between the sender's name and their message
+
+# A message recieved from the server. text is the message as shown to the
+# user. sender is the name of the user that sent it to the room, or None
+# if it came from the server itself, and body is the text without the name.
+# sender_id is only known with version 2 of the protocol and is 0 otherwise.
+# replayed is True for the room's recent messages, sent on joining it.
+Message = namedtuple('Message',
+                     ['text', 'sender', 'body', 'sender_id', 'replayed'],
+                     defaults=(False,))
+
+
+def parse_message(msg_header: dict, text: str):
+    """
+    Splits a message sent to a room into the sender's name and the body.
+
+    Parameters:
+        msg_header (dict): Header of the frame the message came in
+        text (str): The message
+
+    Returns:
+        (Message): The message
+    """
+    replayed = (msg_header.get('type') == mp.HISTORY
+                or msg_header.get('history', False))
+    name, sep, body = text.partition(SEPARATOR)
+    if not sep:
+        return Message(text, None, text, msg_header.get('sender', 0),
+                       replayed)
+    return Message(text, name, body, msg_header.get('sender', 0), replayed)
+
+
+class ChatClient:
+    """
+    Client for a ChatRoom server running on an asyncio event loop. It does
+    not need a display, so it can be used by bots, integrations and tests
+    as well as by the GUI.
+
+    send only queues a message on the stream, so many can be sent without
+    waiting for each one to be written. Await drain to wait for them to be
+    written. Messages from the server are recieved with recv or by
+    iterating over the client, which also answers the server's pings, so a
+    client that stops recieving is eventually disconnected:
+
+        client = await async_client.connect('bot', '127.0.0.1', 5000)
+        client.move('Lobby')
+        client.send('Hello')
+        async for message in client:
+            print(message.text)
+
+    Files shared in the room are saved in download_dir as they arrive, and
+    a message saying where is recieved once each is complete. Files the
+    server does not send straight away are asked for with get_file. A
+    download that was cut off is kept in downloads, and get_file carries
+    on from where it got to.
+
+    Parameters:
+        name (str): Name of the client
+        download_dir (str): Directory to save files in
+    """
+
+    def __init__(self, name: str, download_dir: str = 'downloads'):
+        self.name = name
+        self.download_dir = download_dir
+        self.decoder = FrameDecoder()
+        self.reader = None
+        self.writer = None
+        self.heartbeat = None   # Seconds of quiet before the server pings
+        self.files = None   # Largest file the server accepts, if any
+        self.downloads = {}     # File id -> details of a file being saved
+        self._upload_ready = None   # Future for the reply to an upload
+        self._early = deque()   # Messages recieved during the handshake
+
+    @property
+    def version(self):
+        """
+        The protocol version agreed with the server.
+        """
+        return self.decoder.version
+
+    @property
+    def compression(self):
+        """
+        The compression agreed with the server, or None.
+        """
+        return self.decoder.compression
+
+    @property
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self, host: str, port: int,
+                      versions: tuple = mp.supported_versions,
+                      compress: bool = True):
+        """
+        Connects to the server, sends the client's name and agrees a
+        protocol version and compression. The client offers to answer the
+        server's pings, which recv does. An older server does not reply to
+        the versions, so the first message it sends is kept to be recieved
+        as normal. Sending and recieving files is offered as well.
+
+        Parameters:
+            host (str): Address of the server
+            port (int): Port of the server
+            versions (tuple): Protocol versions to offer
+            compress (bool): Offer to compress large messages
+
+        Errors:
+            OSError: If the server cannot be reached
+            ConnectionResetError: If the server closes the connection
+        """
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        if max(versions) > 1:
+            hello = mp.create_hello(
+                self.name, versions,
+                compression=(Compression.name,) if compress else (),
+                heartbeat=True, files=True)
+        else:
+            hello = mp.create_frame(self.name, self.name)
+        self.writer.write(hello)
+        msg_header, msg = await self._read_frame()
+        if msg_header and 'version' in msg_header:
+            self.decoder.version = msg_header['version']
+            if msg_header.get('compression') == Compression.name:
+                self.decoder.compression = Compression()
+            self.heartbeat = msg_header.get('heartbeat')
+            self.files = msg_header.get('files')
+        elif msg_header:
+            self._early.append(parse_message(msg_header, str(msg, 'utf-8')))
+
+    def send(self, msg: str):
+        """
+        Queues a message or command to be sent to the server. Does not wait
+        for it to be written.
+
+        Parameters:
+            msg (str): The message
+
+        Errors:
+            ConnectionResetError: If the connection is closed
+        """
+        if not self.connected:
+            raise ConnectionResetError('Not connected to the server')
+        self.writer.write(mp.create_frame(msg, self.name, self.version,
+                                          codec=self.compression))
+
+    def send_many(self, msgs):
+        """
+        Queues several messages to be sent to the server with one write.
+
+        Parameters:
+            msgs (iterable): The messages
+
+        Errors:
+            ConnectionResetError: If the connection is closed
+        """
+        if not self.connected:
+            raise ConnectionResetError('Not connected to the server')
+        self.writer.writelines([mp.create_frame(msg, self.name, self.version,
+                                                codec=self.compression)
+                                for msg in msgs])
+
+    async def drain(self):
+        """
+        Waits until the messages sent so far have been written, or enough of
+        them that the stream is below its limit.
+        """
+        await self.writer.drain()
+
+    def move(self, room: str):
+        """
+        Moves into a room, creating it if it does not exist.
+        """
+        self.send(f'{MOVE_ROOM} {room}')
+
+    def leave(self):
+        """
+        Leaves the current room and moves into the default room.
+        """
+        self.send(LEAVE_ROOM)
+
+    def rooms(self, prefix: str = '', page: int = 1):
+        """
+        Asks for a page of the rooms and the number of clients in each. It
+        is recieved as a message from the server.
+
+        Parameters:
+            prefix (str): Only list rooms starting with this
+            page (int): Page to ask for, from 1
+        """
+        if not prefix and page == 1:
+            # Older servers only understand the command on its own
+            self.send(ROOM_DETAILS)
+        else:
+            self.send(f'{ROOM_DETAILS} {prefix} {page}')
+
+    def who(self, room: str = '', page: int = 1):
+        """
+        Asks for a page of the clients in a room, the client's own room if
+        none is given. It is recieved as a message from the server.
+
+        Parameters:
+            room (str): The room
+            page (int): Page to ask for, from 1
+        """
+        self.send(f'{WHO} {room} {page}')
+
+    def help(self):
+        """
+        Asks for the help message.
+        """
+        self.send(HELP)
+
+    async def send_file(self, path: str, file_id: int = None):
+        """
+        Shares a file with the room. It is sent in chunks, waiting for each
+        to be written, so messages sent meanwhile are not held up behind
+        the whole file. The server's reply is read by recv, so something
+        must be recieving messages while a file is sent.
+
+        Parameters:
+            path (str): The file
+            file_id (int): Id of an upload that was cut off, to carry on
+                from where the server got to
+
+        Returns:
+            (int): Id of the upload
+
+        Errors:
+            ValueError: If the server does not accept the file
+            OSError: If the file cannot be read
+            ConnectionResetError: If the connection is closed
+        """
+        if not self.files:
+            raise ValueError('The server does not accept files')
+        if self._upload_ready is not None:
+            raise ValueError('Already sending a file')
+        size = os.path.getsize(path)
+        if size > self.files:
+            raise ValueError(f'Files must be at most {self.files} bytes')
+        if not self.connected:
+            raise ConnectionResetError('Not connected to the server')
+        self._upload_ready = asyncio.get_running_loop().create_future()
+        try:
+            self.writer.write(mp.create_control(
+                self.version, mp.UPLOAD, name=os.path.basename(path),
+                size=size, id=file_id))
+            reply = await self._upload_ready
+        finally:
+            self._upload_ready = None
+        if 'error' in reply:
+            raise ValueError(reply['error'])
+        with open(path, 'rb') as f:
+            f.seek(reply['offset'])
+            chunk = f.read(CHUNK_SIZE)
+            while chunk:
+                self.writer.write(mp.encode_frame(chunk, self.name,
+                                                  self.version,
+                                                  msg_type=mp.CHUNK))
+                await self.writer.drain()
+                chunk = f.read(CHUNK_SIZE)
+        return reply['id']
+
+    def get_file(self, file_id: int, offset: int = None):
+        """
+        Asks for a file shared in the room. It is saved when recieved.
+
+        Parameters:
+            file_id (int): Id of the file
+            offset (int): Where in the file to start, defaults to the end
+                of what was saved of it before
+        """
+        if offset is None:
+            download = self.downloads.get(file_id)
+            offset = download['received'] if download else 0
+        self.send(f'{GET_FILE} {file_id} {offset}')
+
+    async def recv(self):
+        """
+        Waits for the next message from the server, answering any pings
+        that arrive first.
+
+        Returns:
+            (Message): The message
+
+        Errors:
+            ConnectionResetError: If the connection closes
+        """
+        if self._early:
+            return self._early.popleft()
+        while True:
+            msg_header, msg = await self._read_frame()
+            if msg_header is None:
+                continue
+            msg_type = msg_header.get('type', mp.MSG)
+            if msg_type == mp.PING:
+                self.writer.write(mp.create_ping(self.version, pong=True))
+            elif msg_type == mp.FILE_DATA:
+                message = self._save_data(msg_header['sender'], msg)
+                if message:
+                    return message
+            elif msg_type == mp.FILE:
+                message = self._start_download(json.loads(str(msg, 'utf-8')))
+                if message:
+                    return message
+            elif msg_type == mp.UPLOAD_READY:
+                if self._upload_ready and not self._upload_ready.done():
+                    self._upload_ready.set_result(
+                        json.loads(str(msg, 'utf-8')))
+            elif msg_type != mp.PONG:
+                return parse_message(msg_header, str(msg, 'utf-8'))
+
+    def _start_download(self, info: dict):
+        """
+        Opens the file to save a file the server is about to send in. A
+        download from an offset carries on with the file saved before.
+
+        Parameters:
+            info (dict): The FILE frame, the file's id, name, size, sender
+                and the offset it is sent from
+
+        Returns:
+            (Message): Message saying the file was saved, if there is
+                nothing left to recieve
+        """
+        old = self.downloads.pop(info['id'], None)
+        if old:
+            old['file'].close()
+        os.makedirs(self.download_dir, exist_ok=True)
+        name = os.path.basename(info['name']) or 'file'
+        path = os.path.join(self.download_dir, f'{info["id"]}-{name}')
+        file = open(path, 'r+b' if info['offset'] and os.path.exists(path)
+                    else 'wb')
+        file.truncate(info['offset'])
+        file.seek(info['offset'])
+        self.downloads[info['id']] = {**info, 'path': path, 'file': file,
+                                      'received': info['offset']}
+        return self._save_data(info['id'], b'')
+
+    def _save_data(self, file_id: int, data):
+        """
+        Adds part of a file being downloaded to the file.
+
+        Parameters:
+            file_id (int): Id of the file
+            data (bytes-like): The part
+
+        Returns:
+            (Message): Message saying the file was saved, once all of it
+                has been
+        """
+        download = self.downloads.get(file_id)
+        if download is None:
+            # Its FILE frame was lost
+            return None
+        download['file'].write(data)
+        download['received'] += len(data)
+        if download['received'] < download['size']:
+            return None
+        download['file'].close()
+        del self.downloads[file_id]
+        text = (f'{download["sender"]} sent {download["name"]}, saved to'
+                f' {download["path"]}')
+        return Message(text, None, text, 0)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.recv()
+        except (ConnectionResetError, OSError):
+            raise StopAsyncIteration
+
+    async def disconnect(self):
+        """
+        Tells the server the client is leaving, then closes the connection.
+        """
+        if self.connected:
+            try:
+                self.send(DISCONNECT)
+                await self.drain()
+            except OSError:
+                # Server already went away
+                pass
+        await self.close()
+
+    async def close(self):
+        for download in self.downloads.values():
+            # Kept, so get_file can carry on with them later
+            download['file'].close()
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.disconnect()
+
+    async def _read_frame(self):
+        """
+        Waits for the next frame from the server.
+
+        Returns:
+            (dict, memoryview): The header and message, or (None, None) if
+                the header was invalid
+
+        Errors:
+            ConnectionResetError: If the connection closes
+        """
+        while True:
+            frame = self.decoder.next_frame()
+            if frame is not None:
+                return frame
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                error = ConnectionResetError('Server closed the connection')
+                if self._upload_ready and not self._upload_ready.done():
+                    self._upload_ready.set_exception(error)
+                raise error
+            self.decoder.feed(data)
+
+
+async def connect(name: str, host: str, port: int,
+                  versions: tuple = mp.supported_versions,
+                  compress: bool = True):
+    """
+    Creates a client and connects it to a server.
+
+    Parameters:
+        name (str): Name of the client
+        host (str): Address of the server
+        port (int): Port of the server
+        versions (tuple): Protocol versions to offer
+        compress (bool): Offer to compress large messages
+
+    Returns:
+        (ChatClient): The connected client
+    """
+    client = ChatClient(name)
+    await client.connect(host, port, versions, compress)
+    return client
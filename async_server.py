@@ -0,0 +1,503 @@
+import asyncio
+import socket
+import time
+import handoff
+import server
+from server import client_list
+from ChatRoomHelpers import Connection, MessageProtocol as mp
+from outbound import AsyncOutboundQueue, FileSlice, PAUSE
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where the limit cannot be changed
+    resource = None
+
+READ_SIZE = 2**16   # Most bytes taken from a stream per read
+# Turns of the event loop a connection accepted by the server takes to
+# reach handle_client
+ACCEPT_TURNS = 4
+congested = set()   # Connections the current sender should wait for
+
+
+class StreamConnection(Connection):
+    """
+    Wraps the writing end of an asyncio stream so it can be used in place of
+    a socket by the command handlers in server.py. Writes are buffered by
+    the transport so they never block the event loop.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter, conn_id: int = 0):
+        super().__init__(writer.get_extra_info('socket'), conn_id)
+        self.reader = reader
+        self.writer = writer
+        self.outbound = AsyncOutboundQueue(**server.outbound_settings)
+        self.read_task = None
+
+    async def recv_frame(self):
+        """
+        Recieves the next frame, reading from the stream only when the
+        decoder does not already hold a complete one.
+
+        Returns:
+            (dict, str): The header and message, or (None, None) if the
+                header was invalid
+
+        Errors:
+            ConnectionResetError: If the client closes the connection
+        """
+        frame = self.decoder.next_frame()
+        while frame is None:
+            data = await self.reader.read(READ_SIZE)
+            if not data:
+                raise ConnectionResetError('Connection closed')
+            self.decoder.feed(data)
+            frame = self.decoder.next_frame()
+        msg_header, msg = frame
+        if msg_header is None:
+            return frame
+        return (msg_header, mp.decode_body(msg_header, msg))
+
+    async def recv_msg(self):
+        """
+        Recieves a message using the version agreed for this connection.
+
+        Returns:
+            (str): The message sent, or None if the header was invalid
+        """
+        return (await self.recv_frame())[1]
+
+    def sendall(self, data: bytes):
+        """
+        Queues data to be written to the client. With the pause policy a
+        full queue is noted so the sender can wait for it.
+
+        Parameters:
+            data (bytes): Data to send
+        """
+        self.outbound.put(data)
+        if self.outbound.policy == PAUSE and self.outbound.congested:
+            congested.add(self)
+
+    def shutdown(self, how: int):
+        """
+        Stops any more data being written to the client.
+
+        Parameters:
+            how (int): Ignored, kept so this matches socket.shutdown
+        """
+        self.outbound.close()
+
+    def close(self):
+        """
+        Closes the connection, dropping anything still queued.
+        """
+        self.outbound.close()
+        self.writer.close()
+
+    def abort(self):
+        """
+        Drops the connection without waiting for buffered data to reach a
+        client that may never read it. The client's handler then sees the
+        stream close.
+        """
+        self.outbound.close()
+        self.writer.transport.abort()
+
+
+async def write_frames(conn: StreamConnection):
+    """
+    Writes the frames in a connection's queue to its stream a batch at a
+    time, waiting for each write to drain. Slices of files are sent with
+    the event loop's sendfile. Runs as a task for as long as the
+    connection is open. If the queue is closed because the client fell too
+    far behind, the stream is closed so the client's handler stops as well.
+
+    Parameters:
+        conn (StreamConnection): Connection to write to
+    """
+    loop = asyncio.get_running_loop()
+    batch = await conn.outbound.get_batch()
+    try:
+        while batch is not None:
+            if isinstance(batch, FileSlice):
+                await send_slice(loop, conn, batch)
+            else:
+                conn.writer.writelines(batch)
+                conn.outbound.send_calls += 1
+                await conn.writer.drain()
+            batch = await conn.outbound.get_batch()
+    except (OSError, RuntimeError):
+        # Client went away, sendfile raising RuntimeError if the transport
+        # was already closing
+        conn.outbound.close()
+    conn.writer.close()
+
+
+async def send_slice(loop: asyncio.AbstractEventLoop, conn: StreamConnection,
+                     piece: FileSlice):
+    """
+    Writes a slice of a file to a connection, closing the file after its
+    last slice. The loop waits for what is buffered to be written first,
+    then uses os.sendfile where the transport allows it.
+
+    Parameters:
+        loop (AbstractEventLoop): The running loop
+        conn (StreamConnection): Connection to write to
+        piece (FileSlice): The slice
+    """
+    try:
+        conn.writer.write(piece.prefix)
+        if piece.count:
+            await loop.sendfile(conn.writer.transport, piece.file,
+                                piece.offset, piece.count)
+        conn.outbound.send_calls += 1
+        await conn.writer.drain()
+    finally:
+        if piece.last:
+            piece.file.close()
+
+
+async def wait_for_congested():
+    """
+    Pauses the current sender until every client its last message filled
+    the queue of has drained below the low watermark. Message handlers do
+    not await, so anything added to congested while handling a message
+    was caused by the task handling it.
+    """
+    waiting = list(congested)
+    congested.clear()
+    for conn in waiting:
+        await conn.outbound.wait_writable()
+
+
+async def accept_connection(conn: StreamConnection, accepted: float):
+    """
+    Waits for the client to send its name and adds it to the client list.
+    Each client waits in its own task, so slow clients do not hold up the
+    others.
+
+    Parameters:
+        conn (StreamConnection): The newly connected client
+        accepted (float): time.monotonic() when it was accepted
+
+    Returns:
+        (str): Why the handshake failed, as counted in the
+            handshake_failures metric, or None if the client was greeted
+    """
+    failure = 'error'
+    try:
+        msg_header, client_name = await asyncio.wait_for(
+            conn.recv_frame(),
+            accepted + server.handshake_settings['timeout']
+            - time.monotonic())
+        server.greet_client(conn, msg_header, client_name)
+        failure = None
+    except asyncio.TimeoutError:
+        failure = 'timeout'
+    except (ConnectionError, ValueError):
+        # Client left, or sent a frame that was too large, before giving
+        # its name
+        failure = 'closed'
+    finally:
+        server.end_handshake(accepted, failure)
+    return failure
+
+
+async def handle_client(reader: asyncio.StreamReader,
+                        writer: asyncio.StreamWriter):
+    """
+    Handles a client connection as a task on the event loop. Commands are
+    processed by the same handlers as the threaded engine.
+
+    Parameters:
+        reader (StreamReader): Stream to read from the client
+        writer (StreamWriter): Stream to write to the client
+    """
+    if not server.begin_handshake():
+        writer.close()
+        return
+    conn = StreamConnection(reader, writer, next(server.conn_ids))
+    await run_client(conn)
+
+
+async def run_client(conn: StreamConnection, greeted: bool = False):
+    """
+    Serves a client from the current task until it disconnects, or until
+    it is handed off, which cancels the task.
+
+    Parameters:
+        conn (StreamConnection): The client
+        greeted (boolean): Whether it was greeted by a server this one
+            took over from, so there is no handshake
+    """
+    conn.read_task = asyncio.current_task()
+    server.track_connection(conn)
+    # Keep a reference so the task is not garbage collected
+    conn.write_task = asyncio.create_task(write_frames(conn))
+    try:
+        await serve_client(conn, conn.writer.get_extra_info('peername'),
+                           greeted)
+    except asyncio.CancelledError:
+        if not conn.handed_off:
+            raise
+
+
+async def serve_client(conn: StreamConnection, addr: tuple, greeted: bool):
+    """
+    Greets a client, unless it already has been, then processes what it
+    sends until it disconnects. See handle_client.
+    """
+    if not greeted:
+        failure = await accept_connection(conn, conn.accepted)
+        if failure:
+            if failure == 'timeout':
+                print(f"[CLOSING] {addr} took too long to respond")
+            else:
+                print(f"[CLOSING] {addr} closed before sending a name")
+            server.untrack_connection(conn)
+            conn.close()
+            return
+        print(f'[NEW CONNECTION] {addr} has connected')
+        server.sendMsg(conn, client_list.getName(conn) + server.ENTERED)
+
+    connected = True
+    while connected:
+        try:
+            connected = server.handle_frame(conn, *await conn.recv_frame())
+            await wait_for_congested()
+            pause = conn.paused_until - time.monotonic()
+            if pause > 0:
+                # Over a rate limit, stop reading until back under it
+                await asyncio.sleep(pause)
+        except (ConnectionError, OSError, ValueError):
+            # Client went away without sending the disconnect message
+            connected = False
+    print(f'[DISCONNECTION] {client_list.getName(conn)} has disconnected')
+    server.remove_client(conn)
+    print(f'[CONNECTIONS] There are {len(client_list.connections())}'
+          ' connections')
+
+
+async def adopt_sessions(sessions: list):
+    """
+    Carries on serving the clients handed over by the server this process
+    took over from. Every client is put back before any is served, so the
+    messages they had sent reach the others.
+
+    Parameters:
+        sessions (list): (state, unhandled bytes, socket) for each client,
+            from server.take_over
+
+    Returns:
+        (list): The task serving each client
+    """
+    # Opened together, as each takes a turn of the loop
+    streams = await asyncio.gather(
+        *(asyncio.open_connection(sock=sock) for _, _, sock in sessions),
+        return_exceptions=True)
+    adopted = []
+    for (state, pending, sock), stream in zip(sessions, streams):
+        if isinstance(stream, Exception):
+            sock.close()
+            continue
+        reader, writer = stream
+        greeted = state['name'] is not None
+        if not greeted and not server.begin_handshake():
+            writer.close()
+            continue
+        conn = StreamConnection(reader, writer, state['id'])
+        server.restore_session(conn, state, pending)
+        adopted.append((conn, greeted))
+    return [asyncio.create_task(run_client(conn, greeted))
+            for conn, greeted in adopted]
+
+
+async def hand_off(channel: handoff.Channel, sock: socket.socket):
+    """
+    Hands the listening socket and every client to a process taking over
+    from this one, then exits. Each client's task is cancelled where it
+    waits for the client, its transport stops reading and what it had
+    buffered is taken back out, so nothing it sent is lost. It is handed
+    over once everything queued for it has been written. Files being sent
+    are dropped, the clients can ask for the rest, and clients whose
+    frames are not written within drain_timeout are disconnected.
+
+    Parameters:
+        channel (Channel): Channel to the new process
+        sock (socket): The listening socket
+    """
+    started = time.monotonic()
+    print('[HANDOFF] Handing over to a new server')
+    channel.send({'type': 'listener'}, fds=[sock.fileno()])
+    # Stop accepting, without closing the socket or the server, which
+    # would end serve_forever and close every client
+    loop = asyncio.get_running_loop()
+    loop.remove_reader(sock.fileno())
+    server.heartbeats.stop()
+    for _ in range(ACCEPT_TURNS):
+        # Let clients already accepted reach handle_client
+        await asyncio.sleep(0)
+    deadline = started + server.handoff_settings['drain_timeout']
+    conns = server.tracked_connections()
+    for c in conns:
+        c.handed_off = True
+        c.writer.transport.pause_reading()
+        c.read_task.cancel()
+    await asyncio.gather(*(c.read_task for c in conns),
+                         return_exceptions=True)
+    # Some may have left before their tasks were cancelled
+    still_open = set(server.tracked_connections())
+    conns = [c for c in conns if c in still_open]
+    sessions = []
+    for c in conns:
+        try:
+            pending = c.decoder.take_pending() + await take_buffered(c)
+        except ConnectionError:
+            continue
+        sessions.append((c, pending))
+    drained = await asyncio.gather(*(drain(c, deadline)
+                                     for c, _ in sessions))
+    for (c, _), done in zip(sessions, drained):
+        if not done:
+            print(f'[HANDOFF] Disconnecting {client_list.getName(c)},'
+                  ' its messages could not be sent in time')
+            c.abort()
+    server.send_sessions(channel, [session for session, done
+                                   in zip(sessions, drained) if done])
+    server.finish_hand_off(channel, started, sum(drained))
+
+
+async def take_buffered(conn: StreamConnection):
+    """
+    Takes what the stream has read from a client but not yet passed on.
+    The client's transport must be paused and its task finished.
+
+    Returns:
+        (bytes): The data
+
+    Errors:
+        ConnectionError: If the connection had failed
+    """
+    conn.reader.feed_eof()
+    # With the end fed the whole buffer is returned without waiting, so
+    # the transport cannot read anything more in the meantime. Taking it
+    # may resume the transport, which is paused again straight away.
+    data = await conn.reader.read()
+    conn.writer.transport.pause_reading()
+    return data
+
+
+async def drain(conn: StreamConnection, deadline: float):
+    """
+    Waits until everything queued for a client has been written to its
+    socket, files aside, which are dropped.
+
+    Parameters:
+        conn (StreamConnection): The client
+        deadline (float): time.monotonic() to give up at
+
+    Returns:
+        (boolean): True if everything was written
+    """
+    conn.outbound.drop_files()
+    transport = conn.writer.transport
+    if conn.outbound.idle and not transport.get_write_buffer_size():
+        # Most clients have nothing left to write
+        return True
+    if not await conn.outbound.wait_idle(max(0, deadline - time.monotonic())):
+        return False
+    # Writes left in the transport's buffer are waited for as well
+    transport.set_write_buffer_limits(0)
+    try:
+        await asyncio.wait_for(conn.writer.drain(),
+                               max(0, deadline - time.monotonic()))
+    except (asyncio.TimeoutError, ConnectionError):
+        return False
+    return True
+
+
+def poll_heartbeats(loop: asyncio.AbstractEventLoop):
+    """
+    Checks the heartbeat timers every tick, on the event loop so pings and
+    evictions never race the client handlers.
+    """
+    server.heartbeats.poll()
+    loop.call_later(server.heartbeats.tick, poll_heartbeats, loop)
+
+
+def raise_fd_limit():
+    """
+    Raises the soft limit on open files to the hard limit so the process
+    can hold tens of thousands of idle connections.
+
+    Returns:
+        (int): The new soft limit, or None if it cannot be read
+    """
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return soft
+
+
+async def run(sock: socket.socket, addr: tuple, sessions=()):
+    """
+    Serves clients on the given socket until cancelled, or until another
+    process takes over.
+
+    Parameters:
+        sock (socket): The bound socket to listen on
+        addr (tuple): Address the socket is bound to
+        sessions (list): Clients handed over by the server this process
+            took over from, see server.take_over
+    """
+    # Deliver messages from other nodes on the event loop's thread
+    loop = asyncio.get_running_loop()
+    server.backend.dispatch = loop.call_soon_threadsafe
+    # Keep references so the tasks are not garbage collected
+    tasks = await adopt_sessions(sessions)
+    poll_heartbeats(loop)
+    sock.listen(socket.SOMAXCONN)
+    chat_server = await asyncio.start_server(handle_client, sock=sock,
+                                             backlog=socket.SOMAXCONN)
+
+    def request_hand_off(channel: handoff.Channel):
+        tasks.append(asyncio.create_task(hand_off(channel, sock)))
+
+    if server.handoff_settings['path']:
+        handoff.listen(server.handoff_settings['path'],
+                       lambda channel: loop.call_soon_threadsafe(
+                           request_hand_off, channel))
+    print(f'[STARTING] Server has started and is listening on {addr}')
+    try:
+        async with chat_server:
+            await chat_server.serve_forever()
+    finally:
+        # Close all connections before closing socket
+        for c in client_list.connections():
+            c.close()
+
+
+def serve(sock: socket.socket, addr: tuple, sessions=()):
+    """
+    Runs the asyncio engine. Every client is served from a single event
+    loop, so idle connections only cost a small buffer each.
+
+    Parameters:
+        sock (socket): The bound socket to listen on
+        addr (tuple): Address the socket is bound to
+        sessions (list): Clients handed over by the server this process
+            took over from, see server.take_over
+    """
+    limit = raise_fd_limit()
+    print(f'[STARTING] Open file limit is {limit}')
+    try:
+        asyncio.run(run(sock, addr, sessions))
+    except KeyboardInterrupt:
+        print('[EXITING] Keyboard interrupt detected')
@@ -0,0 +1,197 @@
+"""
+Scaling benchmark for ClientList.
+
+Compares the indexed ClientList against the original list-of-dicts
+implementation for growing numbers of clients. For each size it times the
+lookups done per message by server.sendMsg, a full room broadcast, room
+moves and removals, and finally hammers the indexed list from several
+threads to check it stays consistent.
+
+Usage:
+    python benchmarks/bench_client_list.py [--sizes 100 1000 10000]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ChatRoomHelpers import ClientList  # noqa: E402
+
+ROOMS = 10
+
+
+class LinearClientList:
+    """
+    The original ClientList, which scans a list of dicts on every call.
+    Kept here as the baseline.
+    """
+
+    def __init__(self):
+        self.client_list = []
+
+    def addToList(self, conn, name, chat_room):
+        self.client_list.append({'Connection': conn, 'Name': name,
+                                 'Room': chat_room})
+
+    def removeFromList(self, conn):
+        for entry in self.client_list:
+            if entry['Connection'] == conn:
+                self.client_list.remove(entry)
+                return True
+        return False
+
+    def connectionsInRoom(self, chat_room):
+        return [e['Connection'] for e in self.client_list
+                if e['Room'] == chat_room]
+
+    def getConnRoom(self, conn):
+        for entry in self.client_list:
+            if entry['Connection'] == conn:
+                return entry['Room']
+        return None
+
+    def getName(self, conn):
+        for entry in self.client_list:
+            if entry['Connection'] == conn:
+                return entry['Name']
+        return None
+
+    def updateChatRoom(self, conn, chat_room):
+        for entry in self.client_list:
+            if entry['Connection'] == conn:
+                entry['Room'] = chat_room
+                return True
+        return False
+
+
+def populate(registry, size: int):
+    """
+    Fills the registry with size clients spread over ROOMS rooms.
+
+    Returns:
+        (list): The connections that were added
+    """
+    conns = [object() for _ in range(size)]
+    for i, conn in enumerate(conns):
+        registry.addToList(conn, f'User{i}', f'Room{i % ROOMS}')
+    return conns
+
+
+def timed(func, repeat: int):
+    """
+    Runs func repeat times and returns the mean time per call in seconds.
+    """
+    start = time.perf_counter()
+    for i in range(repeat):
+        func(i)
+    return (time.perf_counter() - start) / repeat
+
+
+def bench(cls, size: int, repeat: int):
+    """
+    Times the common operations on a registry of the given size.
+
+    Returns:
+        (dict): Mean seconds per operation keyed by operation name
+    """
+    registry = cls()
+    conns = populate(registry, size)
+    sample = conns[::max(1, size // repeat)][:repeat]
+    repeat = len(sample)
+
+    def lookup(i):
+        conn = sample[i]
+        registry.getName(conn)
+        registry.getConnRoom(conn)
+
+    def broadcast(i):
+        # What sendMsg does for one message
+        conn = sample[i]
+        room = registry.getConnRoom(conn)
+        name = registry.getName(conn)
+        return [(c, name) for c in registry.connectionsInRoom(room)
+                if c is not conn]
+
+    def broadcast_old(i):
+        # The original sendMsg looked the name up once per recipient
+        conn = sample[i]
+        room = registry.getConnRoom(conn)
+        return [(c, registry.getName(conn))
+                for c in registry.connectionsInRoom(room) if c is not conn]
+
+    def move(i):
+        registry.updateChatRoom(sample[i], f'Room{(i + 1) % ROOMS}')
+
+    def remove(i):
+        registry.removeFromList(sample[i])
+
+    results = {'lookup': timed(lookup, repeat), 'move': timed(move, repeat)}
+    results['broadcast'] = timed(
+        broadcast_old if cls is LinearClientList else broadcast, repeat)
+    results['remove'] = timed(remove, repeat)
+    return results
+
+
+def stress(threads: int, ops: int):
+    """
+    Adds, moves and removes clients from several threads at once and checks
+    the room index still agrees with the client index.
+
+    Returns:
+        (float): Seconds taken
+    """
+    registry = ClientList()
+
+    def worker(t):
+        for i in range(ops):
+            conn = (t, i)
+            registry.addToList(conn, f'User{t}.{i}', f'Room{i % ROOMS}')
+            registry.updateChatRoom(conn, f'Room{(i + t) % ROOMS}')
+            registry.connectionsInRoom(f'Room{i % ROOMS}')
+            if i % 2:
+                registry.removeFromList(conn)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(t,))
+               for t in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+
+    in_rooms = sum(len(registry.connectionsInRoom(f'Room{r}'))
+                   for r in range(ROOMS))
+    expected = threads * (ops - ops // 2)
+    assert len(registry.connections()) == expected == in_rooms, \
+        'room index out of sync with client index'
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    ops = ('lookup', 'broadcast', 'move', 'remove')
+    print(f'{"clients":>8} {"impl":>8} ' +
+          ' '.join(f'{op + " us":>13}' for op in ops))
+    for size in args.sizes:
+        for cls, label in ((LinearClientList, 'linear'),
+                           (ClientList, 'indexed')):
+            results = bench(cls, size, args.repeat)
+            print(f'{size:>8} {label:>8} ' +
+                  ' '.join(f'{results[op] * 1e6:>13.2f}' for op in ops))
+
+    elapsed = stress(args.threads, 5000)
+    print(f'\n{args.threads} threads x 5000 ops: {elapsed:.2f}s, '
+          'indexes consistent')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Write coalescing benchmark for ConnectionWriter.
+
+Pushes bursts of small chat frames through a BlockingOutboundQueue and
+its writer thread into one end of a socket pair, while a reader drains the
+other end. Reports the sends made per frame delivered and the time taken,
+with coalescing off (one frame per send) and with a few batch sizes and
+flush delays.
+
+Usage:
+    python benchmarks/bench_coalescing.py [--frames 100000] [--burst 50]
+"""
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ChatRoomHelpers import MessageProtocol as mp  # noqa: E402
+from outbound import BlockingOutboundQueue, ConnectionWriter  # noqa: E402
+
+# batch_bytes, flush_delay
+CONFIGS = ((0, 0), (2**12, 0), (2**16, 0), (2**16, 0.001))
+
+
+class PairEnd:
+    """
+    Stands in for a Connection, holding one end of the socket pair.
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+
+
+def drain(sock: socket.socket, total: int):
+    """
+    Reads from the socket until total bytes have arrived.
+    """
+    buf = bytearray(2**16)
+    received = 0
+    while received < total:
+        n = sock.recv_into(buf)
+        if n == 0:
+            break
+        received += n
+
+
+def run(batch_bytes: int, flush_delay: float, frames: int, burst: int):
+    """
+    Sends frames through a writer using the given settings.
+
+    Returns:
+        (int, float): Sends made, seconds taken
+    """
+    writer_end, reader_end = socket.socketpair()
+    frame = mp.create_frame('User1:\n hello everyone', 'SERVER', 2, 1)
+    queue = BlockingOutboundQueue(high_watermark=2**30,
+                                  low_watermark=2**29,
+                                  batch_bytes=batch_bytes,
+                                  flush_delay=flush_delay)
+    writer = ConnectionWriter(PairEnd(writer_end), queue)
+    reader = threading.Thread(target=drain,
+                              args=(reader_end, frames * len(frame)))
+    start = time.perf_counter()
+    writer.start()
+    reader.start()
+    for i in range(0, frames, burst):
+        for _ in range(min(burst, frames - i)):
+            queue.put(frame)
+        # Gap between bursts, as when people pause between messages
+        time.sleep(0)
+    reader.join()
+    elapsed = time.perf_counter() - start
+    queue.close()
+    writer.join()
+    writer_end.close()
+    reader_end.close()
+    return queue.send_calls, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--frames', type=int, default=100000)
+    parser.add_argument('--burst', type=int, default=50)
+    args = parser.parse_args()
+
+    print(f'{"batch bytes":>11} {"delay ms":>9} {"sends":>8}'
+          f' {"sends/frame":>12} {"seconds":>8}')
+    for batch_bytes, flush_delay in CONFIGS:
+        sends, elapsed = run(batch_bytes, flush_delay, args.frames,
+                             args.burst)
+        print(f'{batch_bytes:>11} {flush_delay * 1000:>9.1f} {sends:>8}'
+              f' {sends / args.frames:>12.3f} {elapsed:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
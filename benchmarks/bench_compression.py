@@ -0,0 +1,83 @@
+"""
+Compression benchmark.
+
+Compresses the kinds of message the server sends, short chat, long
+pastes and /rooms tables, with and without the preset dictionary, and
+reports the ratio of bytes before and after and the CPU time taken per
+message to compress and decompress. Messages below the threshold are sent
+as they are, which the table shows as a ratio of 1.
+
+Usage:
+    python benchmarks/bench_compression.py [--repeat 2000] [--threshold 512]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+from tabulate import tabulate
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ChatRoomHelpers import Compression  # noqa: E402
+
+WORDS = ('the and you to is it that for what have this with are was not but'
+         ' just can will know from about there they when think like lunch'
+         ' meeting deploy later tomorrow build broken fixed thanks').split()
+
+
+def chat(words: int):
+    return 'user42:\n ' + ' '.join(random.choice(WORDS)
+                                  for _ in range(words))
+
+
+def rooms_table(clients: int):
+    rows = [f'User{i:<4}  Room{i % 20}' for i in range(clients)]
+    return 'Name     Room\n-------  ------\n' + '\n'.join(rows)
+
+
+def measure(codec: Compression, body: bytes, repeat: int):
+    """
+    Returns:
+        (float, float, float): Ratio, microseconds to compress and to
+            decompress
+    """
+    start = time.thread_time()
+    for _ in range(repeat):
+        data = codec.compress(body)
+    compress = (time.thread_time() - start) / repeat
+    if data is None:
+        return 1.0, compress * 1e6, 0.0
+    start = time.thread_time()
+    for _ in range(repeat):
+        codec.decompress(data, 2**24)
+    decompress = (time.thread_time() - start) / repeat
+    return len(body) / len(data), compress * 1e6, decompress * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--repeat', type=int, default=2000)
+    parser.add_argument('--threshold', type=int, default=512)
+    args = parser.parse_args()
+    random.seed(1)
+    messages = [('short chat', chat(10)), ('long chat', chat(150)),
+                ('paste', chat(1500)), ('/rooms 50', rooms_table(50)),
+                ('/rooms 2000', rooms_table(2000))]
+    plain = Compression(args.threshold)
+    plain.dictionary = b''
+    preset = Compression(args.threshold)
+    rows = []
+    for name, text in messages:
+        body = text.encode()
+        row = [name, len(body)]
+        for codec in (plain, preset):
+            row.extend(measure(codec, body, args.repeat))
+        rows.append(row)
+    print(tabulate(rows, floatfmt='.2f', headers=[
+        'Message', 'Bytes', 'Ratio', 'Comp us', 'Decomp us',
+        'Dict ratio', 'Dict comp us', 'Dict decomp us']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Room directory benchmark.
+
+Fills a RoomDirectory and a ClientList with the same clients and times
+answering /rooms the way the server used to, with a table of every client,
+against a page of the directory, both straight after a change of
+membership and when the page is cached.
+
+Usage:
+    python benchmarks/bench_directory.py [--clients 5000] [--rooms 200]
+"""
+import argparse
+import os
+import sys
+import time
+
+from tabulate import tabulate
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ChatRoomHelpers import ClientList  # noqa: E402
+from directory import RoomDirectory  # noqa: E402
+
+
+def time_calls(func, repeat: int):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--clients', type=int, default=5000)
+    parser.add_argument('--rooms', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    client_list = ClientList()
+    directory = RoomDirectory()
+    for i in range(args.clients):
+        room = f'Room{i % args.rooms}'
+        client_list.addToList(object(), f'User{i}', room)
+        directory.join(i, f'User{i}', room)
+
+    def full_table():
+        entries = client_list.getList()
+        return tabulate([list(e.values())[1:] for e in entries],
+                        headers=entries[0].keys())
+
+    def after_change():
+        directory.move(0, 'Room1')
+        directory.move(0, 'Room0')
+        return directory.rooms_page()
+
+    results = [('every client', time_calls(full_table, args.repeat)),
+               ('page after a change', time_calls(after_change,
+                                                  args.repeat)),
+               ('cached page', time_calls(directory.rooms_page,
+                                          args.repeat * 100))]
+    print(f'/rooms with {args.clients} clients in {args.rooms} rooms:')
+    for name, seconds in results:
+        print(f'  {name:>20} {seconds * 1e6:>10.1f}us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Fan-out benchmark for server.sendMsg.
+
+Times one broadcast to rooms of growing size, comparing the old approach
+of building and encoding the frame for every recipient against encoding
+it once with SharedFrame. Recipients are fake connections that only keep
+the frame they are given, so the numbers are the cost of the server's own
+work rather than the network.
+
+Usage:
+    python benchmarks/bench_fanout.py [--sizes 10 100 500 1000 5000]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import server  # noqa: E402
+from server import client_list, NAME  # noqa: E402
+from ChatRoomHelpers import MessageProtocol as mp  # noqa: E402
+
+ROOM = 'Bench'
+MSG = 'The quick brown fox jumps over the lazy dog'
+
+
+class FakeConnection:
+    """
+    Stands in for a Connection, keeping the last frame sent to it.
+    """
+
+    def __init__(self, conn_id: int, version: int):
+        self.id = conn_id
+        self.version = version
+        self.compression = None
+        self.last = None
+
+    def sendall(self, data: bytes):
+        self.last = data
+
+    def send_msg(self, msg: str, name: str, sender_id: int = 0):
+        mp.send_msg_protocol(self, msg, name, self.version, sender_id)
+
+
+def send_msg_per_recipient(conn, msg: str):
+    """
+    sendMsg as it was before frames were shared: the text is built and the
+    frame encoded once for every recipient.
+    """
+    current_chat_room = client_list.getConnRoom(conn)
+    for c in client_list.connectionsInRoom(current_chat_room):
+        if c is not conn:
+            c.send_msg(f'{client_list.getName(conn)}:\n {msg}', NAME,
+                       conn.id)
+
+
+def fill_room(size: int, mix: str):
+    """
+    Replaces the clients in the room with size fake connections.
+
+    Parameters:
+        size (int): Number of clients
+        mix (str): 'v1', 'v2' or 'mixed' protocol versions
+
+    Returns:
+        (list): The connections
+    """
+    for c in client_list.connections():
+        client_list.removeFromList(c)
+    conns = []
+    for i in range(size):
+        version = {'v1': 1, 'v2': 2}.get(mix, 1 + i % 2)
+        conn = FakeConnection(i + 1, version)
+        client_list.addToList(conn, f'User{i}', ROOM)
+        conns.append(conn)
+    return conns
+
+
+def bench(send, conns: list, repeat: int):
+    """
+    Returns the mean seconds taken by send to broadcast one message.
+    """
+    start = time.perf_counter()
+    for i in range(repeat):
+        send(conns[i % len(conns)], MSG)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10, 100, 500, 1000, 5000])
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    print(f'{"room":>6} {"versions":>8} {"before us":>11} {"after us":>11}'
+          f' {"per member ns":>14} {"speedup":>8}')
+    for size in args.sizes:
+        for mix in ('v1', 'v2', 'mixed'):
+            conns = fill_room(size, mix)
+            before = bench(send_msg_per_recipient, conns, args.repeat)
+            after = bench(server.sendMsg, conns, args.repeat)
+            print(f'{size:>6} {mix:>8} {before * 1e6:>11.1f}'
+                  f' {after * 1e6:>11.1f} {after * 1e9 / size:>14.0f}'
+                  f' {before / after:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
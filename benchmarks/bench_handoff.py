@@ -0,0 +1,215 @@
+"""
+Zero-downtime restart benchmark.
+
+Starts a server with --handoff, connects idle clients to it spread over a
+few rooms, a quarter of them on version 1 of the protocol, and has one
+client send a numbered message to another every few milliseconds. A
+second server is then started with the same arguments and takes over from
+the first. Reports how long the messages were held up, whether any were
+lost, how many of the idle clients are still connected and in their
+rooms afterwards, and how long clients connecting during the handoff
+took to be greeted.
+
+Usage:
+    python benchmarks/bench_handoff.py [--engine asyncio] [--clients 500]
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+from async_client import ChatClient  # noqa: E402
+
+
+def start_server(args, path: str, log):
+    """
+    Starts a server process taking over from any server on path.
+    """
+    return subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'server.py'),
+         '--engine', args.engine, '--host', '127.0.0.1',
+         '--port', str(args.port), '--handoff', path,
+         '--chat-limit', '0', '--room-chat-limit', '0',
+         '--command-limit', '0', '--room-command-limit', '0',
+         '--max-file-bytes', '0'],
+        stdout=log, stderr=subprocess.STDOUT)
+
+
+async def connect(name: str, port: int, versions=(1, 2)):
+    """
+    Connects a client and reads past its welcome message.
+    """
+    client = ChatClient(name)
+    await client.connect('127.0.0.1', port, versions)
+    await client.recv()
+    return client
+
+
+async def wait_for(client: ChatClient, text: str, timeout: float):
+    """
+    Recieves until a message containing text arrives.
+
+    Returns:
+        (boolean): True if it did before the timeout
+    """
+    try:
+        async with asyncio.timeout(timeout):
+            while text not in (await client.recv()).text:
+                pass
+        return True
+    except (TimeoutError, ConnectionError):
+        return False
+
+
+async def chat(sender: ChatClient, receiver: ChatClient, interval: float,
+               stop: asyncio.Event):
+    """
+    Sends numbered messages until stop is set, noting when each arrives.
+
+    Returns:
+        (int, dict): Messages sent, and sequence number -> (sent, arrived)
+    """
+    sent_at = {}
+    arrivals = {}
+
+    async def receive():
+        while True:
+            message = await receiver.recv()
+            if message.body.startswith('seq '):
+                seq = int(message.body.split()[1])
+                arrivals[seq] = (sent_at[seq], time.monotonic())
+
+    reader = asyncio.create_task(receive())
+    seq = 0
+    while not stop.is_set():
+        sent_at[seq] = time.monotonic()
+        sender.send(f'seq {seq}')
+        seq += 1
+        await asyncio.sleep(interval)
+    # Give the last ones time to arrive
+    await asyncio.sleep(1)
+    reader.cancel()
+    return seq, arrivals
+
+
+async def newcomers(port: int, stop: asyncio.Event):
+    """
+    Connects a new client every 10ms until stop is set.
+
+    Returns:
+        (list): Seconds each took to be greeted, None for those that failed
+    """
+    times = []
+    n = 0
+    while not stop.is_set():
+        start = time.monotonic()
+        try:
+            client = await asyncio.wait_for(connect(f'new{n}', port), 10)
+            times.append(time.monotonic() - start)
+            await client.close()
+        except (OSError, asyncio.TimeoutError):
+            times.append(None)
+        n += 1
+        await asyncio.sleep(0.01)
+    return times
+
+
+async def run(args, path: str, logs: list):
+    clients = []
+    for i in range(args.clients):
+        client = await connect(f'idle{i}', args.port,
+                               (1,) if i % 4 == 0 else (1, 2))
+        client.move(f'room{i % args.rooms}')
+        clients.append(client)
+    sender = await connect('sender', args.port)
+    receiver = await connect('receiver', args.port)
+    for client in (sender, receiver):
+        client.move('bench')
+    await wait_for(receiver, 'sender has entered', 5)
+
+    stop = asyncio.Event()
+    chatting = asyncio.create_task(chat(sender, receiver,
+                                        args.interval / 1000, stop))
+    connecting = asyncio.create_task(newcomers(args.port, stop))
+    await asyncio.sleep(1)
+    old = logs[0][1]
+    handoff_start = time.monotonic()
+    logs.append((None, start_server(args, path, logs[0][0])))
+    await asyncio.to_thread(old.wait)
+    handoff_end = time.monotonic()
+    await asyncio.sleep(1)
+    stop.set()
+    sent, arrivals = await chatting
+    greet_times = await connecting
+
+    # Every idle client should still be in its room
+    alive = 0
+    for i, client in enumerate(clients):
+        try:
+            client.send('/who')
+            if await wait_for(client, f'room{i % args.rooms}', 5):
+                alive += 1
+        except ConnectionError:
+            pass
+
+    lost = [seq for seq in range(sent) if seq not in arrivals]
+    delays = sorted(arrived - sent_at
+                    for sent_at, arrived in arrivals.values())
+    times = sorted(arrived for _, arrived in arrivals.values())
+    # The new server starting up slows the old one down too, so the gap
+    # across the handoff is the one around the old server exiting
+    gap = max((b - a for a, b in zip(times, times[1:])
+               if a <= handoff_end <= b), default=0)
+    longest = max((b - a for a, b in zip(times, times[1:])), default=0)
+    greeted = sorted(t for t in greet_times if t is not None)
+    print(f'Old server exited {(handoff_end - handoff_start) * 1000:.0f}ms'
+          ' after the new one started')
+    print(f'Messages: {sent} sent, {len(arrivals)} arrived, {len(lost)}'
+          ' lost')
+    print(f'Delay: p50 {delays[len(delays) // 2] * 1000:.2f}ms,'
+          f' max {delays[-1] * 1000:.1f}ms')
+    print(f'Gap in messages arriving across the handoff:'
+          f' {gap * 1000:.1f}ms, longest gap {longest * 1000:.1f}ms'
+          f' (sent every {args.interval:g}ms)')
+    print(f'Idle clients still connected and in their rooms: {alive}'
+          f' of {args.clients}')
+    print(f'New clients: {len(greeted)} of {len(greet_times)} greeted,'
+          f' slowest {greeted[-1] * 1000 if greeted else 0:.1f}ms')
+    for client in clients + [sender, receiver]:
+        await client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--engine', choices=('threaded', 'asyncio'),
+                        default='threaded')
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--interval', type=float, default=2,
+                        help='Milliseconds between chat messages')
+    parser.add_argument('--port', type=int, default=5099)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'handoff.sock')
+        log = open(os.path.join(tmp, 'server.log'), 'w+')
+        logs = [(log, start_server(args, path, log))]
+        time.sleep(1)
+        try:
+            asyncio.run(run(args, path, logs))
+        finally:
+            for _, process in logs:
+                process.kill()
+                process.wait()
+            log.seek(0)
+            for line in log:
+                if line.startswith('[HANDOFF]'):
+                    print('Server: ' + line.rstrip())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+Heartbeat benchmark.
+
+Watches idle connections with a HeartbeatMonitor for a few minutes of
+simulated time, some of them sending a frame every second and the rest
+going quiet, and reports the cost of noting a frame and of each check of
+the timers. A checker that looks at every connection on every tick is
+timed the same way for comparison.
+
+Usage:
+    python benchmarks/bench_heartbeat.py [--connections 1000 10000 100000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from heartbeat import HeartbeatMonitor  # noqa: E402
+
+SECONDS = 180   # Simulated seconds, long enough for quiet ones to go
+ACTIVE = 0.1    # Share of connections that send a frame each second
+
+
+class Conn:
+    last_heard = None
+
+
+class ScanMonitor:
+    """
+    Baseline that checks every connection on every tick.
+    """
+
+    def __init__(self, ping, evict, interval: float, timeout: float):
+        self.ping = ping
+        self.evict = evict
+        self.interval = interval
+        self.timeout = timeout
+        self.pinged = {}    # Connection -> when it was last pinged
+        self.conns = set()
+
+    def add(self, conn, now: float):
+        conn.last_heard = now
+        self.conns.add(conn)
+
+    def poll(self, now: float):
+        for conn in list(self.conns):
+            quiet = now - conn.last_heard
+            if quiet >= self.timeout:
+                self.conns.discard(conn)
+                self.evict(conn)
+            elif (quiet >= self.interval
+                  and now - self.pinged.get(conn, conn.last_heard)
+                  >= self.interval):
+                self.pinged[conn] = now
+                self.ping(conn)
+
+
+def simulate(monitor, conns: list, seed: int = 1):
+    """
+    Returns:
+        (float, float, int): Mean and worst seconds per check, evictions
+    """
+    rng = random.Random(seed)
+    evicted = []
+    monitor.evict = evicted.append
+    # Half stay active and the rest stop sending once connected. They all
+    # connect during the first minute.
+    active = conns[::2]
+    joining = list(conns)
+    per_second = -(-len(conns) // 60)
+    checks = []
+    for second in range(1, SECONDS + 1):
+        for conn in joining[:per_second]:
+            monitor.add(conn, now=second)
+        del joining[:per_second]
+        for conn in rng.sample(active, int(len(active) * ACTIVE)):
+            if conn.last_heard is not None:
+                conn.last_heard = second
+        start = time.perf_counter()
+        monitor.poll(now=second)
+        checks.append(time.perf_counter() - start)
+    return sum(checks) / len(checks), max(checks), len(evicted)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--connections', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--interval', type=float, default=30)
+    parser.add_argument('--timeout', type=float, default=90)
+    args = parser.parse_args()
+
+    conn = Conn()
+    repeat = 10**6
+    start = time.perf_counter()
+    for _ in range(repeat):
+        conn.last_heard = time.monotonic()
+    print(f'Noting a frame: {(time.perf_counter() - start) / repeat * 1e9:.0f}'
+          'ns whatever the number of connections\n')
+
+    print(f'{"connections":>11} {"checker":>8} {"mean ms":>8}'
+          f' {"worst ms":>9} {"evicted":>8}')
+    for count in args.connections:
+        for name, monitor in (
+                ('wheel', HeartbeatMonitor(None, None, args.interval,
+                                           args.timeout, now=0)),
+                ('scan', ScanMonitor(None, None, args.interval,
+                                     args.timeout))):
+            monitor.ping = lambda conn: None
+            mean, worst, evicted = simulate(
+                monitor, [Conn() for _ in range(count)])
+            print(f'{count:>11} {name:>8} {mean * 1000:>8.3f}'
+                  f' {worst * 1000:>9.3f} {evicted:>8}')
+
+
+if __name__ == '__main__':
+    main()
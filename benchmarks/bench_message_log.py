@@ -0,0 +1,127 @@
+"""
+Message log benchmark.
+
+Appends chat messages from several threads, as client threads would, and
+reports how long append keeps the caller waiting, the messages written per
+second and how many messages each fsync covered. A log that writes and
+syncs each message as it is sent is timed the same way for comparison.
+Then one room is replayed from the middle of the log, through the sparse
+index and by reading every segment from the start.
+
+Usage:
+    python benchmarks/bench_message_log.py [--messages 20000] [--threads 8]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from message_log import MessageLog, encode_record  # noqa: E402
+
+ROOMS = 50
+
+
+class SyncEachLog:
+    """
+    Baseline that writes and fsyncs every message before returning.
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, 'ab')
+        self._lock = threading.Lock()
+
+    def append(self, chat_room: str, sender_id: int, body: bytes):
+        with self._lock:
+            self._file.write(encode_record(time.time(), chat_room, sender_id,
+                                           body))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self._file.close()
+
+
+def percentile(values: list, pct: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def send(log, thread: int, count: int, waits: list):
+    body = b'user:\n ' + b'x' * 80
+    for i in range(count):
+        start = time.perf_counter()
+        log.append(f'room{(thread * count + i) % ROOMS}', thread, body)
+        waits.append(time.perf_counter() - start)
+
+
+def run_appends(log, messages: int, threads: int):
+    """
+    Returns:
+        (list, float): Time each append took, seconds to commit them all
+    """
+    waits = []
+    workers = [threading.Thread(target=send,
+                                args=(log, t, messages // threads, waits))
+               for t in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    log.flush()
+    return waits, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp(prefix='chatroom-log-')
+    try:
+        print(f'{"log":>14} {"msgs/s":>9} {"p50 us":>8} {"p99 us":>8}'
+              f' {"msgs/fsync":>11}')
+        baseline = SyncEachLog(os.path.join(directory, 'baseline'))
+        waits, elapsed = run_appends(baseline, args.messages, args.threads)
+        baseline.close()
+        print(f'{"fsync each":>14} {len(waits) / elapsed:>9.0f}'
+              f' {percentile(waits, 50) * 1e6:>8.1f}'
+              f' {percentile(waits, 99) * 1e6:>8.1f} {1:>11.1f}')
+
+        log = MessageLog(os.path.join(directory, 'log'),
+                         segment_bytes=2**20)
+        waits, elapsed = run_appends(log, args.messages, args.threads)
+        print(f'{"group commit":>14} {len(waits) / elapsed:>9.0f}'
+              f' {percentile(waits, 50) * 1e6:>8.1f}'
+              f' {percentile(waits, 99) * 1e6:>8.1f}'
+              f' {log.stats["records"] / log.stats["commits"]:>11.1f}')
+
+        # Replay one room from halfway through the log
+        times = [t for t, _, _, _ in log.replay()]
+        since = times[len(times) // 2]
+        start = time.perf_counter()
+        indexed = sum(1 for _ in log.replay('room7', since))
+        indexed_time = time.perf_counter() - start
+        start = time.perf_counter()
+        scanned = sum(1 for t, room, _, _ in log.replay()
+                      if room == 'room7' and t >= since)
+        scan_time = time.perf_counter() - start
+        log.close()
+        print(f'\nReplaying {indexed} messages of one room from'
+              f' {len(log.segments)} segments:')
+        print(f'  through the index {indexed_time * 1000:.1f}ms,'
+              f' reading everything {scan_time * 1000:.1f}ms'
+              f' ({scanned} found)')
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
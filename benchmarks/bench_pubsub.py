@@ -0,0 +1,117 @@
+"""
+Cross-node fan-out benchmark for the room backends.
+
+Starts a Broker on a local TCP port and connects several BrokerBackend
+nodes to it, as separate servers would. Every node publishes chat
+messages to a few rooms at once. The time from publishing a message to
+each node delivering it is reported as percentiles, and every node is
+checked to have delivered each room's messages in the same order. The
+LocalBackend is timed the same way as a baseline.
+
+Usage:
+    python benchmarks/bench_pubsub.py [--nodes 4] [--messages 2000]
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from pubsub import Broker, BrokerBackend, LocalBackend  # noqa: E402
+
+ROOMS = ('General', 'Lobby', 'Random')
+
+
+class Recorder:
+    """
+    Stands in for server.deliver, noting when each message arrives.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.order = {room: [] for room in ROOMS}
+
+    def deliver(self, room: str, text: str, sender_id: int):
+        now = time.perf_counter()
+        sent_at, label = text.split(' ', 1)
+        with self.lock:
+            self.latencies.append(now - float(sent_at))
+            self.order[room].append(label)
+
+
+def percentile(values: list, pct: float):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def publish(backend, node: int, messages: int):
+    """
+    Publishes messages round robin over the rooms.
+    """
+    for i in range(messages):
+        room = ROOMS[i % len(ROOMS)]
+        backend.publish_chat(room, f'{time.perf_counter()} {node}.{i}',
+                             node)
+
+
+def wait_for(recorders: list, total: int, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if all(len(r.latencies) >= total for r in recorders):
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def report(label: str, recorders: list):
+    latencies = [lat for r in recorders for lat in r.latencies]
+    print(f'{label:>14} {len(latencies):>9}'
+          f' {statistics.mean(latencies) * 1e6:>9.0f}'
+          f' {percentile(latencies, 50) * 1e6:>9.0f}'
+          f' {percentile(latencies, 99) * 1e6:>9.0f}'
+          f' {percentile(latencies, 99.9) * 1e6:>9.0f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--nodes', type=int, default=4)
+    parser.add_argument('--messages', type=int, default=2000,
+                        help='Messages published by each node')
+    args = parser.parse_args()
+    total = args.nodes * args.messages
+
+    print(f'{"backend":>14} {"delivered":>9} {"mean us":>9} {"p50 us":>9}'
+          f' {"p99 us":>9} {"p99.9 us":>9}')
+
+    recorder = Recorder()
+    local = LocalBackend(recorder.deliver)
+    publish(local, 0, total)
+    report('local', [recorder])
+
+    broker = Broker(('127.0.0.1', 0))
+    broker.start()
+    recorders = [Recorder() for _ in range(args.nodes)]
+    nodes = [BrokerBackend(broker.addr, r.deliver) for r in recorders]
+    publishers = [threading.Thread(target=publish,
+                                   args=(node, node.node, args.messages))
+                  for node in nodes]
+    for p in publishers:
+        p.start()
+    for p in publishers:
+        p.join()
+    if not wait_for(recorders, total):
+        print('Timed out waiting for messages')
+    report(f'broker x{args.nodes}', recorders)
+
+    same_order = all(r.order == recorders[0].order for r in recorders)
+    print(f'\nPer room order identical on every node: {same_order}')
+    for node in nodes:
+        node.close()
+    broker.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+File delivery benchmark.
+
+Sends a file from disk over a loopback TCP connection to a reader in
+another process, first by reading it into Python and sending each chunk,
+then as a FileTransfer through a BlockingOutboundQueue and its writer
+thread, which uses sendfile. Reports the throughput and the CPU time used
+by the sending process. The transfer is then repeated with chat frames
+queued every few milliseconds, and the delay of each chat frame behind
+the file is reported for a few slice sizes.
+
+Usage:
+    python benchmarks/bench_sendfile.py [--mb 256] [--chat-interval 5]
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ChatRoomHelpers import FrameDecoder  # noqa: E402
+from ChatRoomHelpers import MessageProtocol as mp  # noqa: E402
+from outbound import (BlockingOutboundQueue, ConnectionWriter,  # noqa: E402
+                      FileTransfer)
+
+COPY_CHUNK = 2**17
+SLICES = (2**16, 2**17, 2**20, None)    # None sends the file as one slice
+
+
+class SocketEnd:
+    """
+    Stands in for a Connection, holding the sending socket.
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+
+
+def read_frames(port: int, results):
+    """
+    Reads frames until the connection closes, noting how late each chat
+    frame arrived from the time it holds.
+    """
+    sock = socket.create_connection(('127.0.0.1', port))
+    decoder = FrameDecoder(version=2, buffer_size=2**20)
+    decoder.max_frame_size = 2**31
+    delays = []
+    while decoder.recv_into(sock):
+        for msg_header, msg in decoder.frames():
+            if msg_header['type'] == mp.MSG:
+                delays.append(time.monotonic() - float(str(msg, 'utf-8')))
+    results.put(delays)
+
+
+def connect(results):
+    """
+    Starts a reader process and returns the socket to send to it.
+    """
+    listener = socket.create_server(('127.0.0.1', 0))
+    reader = multiprocessing.Process(
+        target=read_frames, args=(listener.getsockname()[1], results))
+    reader.start()
+    sock, _ = listener.accept()
+    listener.close()
+    return sock, reader
+
+
+def send_copy(path: str, size: int, results):
+    """
+    Sends the file by reading each chunk into Python.
+
+    Returns:
+        (float, float): Seconds and CPU seconds taken
+    """
+    sock, reader = connect(results)
+    start, cpu = time.perf_counter(), time.process_time()
+    with open(path, 'rb') as f:
+        offset = 0
+        while offset < size:
+            chunk = f.read(COPY_CHUNK)
+            sock.sendall(mp.create_file_data(1, len(chunk)) + chunk)
+            offset += len(chunk)
+    sock.close()
+    results.get()
+    reader.join()
+    return time.perf_counter() - start, time.process_time() - cpu
+
+
+def send_queued(path: str, size: int, results, slice_bytes: int,
+                chat_interval: float = None):
+    """
+    Sends the file through an outbound queue, with chat frames queued
+    every chat_interval seconds until it has been sent.
+
+    Returns:
+        (float, float, list): Seconds and CPU seconds taken, and the delay
+            of each chat frame
+    """
+    sock, reader = connect(results)
+    queue = BlockingOutboundQueue(high_watermark=2**30, low_watermark=2**29)
+    writer = ConnectionWriter(SocketEnd(sock), queue)
+    start, cpu = time.perf_counter(), time.process_time()
+    writer.start()
+    queue.put_file(FileTransfer(path, 0, size,
+                                lambda count: mp.create_file_data(1, count),
+                                slice_bytes or size))
+    while chat_interval and queue.file_bytes_sent < size:
+        time.sleep(chat_interval)
+        queue.put(mp.create_frame(str(time.monotonic()), '', 2))
+    while queue.stats()['queued_files'] or len(queue):
+        time.sleep(0.001)
+    queue.close()
+    writer.join()
+    sock.close()
+    delays = results.get()
+    reader.join()
+    return (time.perf_counter() - start, time.process_time() - cpu,
+            delays)
+
+
+def percentile(values: list, p: float):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--mb', type=int, default=256)
+    parser.add_argument('--chat-interval', type=float, default=5,
+                        help='Milliseconds between chat frames')
+    args = parser.parse_args()
+    size = args.mb * 2**20
+    results = multiprocessing.Queue()
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(os.urandom(2**20) * args.mb)
+        f.flush()
+
+        print(f'{"method":>18} {"MB/s":>8} {"CPU ms":>8}')
+        elapsed, cpu = send_copy(f.name, size, results)
+        print(f'{"read and send":>18} {args.mb / elapsed:>8.0f}'
+              f' {cpu * 1000:>8.0f}')
+        elapsed, cpu, _ = send_queued(f.name, size, results, 2**17)
+        print(f'{"sendfile":>18} {args.mb / elapsed:>8.0f}'
+              f' {cpu * 1000:>8.0f}')
+
+        print(f'\nChat frames every {args.chat_interval:g}ms during the'
+              ' transfer')
+        print(f'{"slice bytes":>12} {"MB/s":>8} {"frames":>7}'
+              f' {"p50 ms":>8} {"p99 ms":>8} {"max ms":>8}')
+        for slice_bytes in SLICES:
+            elapsed, _, delays = send_queued(f.name, size, results,
+                                             slice_bytes,
+                                             args.chat_interval / 1000)
+            label = slice_bytes or 'whole file'
+            print(f'{label:>12} {args.mb / elapsed:>8.0f} {len(delays):>7}'
+                  f' {percentile(delays, 0.5) * 1000:>8.2f}'
+                  f' {percentile(delays, 0.99) * 1000:>8.2f}'
+                  f' {max(delays, default=0) * 1000:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
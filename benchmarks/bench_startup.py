@@ -0,0 +1,107 @@
+"""
+Startup benchmark.
+
+Imports the server, the asyncio engine, the headless client and the GUI
+client, each in a fresh interpreter, and reports how long the import took
+and the memory (RSS) of the process afterwards, against an interpreter
+that imports nothing. It also lists the slow to load modules each one
+brought in. With --check it exits with an error if a headless
+module loaded a module it should not need, such as tkinter in the server.
+
+Unix only. The memory is read from /proc on Linux, elsewhere the peak
+reported by the resource module is used.
+
+Usage:
+    python benchmarks/bench_startup.py [--runs 10] [--check]
+"""
+import argparse
+import compileall
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# Slow to import modules that only some parts of the project need
+HEAVY = ('tkinter', 'tabulate', 'asyncio', 'http.server')
+# Module to import, and the heavy modules it must not load
+TARGETS = (
+    ('server', ('tkinter', 'tabulate', 'asyncio', 'http.server')),
+    ('async_server', ('tkinter', 'tabulate', 'http.server')),
+    ('async_client', ('tkinter', 'tabulate', 'http.server')),
+    ('client', ('tabulate', 'http.server')),
+)
+
+# Run in the fresh interpreter with the module to import as its argument
+MEASURE = '''
+import json, resource, sys, time
+start = time.perf_counter()
+if sys.argv[1]:
+    __import__(sys.argv[1])
+elapsed = time.perf_counter() - start
+try:
+    with open('/proc/self/statm') as f:
+        rss = int(f.read().split()[1]) * resource.getpagesize() // 1024
+except OSError:
+    # Not Linux, the peak will do
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({
+    'seconds': elapsed,
+    'rss': rss,
+    'modules': [name for name in %r if name in sys.modules],
+}))
+''' % (HEAVY,)
+
+
+def measure(module: str, runs: int):
+    """
+    Imports a module in runs fresh interpreters.
+
+    Parameters:
+        module (str): Module to import, '' for none
+        runs (int): Interpreters to start
+
+    Returns:
+        (float, float, list): Median seconds taken, median RSS in KB
+            and the heavy modules loaded
+    """
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', MEASURE, module], cwd=ROOT, check=True,
+            capture_output=True, text=True).stdout
+        results.append(json.loads(output))
+    return (statistics.median(r['seconds'] for r in results),
+            statistics.median(r['rss'] for r in results),
+            results[0]['modules'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--check', action='store_true',
+                        help='Fail if a module loads one it should not')
+    args = parser.parse_args()
+    # Time loading bytecode, not compiling the source
+    compileall.compile_dir(ROOT, maxlevels=0, quiet=1)
+
+    _, base_rss, _ = measure('', args.runs)
+    print(f'Interpreter alone: {base_rss / 1024:.1f}MB RSS\n')
+    print(f'{"module":>14} {"import ms":>10} {"RSS MB":>8} {"+MB":>6}'
+          '  heavy modules loaded')
+    failed = []
+    for module, forbidden in TARGETS:
+        seconds, rss, loaded = measure(module, args.runs)
+        print(f'{module:>14} {seconds * 1000:>10.1f} {rss / 1024:>8.1f}'
+              f' {(rss - base_rss) / 1024:>6.1f}  {", ".join(loaded)}')
+        failed += [(module, name) for name in loaded if name in forbidden]
+    for module, name in failed:
+        print(f'{module} loads {name}')
+    if args.check and failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
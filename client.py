@@ -1,224 +1,387 @@
+import asyncio
 from queue import Queue
 import random
 import socket
 import threading
+import time
 import tkinter as tk
 from tkinter import PhotoImage, messagebox
-from ChatRoomHelpers import ClientSetUp, MessageProtocol as mp
-from win10toast_persist import ToastNotifier
-from ChatRoomHelpers import resource_path
+from async_client import ChatClient, SEPARATOR
+from ChatRoomHelpers import DISCONNECT, SEND_FILE
+from gui import ClientSetUp, resource_path
+from notifications import Notifier, default_backend
+from transcript import TranscriptStore, TranscriptView
 
-LABEL_WIDTH = 500           # Max width of labels
-DISCONNECT = '/disconnect'  # Disconnect message
-NAME = ''                   # Name of this client
+LOST_CONNECTION = 'Lost connection with server, please restart'
+TITLE = 'Chat Room'
+POLL_INTERVAL = 100     # Milliseconds between checks, if Tk cannot wait
+FRAME_BUDGET = 0.016    # Seconds spent adding messages before handling input
+LAG_WARNING = 0.5       # Seconds behind before the title says so
 
-# Setup connection to the server
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-msgRcvQueue = Queue()   # FIFO Queue
-window = tk.Tk()        # Main window
-notifier = ToastNotifier()
-
-# Set up scollable frame
-baseFrame = tk.Frame(window)
-canvas = tk.Canvas(baseFrame)
-frame = tk.Frame(canvas)  # Frame containing history of messages
-
-
-def onFrameConfig(canvas: tk.Canvas):
-    """
-    Executed when the frame gets larger (i.e. when a messge is sent). It will
-    first resize the scroll region. If the user was originally at the
-    bottom of the scroll, then they will stay ot the bottom. Otherwise, they
-    stay where they are.
-
-    Parameters:
-        canvas (Canvas): Canvas widget to configure
-    """
-    yView = canvas.yview()[1]
-    canvas.configure(scrollregion=canvas.bbox('all'))
-    if 1 == yView:
-        canvas.yview_moveto(1)
-
-
-def on_mouse_wheel(event, canvas: tk.Canvas):
-    canvas.yview_scroll(-1 * int((event.delta) / 120), 'units')
-
-
-def checkForMessages():
-    """
-    Checks the msgRcvQueue for messages. If there is a message in the
-    queue, get it and create a label with the message in it. Message is
-    removed once it is used.
-    """
-    if not msgRcvQueue.empty():
-        msg = msgRcvQueue.get()
-        label = tk.Label(text=msg,
-                         master=frame,
-                         justify='left',
-                         wraplength=LABEL_WIDTH,
-                         relief='raised')
-        label.pack(anchor='w')
-        create_notification(msg)
-    window.after(100, checkForMessages)
-
-def create_notification(msg: str):
-    """
-    Creates a notification that is placed in the Windows 10 Action Center.
-
-    Parmeters:
-        msg (str): Message to display
-    """
-    split_msg = msg.split(':')
-    notifier.show_toast(title=split_msg[0],
-                        msg=' '.join(split_msg[1:]),
-                        icon_path=resource_path('icon.ico'),
-                        duration=None)
-
-def setUpWindow():
+class ChatWindow:
     """
-    Populates the window that the user will use to send and
-    recieve messages. Consists of a frame full of labels that is used to
-    show the messages. A text box to type messages and a send button.
+    The window the user sends and recieves messages with. The connection
+    is a ChatClient running on an event loop in another thread. Messages it
+    recieves are added to a queue and a flag is set. tkinter can only be
+    called from its own thread, so the first message queued since the last
+    check also writes a byte to a socket that tkinter waits on, and its
+    thread then shows everything queued. An idle window does not wake at
+    all. Where tkinter cannot wait on a socket (Windows), its thread checks
+    the flag every POLL_INTERVAL instead.
+
+    Showing messages stops after FRAME_BUDGET so that typing and scrolling
+    still respond during a burst, and carries on once tkinter has handled
+    its other events. If messages are shown more than LAG_WARNING after
+    they arrived, the title shows how far behind the window is.
 
     Parameters:
-        window (tkinter): The window to display
-    """
-    myscrollbar = tk.Scrollbar(baseFrame, orient="vertical",
-                               command=canvas.yview)
-    canvas.configure(yscrollcommand=myscrollbar.set)
-    canvas.create_window((4, 4), window=frame, anchor="nw")
-    frame.bind('<Configure>',
-               lambda event, canvas=canvas: onFrameConfig(canvas))
-
-    canvas.bind_all('<MouseWheel>',
-                    lambda event, canvas=canvas:
-                        on_mouse_wheel(event, canvas))
-
-    input_box = tk.Text(master=window)
-    button = tk.Button(master=window, text="Send")
-    # Using a lambda here so that the inputBox can be passed in as
-    # and argument
-    button.bind("<Button-1>",
-                lambda event, inputBox=input_box:
-                    handle_send(inputBox))
-
-    input_box.bind('<Shift-Return>',
-                   lambda event, inputBox=input_box:
-                       handle_shift_send(inputBox))
-
-    baseFrame.pack(fill='both')
-    myscrollbar.pack(side='right', fill='y')
-    canvas.pack(side='left', fill='both', expand=True)
-    input_box.pack(side='left', anchor='w')
-    button.pack(side='left', anchor='sw')
-
-    # Give the input box focus
-    input_box.focus()
-
-    photo = PhotoImage(file=resource_path('icon.png'))
-    window.iconphoto(False, photo)
-
-    window.title("Chat Room")
-    window.protocol("WM_DELETE_WINDOW", on_close)
-    window.after(0, checkForMessages)
-
-
-def handle_shift_send(input_box: tk.Text):
-    """
-    Used when sending a message using shift return. Waits 100ms
-    before sending the message so that the return key is entered with
-    the message rather than after it is sent. If it is done after then
-    the cursor will be on line 2 when the user wants to type again.
-
-    Paramters:
-        input_box (tk.Text): Message box
+        window (Tk): The main window
+        client (ChatClient): Client connected to the server
+        loop (AbstractEventLoop): Event loop the client runs on
     """
-    input_box.after(100, handle_send, input_box)
-
-
-def handle_send(input_box: tk.Text):
-    """
-    Executed when the user presses send. It will get and clear the
-    text box then send the message. The message will be put straight
-    into the list of messages on the client side. This is done so that
-    the message doesn't need to be sent to the server and back again.
-
-    If the server cannot be contacted, a message is displayed to the
-    user to restart.
 
-    Parameter:
-        input_box (tk.Text): Text box containing the message
-    """
-    msg = input_box.get("1.0", tk.END).rstrip()
-    input_box.delete("1.0", tk.END)
-    try:
-        mp.send_msg_protocol(s, msg, NAME)
-        # Create a label with the clients message and add it to the frame
-        label = tk.Label(text='You:\n' + msg,
-                         master=frame,
-                         justify='left',
-                         wraplength=LABEL_WIDTH,
-                         relief='raised')
-        label.pack(anchor='w')
+    def __init__(self, window: tk.Tk, client: ChatClient,
+                 loop: asyncio.AbstractEventLoop):
+        self.window = window
+        self.client = client
+        self.loop = loop
+        self.msgRcvQueue = Queue()  # FIFO Queue of (time, message)
+        self._wake_lock = threading.Lock()
+        self._wake_pending = False  # Messages queued since the last check
+        self._waker = None          # (reading, writing) sockets, if used
+        self._poll_id = None        # Pending after() of the fallback poll
+        self.closed = False
+        self.render_stats = {'batches': 0, 'messages': 0, 'lag': 0.0,
+                             'max_lag': 0.0, 'behind': 0}
+        self.notifier = Notifier(default_backend(resource_path('icon.ico')))
+        self.baseFrame = tk.Frame(window)
+        # History of messages. Only the most recent are in the window, older
+        # ones are kept compressed and shown again when scrolled back to.
+        self.transcript = TranscriptView(self.baseFrame, TranscriptStore())
+
+    def post(self, msg: str):
+        """
+        Queues a message to be shown by the tkinter thread when it next
+        checks. Can be called from any thread, as it does not call tkinter.
+
+        Parameters:
+            msg (str): Message to display
+        """
+        self.msgRcvQueue.put((time.monotonic(), msg))
+        with self._wake_lock:
+            if self._wake_pending:
+                # tkinter has already been woken for the earlier ones
+                return
+            self._wake_pending = True
+            if self._waker is not None:
+                try:
+                    self._waker[1].send(b'\0')
+                except OSError:
+                    # Window closed
+                    pass
+
+    def start_waking(self):
+        """
+        Has tkinter wait on a socket that post writes to, or if it cannot,
+        checks for messages every POLL_INTERVAL.
+        """
+        if hasattr(self.window.tk, 'createfilehandler'):
+            self._waker = socket.socketpair()
+            for sock in self._waker:
+                sock.setblocking(False)
+            self.window.tk.createfilehandler(
+                self._waker[0], tk.READABLE, lambda *args: self.wake())
+        else:
+            self._poll_id = self.window.after(POLL_INTERVAL, self.poll)
+
+    def stop_waking(self):
+        """
+        Stops checking for messages, before the window is destroyed.
+        """
+        with self._wake_lock:
+            self.closed = True
+            if self._waker is not None:
+                self.window.tk.deletefilehandler(self._waker[0])
+                for sock in self._waker:
+                    sock.close()
+                self._waker = None
+        if self._poll_id is not None:
+            self.window.after_cancel(self._poll_id)
+            self._poll_id = None
+
+    def wake(self):
+        """
+        Shows the messages queued since the last check, if there are any.
+        Runs on the tkinter thread.
+        """
+        with self._wake_lock:
+            pending = self._wake_pending
+            self._wake_pending = False
+            if self._waker is not None:
+                try:
+                    # Only one byte is written until the flag is cleared
+                    self._waker[0].recv(16)
+                except BlockingIOError:
+                    pass
+        if pending and not self.closed:
+            self.checkForMessages()
+
+    def poll(self):
+        """
+        Shows the messages queued since the last check and checks again
+        after POLL_INTERVAL, until the window is closed.
+        """
+        self.wake()
+        if not self.closed:
+            self._poll_id = self.window.after(POLL_INTERVAL, self.poll)
+
+    def checkForMessages(self):
+        """
+        Shows the messages in the msgRcvQueue, a label and notification for
+        each. Stops after FRAME_BUDGET if there are more, and is called
+        again once tkinter has handled any input and redrawn.
+        """
+        deadline = time.monotonic() + FRAME_BUDGET
+        received = None
+        shown = 0
+        while not self.msgRcvQueue.empty():
+            received, msg = self.msgRcvQueue.get()
+            self.add_message(msg)
+            self.create_notification(msg)
+            shown += 1
+            if time.monotonic() > deadline:
+                break
+        if received is not None:
+            self.report_lag(time.monotonic() - received, shown)
+        if not self.msgRcvQueue.empty() and not self.closed:
+            self.window.after(1, self.checkForMessages)
+
+    def report_lag(self, lag: float, shown: int):
+        """
+        Records how long the last message shown waited to be shown, and
+        puts how far behind the window is in the title when it is more
+        than LAG_WARNING.
+
+        Parameters:
+            lag (float): Seconds from recieving the message to showing it
+            shown (int): Messages shown since the last report
+        """
+        stats = self.render_stats
+        stats['batches'] += 1
+        stats['messages'] += shown
+        stats['lag'] = lag
+        stats['max_lag'] = max(stats['max_lag'], lag)
+        stats['behind'] = self.msgRcvQueue.qsize()
+        if lag > LAG_WARNING:
+            self.window.title(f'{TITLE} - {stats["behind"]} messages'
+                              f' behind ({lag:.1f}s)')
+        else:
+            self.window.title(TITLE)
+
+    def add_message(self, msg: str):
+        """
+        Adds a message to the history of messages.
+
+        Parameters:
+            msg (str): Message to display
+        """
+        self.transcript.add(msg)
+
+    def create_notification(self, msg: str):
+        """
+        Hands a message to the notifier, which groups the messages of a
+        burst into one notification and shows it on its own thread.
+
+        Parmeters:
+            msg (str): Message to display
+        """
+        sender, sep, body = msg.partition(SEPARATOR)
+        if not sep:
+            # A message from the server itself
+            sender, body = TITLE, msg
+        self.notifier.notify(sender, body)
+
+    def setUpWindow(self):
+        """
+        Populates the window that the user will use to send and
+        recieve messages. Consists of the transcript of messages, a text box
+        to type messages and a send button.
+        """
+        myscrollbar = tk.Scrollbar(self.baseFrame, orient="vertical")
+        self.transcript.attach_scrollbar(myscrollbar)
+
+        input_box = tk.Text(master=self.window)
+        button = tk.Button(master=self.window, text="Send")
+        # Using a lambda here so that the inputBox can be passed in as
+        # and argument
+        button.bind("<Button-1>",
+                    lambda event, inputBox=input_box:
+                        self.handle_send(inputBox))
+
+        input_box.bind('<Shift-Return>',
+                       lambda event, inputBox=input_box:
+                           self.handle_shift_send(inputBox))
+
+        self.baseFrame.pack(fill='both')
+        myscrollbar.pack(side='right', fill='y')
+        self.transcript.text.pack(side='left', fill='both', expand=True)
+        input_box.pack(side='left', anchor='w')
+        button.pack(side='left', anchor='sw')
+
+        # Give the input box focus
+        input_box.focus()
+
+        photo = PhotoImage(file=resource_path('icon.png'))
+        self.window.iconphoto(False, photo)
+
+        self.window.title(TITLE)
+        self.window.protocol("WM_DELETE_WINDOW", self.on_close)
+        # No need to notify the user of messages they can see
+        self.window.bind('<FocusIn>',
+                         lambda event: self.notifier.set_focus(True))
+        self.window.bind('<FocusOut>',
+                         lambda event: self.notifier.set_focus(False))
+        self.start_waking()
+        self.window.after(0, self.run, self.handle_recv())
+
+    def handle_shift_send(self, input_box: tk.Text):
+        """
+        Used when sending a message using shift return. Waits 100ms
+        before sending the message so that the return key is entered with
+        the message rather than after it is sent. If it is done after then
+        the cursor will be on line 2 when the user wants to type again.
+
+        Paramters:
+            input_box (tk.Text): Message box
+        """
+        input_box.after(100, self.handle_send, input_box)
+
+    def handle_send(self, input_box: tk.Text):
+        """
+        Executed when the user presses send. It will get and clear the
+        text box then hand the message to the client to send. The message
+        will be put straight into the list of messages on the client side.
+        This is done so that the message doesn't need to be sent to the
+        server and back again.
+
+        If the server cannot be contacted, a message is displayed to the
+        user to restart.
+
+        Parameter:
+            input_box (tk.Text): Text box containing the message
+        """
+        msg = input_box.get("1.0", tk.END).rstrip()
+        input_box.delete("1.0", tk.END)
         if msg == DISCONNECT:
-            window.destroy()
-            s.close()
-    except ConnectionAbortedError:
-        msgRcvQueue.put('Lost connection with server, please restart')
-    except OSError:
-        msgRcvQueue.put('Lost connection with server, please restart')
-
-
-def on_close():
-    """
-    Funciton to handle when the user closes the window instead of typing
-    the DISCONNECT message. First notifies the server that you are
-    disconnecting, then closes the socket and window. If the socket was already
-    closed (say by the server), then simply destroy the window.
+            self.run(self.client.disconnect())
+            self.notifier.close()
+            self.stop_waking()
+            self.window.destroy()
+            return
+        if msg.startswith(SEND_FILE + ' ') and self.client.files:
+            path = msg[len(SEND_FILE):].strip()
+            sending = self.run(self.client.send_file(path))
+            sending.add_done_callback(
+                lambda sending: self.check_file_sent(sending, path))
+            self.add_message(f'You:\n Sending {path}')
+            return
+        # Sent on the client's thread, the window does not wait for it
+        sending = self.run(self.send(msg))
+        sending.add_done_callback(self.check_sent)
+        # Add the clients message to the transcript
+        self.add_message('You:\n' + msg)
+
+    async def send(self, msg: str):
+        self.client.send(msg)
+        await self.client.drain()
+
+    def check_sent(self, sending):
+        """
+        Tells the user if a message could not be sent.
+        """
+        if not sending.cancelled() and sending.exception() is not None:
+            self.post(LOST_CONNECTION)
+
+    def check_file_sent(self, sending, path: str):
+        """
+        Tells the user if a file could not be sent, and why.
+        """
+        if sending.cancelled():
+            return
+        error = sending.exception()
+        if isinstance(error, ConnectionError):
+            self.post(LOST_CONNECTION)
+        elif error is not None:
+            # Refused by the server, or the file could not be read
+            self.post(f'Could not send {path}: {error}')
+
+    def on_close(self):
+        """
+        Funciton to handle when the user closes the window instead of typing
+        the DISCONNECT message. First notifies the server that you are
+        disconnecting, then closes the connection and window. If the
+        connection was already closed (say by the server), then simply
+        destroy the window.
+        """
+        if messagebox.askokcancel("Quit", "Do you want to quit?"):
+            self.run(self.client.disconnect())
+            self.notifier.close()
+            self.stop_waking()
+            self.window.destroy()
+
+    async def handle_recv(self):
+        """
+        Runs on the client's event loop, adding the messages from the server
+        (messages from other users) to the queue until the connection
+        closes.
+        """
+        async for message in self.client:
+            self.post(message.text)
+
+    def run(self, coro):
+        """
+        Runs a coroutine on the client's event loop.
+
+        Returns:
+            (Future): Future for the result of the coroutine
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+def start_event_loop():
     """
-    if messagebox.askokcancel("Quit", "Do you want to quit?"):
-        try:
-            mp.send_msg_protocol(s, DISCONNECT, NAME)
-            s.close()
-        except ConnectionAbortedError:
-            pass
-        except OSError:
-            pass
-        finally:
-            window.destroy()
-
+    Starts an event loop for the client on its own thread, so the tkinter
+    main loop can keep the main thread.
 
-def handle_recv():
+    Returns:
+        (AbstractEventLoop): The event loop
     """
-    This function runs in it's own thread. It runs a blocking call
-    to recieve data from the server (messages from other users). This
-    call fails when the socket is closed, which happens in the other
-    thread.
-    """
-    while True:
-        try:
-            data = mp.recv_msg_protocol(s)
-            # Ignore if data is empty or the header was invalid
-            if data:
-                msgRcvQueue.put(data)
-        except ConnectionAbortedError:
-            break
-        except OSError:
-            break
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
 
 
 def main():
+    window = tk.Tk()        # Main window
+    loop = start_event_loop()
     connected = False
     dialog = ClientSetUp()
     window.protocol("WM_DELETE_WINDOW", dialog.on_close)
     window.mainloop()
     NAME, ip, port = (dialog.name, dialog.ip, dialog.port)
     while not connected:
+        if not NAME:
+            # If name was not entered, create a random name
+            NAME = "User" + str(random.randint(0, 1000))
+        client = ChatClient(NAME)
         try:
             port = int(port)
-            addr = (ip, port)
-            s.connect(addr)
+            # Connects and sends the first message that initialises the
+            # connection. This sets the name of this client on the server
+            # and agrees which version of the protocol to use.
+            asyncio.run_coroutine_threadsafe(
+                client.connect(ip, port), loop).result()
             connected = True
         except ConnectionRefusedError:
             dialog.retry(name=NAME)
@@ -232,22 +395,8 @@ def main():
             NAME, ip, port = (dialog.name, dialog.ip, dialog.port)
     dialog.destroy()
 
-    thread_recv = threading.Thread(target=handle_recv)
-    thread_recv.start()
-    setUpWindow()
-
-    if not NAME:
-        # If name was not entered, create a random name
-        NAME = "User" + str(random.randint(0, 1000))
-
-    # Send the first message that initialises the connection.
-    # This simply involves setting the name of this client on the server.
-    try:
-        mp.send_msg_protocol(s, NAME, NAME)
-    except Exception:
-        # If this fails, the initialisation failed so client is not
-        # connected to server properly
-        msgRcvQueue.put('Connection not set up properlly, restart application')
+    chat = ChatWindow(window, client, loop)
+    chat.setUpWindow()
 
     window.mainloop()
 
@@ -0,0 +1,260 @@
+import bisect
+import threading
+
+PAGE_SIZE = 50      # Rows in each page of /rooms and /who
+MAX_CACHED = 1024   # Pages kept of each kind before the cache is emptied
+LAST_CHAR = '\U0010ffff'    # Sorts after every other character
+
+
+def table(rows: list, headers: list):
+    """
+    Formats rows as a plain text table. tabulate is only imported when the
+    first page is made, as it is slow to import and most servers may never
+    be asked for one.
+
+    Parameters:
+        rows (list): Rows of the table
+        headers (list): Heading of each column
+
+    Returns:
+        (str): The table
+    """
+    from tabulate import tabulate
+    return tabulate(rows, headers=headers)
+
+
+def split_page(text: str):
+    """
+    Splits a page number off the end of a command's arguments.
+
+    Parameters:
+        text (str): The arguments, such as 'Lobby 2'
+
+    Returns:
+        (str, int): The rest of the arguments and the page, 1 if no page
+            was given
+    """
+    rest, _, last = text.strip().rpartition(' ')
+    if last.isdigit():
+        return (rest.strip(), max(1, int(last)))
+    return (text.strip(), 1)
+
+
+class RoomDirectory:
+    """
+    The room of every client, whether connected to this server or another
+    node, and the members of each room. It is updated as clients join,
+    move and leave, so listing the rooms does not go through every client.
+    Room names are kept sorted so the rooms starting with a prefix are
+    found with a binary search.
+
+    Listings are sent a page at a time and each page is cached until the
+    membership it shows changes. Any change clears the pages of rooms, as
+    the counts change, but only a change to a room clears the pages of
+    its members.
+
+    Parameters:
+        page_size (int): Rows in each page
+        on_emptied (function): Called with the name of a room when its
+            last client leaves, with the lock held
+    """
+
+    def __init__(self, page_size: int = PAGE_SIZE, on_emptied=None):
+        self.page_size = page_size
+        self.on_emptied = on_emptied
+        self._lock = threading.Lock()
+        self._clients = {}      # Client id -> (name, room)
+        self._rooms = {}        # Room -> {client id: name}, oldest first
+        self._names = []        # Names of the rooms, sorted
+        self._generation = 0    # Changed with every change of membership
+        self._room_pages = {}   # (prefix, page) -> text
+        self._who_pages = {}    # Room -> {page: text}
+        self.stats = {'cached': 0, 'rendered': 0}
+
+    def join(self, client_id: int, name: str, room: str):
+        """
+        Adds a client to a room.
+
+        Parameters:
+            client_id (int): Id of the client
+            name (str): Name of the client
+            room (str): The room it joined
+        """
+        with self._lock:
+            if client_id in self._clients:
+                self._remove(client_id)
+            self._add(client_id, name, room)
+
+    def move(self, client_id: int, room: str):
+        """
+        Moves a client to another room.
+
+        Parameters:
+            client_id (int): Id of the client
+            room (str): The room it moved to
+        """
+        with self._lock:
+            entry = self._clients.get(client_id)
+            if entry is None or entry[1] == room:
+                return
+            self._remove(client_id)
+            self._add(client_id, entry[0], room)
+
+    def leave(self, client_id: int):
+        """
+        Removes a client that has disconnected.
+
+        Parameters:
+            client_id (int): Id of the client
+        """
+        with self._lock:
+            if client_id in self._clients:
+                self._remove(client_id)
+
+    def remove_node(self, node: int, id_bits: int):
+        """
+        Removes every client of a node that has gone away.
+
+        Parameters:
+            node (int): Id of the node
+            id_bits (int): Bits of a client id below the node id
+        """
+        with self._lock:
+            for client_id in [c for c in self._clients
+                              if c >> id_bits == node]:
+                self._remove(client_id)
+
+    def __contains__(self, room: str):
+        return room in self._rooms
+
+    def counts(self):
+        """
+        Returns the number of clients in each room.
+
+        Returns:
+            (dict): Room -> clients
+        """
+        with self._lock:
+            return {room: len(members)
+                    for room, members in self._rooms.items()}
+
+    def rooms_page(self, prefix: str = '', page: int = 1):
+        """
+        Returns a page of the rooms starting with a prefix and the number
+        of clients in each, in order of name.
+
+        Parameters:
+            prefix (str): Start of the room names to list
+            page (int): Page to return, from 1
+
+        Returns:
+            (str): The page
+        """
+        with self._lock:
+            text = self._room_pages.get((prefix, page))
+            if text is not None:
+                self.stats['cached'] += 1
+                return text
+            generation = self._generation
+            start = bisect.bisect_left(self._names, prefix)
+            end = bisect.bisect_left(self._names, prefix + LAST_CHAR, start)
+            first, pages = self._page_bounds(start, end, page)
+            rows = [(name, len(self._rooms[name]))
+                    for name in self._names[first:
+                                            min(first + self.page_size,
+                                                end)]]
+        if not rows:
+            text = (f'No rooms start with "{prefix}"' if prefix
+                    else 'There are no rooms')
+        else:
+            text = table(rows, ['Room', 'Clients'])
+            text += self._footer(page, pages, f'/rooms {prefix}'.rstrip())
+        with self._lock:
+            self.stats['rendered'] += 1
+            if generation == self._generation:
+                if len(self._room_pages) >= MAX_CACHED:
+                    self._room_pages.clear()
+                self._room_pages[(prefix, page)] = text
+        return text
+
+    def who_page(self, room: str, page: int = 1):
+        """
+        Returns a page of the clients in a room, in the order they joined
+        it.
+
+        Parameters:
+            room (str): The room
+            page (int): Page to return, from 1
+
+        Returns:
+            (str): The page
+        """
+        with self._lock:
+            text = self._who_pages.get(room, {}).get(page)
+            if text is not None:
+                self.stats['cached'] += 1
+                return text
+            generation = self._generation
+            members = list(self._rooms.get(room, {}).values())
+        if not members:
+            return f'Nobody is in "{room}"'
+        first, pages = self._page_bounds(0, len(members), page)
+        rows = [(name,) for name in members[first:first + self.page_size]]
+        text = table(rows, [f'In {room}'])
+        text += self._footer(page, pages, f'/who {room}')
+        with self._lock:
+            self.stats['rendered'] += 1
+            if generation == self._generation:
+                if len(self._who_pages) >= MAX_CACHED:
+                    self._who_pages.clear()
+                self._who_pages.setdefault(room, {})[page] = text
+        return text
+
+    def _page_bounds(self, start: int, end: int, page: int):
+        """
+        Returns the index of the first row of a page, and the number of
+        pages, for rows start to end. Pages past the end give the last.
+        """
+        pages = max(1, -(-(end - start) // self.page_size))
+        return (start + (min(page, pages) - 1) * self.page_size, pages)
+
+    def _footer(self, page: int, pages: int, command: str):
+        if pages == 1:
+            return ''
+        page = min(page, pages)
+        footer = f'\n\nPage {page} of {pages}'
+        if page < pages:
+            footer += f', {command} {page + 1} for the next'
+        return footer
+
+    def _add(self, client_id: int, name: str, room: str):
+        """
+        Adds a client to a room. Must be called with the lock held.
+        """
+        self._clients[client_id] = (name, room)
+        members = self._rooms.get(room)
+        if members is None:
+            members = self._rooms[room] = {}
+            bisect.insort(self._names, room)
+        members[client_id] = name
+        self._changed(room)
+
+    def _remove(self, client_id: int):
+        """
+        Removes a client from its room, dropping the room once it is empty.
+        Must be called with the lock held.
+        """
+        _, room = self._clients.pop(client_id)
+        members = self._rooms[room]
+        del members[client_id]
+        if not members:
+            del self._rooms[room]
+            del self._names[bisect.bisect_left(self._names, room)]
+            if self.on_emptied is not None:
+                self.on_emptied(room)
+        self._changed(room)
+
+    def _changed(self, room: str):
+        self._generation += 1
+        self._room_pages.clear()
+        self._who_pages.pop(room, None)
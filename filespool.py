@@ -0,0 +1,287 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+class Upload:
+    """
+    A file being recieved into the spool. Chunks are appended to a partial
+    file, which the spool keeps if the upload stops part way so that it can
+    be resumed from where it got to.
+
+    Parameters:
+        spool (FileSpool): The spool it is being recieved into
+        info (dict): Details of the file, see FileSpool.begin
+        file (file): The partial file, opened for appending
+    """
+
+    def __init__(self, spool, info: dict, file):
+        self.spool = spool
+        self.info = info
+        self.file = file
+        self.received = file.tell()
+
+    @property
+    def id(self):
+        return self.info['id']
+
+    @property
+    def complete(self):
+        return self.received >= self.info['size']
+
+    def write(self, data: bytes):
+        """
+        Adds the next chunk of the file.
+
+        Parameters:
+            data (bytes): The chunk
+
+        Returns:
+            (boolean): True once the whole file has arrived
+
+        Errors:
+            ValueError: If the chunk goes past the size of the file
+        """
+        if self.received + len(data) > self.info['size']:
+            raise ValueError('More data than the size of the file')
+        self.file.write(data)
+        self.received += len(data)
+        return self.complete
+
+    def close(self):
+        """
+        Stops recieving the file, keeping what has arrived.
+        """
+        self.file.close()
+        self.spool._release(self)
+
+
+class FileSpool:
+    """
+    Files shared in rooms, kept in a directory until they are removed to
+    make room for newer ones. Uploads arrive in chunks and are appended to
+    a partial file, so nothing larger than a chunk is held in memory, and
+    an upload that is cut off can be carried on from the partial file.
+    Once complete the file is renamed, and is then sent from disk.
+
+    Each file's details are written next to it as json, so any process
+    sharing the directory can find a file by its id. Ids are given out
+    from first_id to last_id, so processes sharing a directory must be
+    given ranges that do not overlap. Files this spool wrote are picked up
+    again when it is reopened, and only those count towards its limits.
+
+    Parameters:
+        directory (str): Directory to keep the files in, a new temporary
+            directory if None, which is removed on close
+        max_file_bytes (int): Largest file accepted
+        max_total_bytes (int): Most bytes kept, files and partial uploads
+            together, the oldest being removed to make room
+        first_id (int): First id to give out
+        last_id (int): Last id to give out
+    """
+
+    def __init__(self, directory: str = None, max_file_bytes: int = 2**26,
+                 max_total_bytes: int = 2**30, first_id: int = 1,
+                 last_id: int = 2**32 - 1):
+        self.temporary = directory is None
+        self.directory = directory or tempfile.mkdtemp(
+            prefix='chatroom-files-')
+        os.makedirs(self.directory, exist_ok=True)
+        self.max_file_bytes = max_file_bytes
+        self.max_total_bytes = max_total_bytes
+        self.first_id = first_id
+        self.last_id = last_id
+        self._lock = threading.Lock()
+        self._files = OrderedDict()     # Id -> details, oldest first
+        self._uploading = set()     # Ids of uploads in progress
+        self.total_bytes = 0
+        self.stats = {'uploads': 0, 'completed': 0, 'evicted': 0}
+        self._next_id = first_id
+        self._load()
+
+    def __len__(self):
+        return len(self._files)
+
+    def path(self, file_id: int, partial: bool = False):
+        """
+        Returns where the file with an id is kept.
+        """
+        name = f'{file_id}.part' if partial else str(file_id)
+        return os.path.join(self.directory, name)
+
+    def begin(self, sender: str, name: str, size: int,
+              file_id: int = None):
+        """
+        Starts recieving a file, or carries on recieving one that was cut
+        off. Only the client that started an upload can resume it, and the
+        name and size must match.
+
+        Parameters:
+            sender (str): Name of the client sending it
+            name (str): Name of the file
+            size (int): Size of the file in bytes
+            file_id (int): Id of the upload to resume, or None
+
+        Returns:
+            (Upload): The upload, its received attribute being the offset
+                to send from
+
+        Errors:
+            ValueError: If the file is too large, or the upload cannot be
+                resumed
+        """
+        name = os.path.basename(name) or 'file'
+        if not 0 <= size <= min(self.max_file_bytes, self.max_total_bytes):
+            raise ValueError(f'Files must be at most {self.max_file_bytes}'
+                             ' bytes')
+        with self._lock:
+            if file_id is None:
+                if self._next_id > self.last_id:
+                    raise ValueError('No file ids left')
+                info = {'id': self._next_id, 'name': name, 'size': size,
+                        'sender': sender, 'room': None,
+                        'created': time.time()}
+                self._next_id += 1
+                self._files[info['id']] = info
+                self._uploading.add(info['id'])
+                self.total_bytes += size
+                self._evict()
+                self._write_info(info)
+            else:
+                info = self._files.get(file_id)
+                if (info is None or info['room'] is not None
+                        or file_id in self._uploading
+                        or (info['sender'], info['name'], info['size'])
+                        != (sender, name, size)):
+                    raise ValueError(f'Upload {file_id} cannot be resumed')
+            self._uploading.add(info['id'])
+            self.stats['uploads'] += 1
+        try:
+            file = open(self.path(info['id'], partial=True), 'ab')
+        except OSError:
+            self._release_id(info['id'])
+            raise
+        return Upload(self, info, file)
+
+    def finish(self, upload: Upload, room: str):
+        """
+        Moves a complete upload into place, after which it can be sent.
+
+        Parameters:
+            upload (Upload): The upload, once write has returned True
+            room (str): Room it was shared in
+
+        Returns:
+            (dict): The file's details, see lookup
+        """
+        upload.file.close()
+        info = upload.info
+        os.replace(self.path(info['id'], partial=True), self.path(info['id']))
+        with self._lock:
+            info['room'] = room
+            self._write_info(info)
+            self._uploading.discard(info['id'])
+            self.stats['completed'] += 1
+        return self.lookup(info['id'])
+
+    def lookup(self, file_id: int):
+        """
+        Finds a complete file, including those of other processes sharing
+        the directory.
+
+        Parameters:
+            file_id (int): Id of the file
+
+        Returns:
+            (dict): id, name, size, sender, room, created and path of the
+                file, or None if there is no complete file with that id
+        """
+        with self._lock:
+            info = self._files.get(file_id)
+        if info is None:
+            info = self._read_info(file_id)
+        if info is None or info['room'] is None:
+            return None
+        path = self.path(file_id)
+        if not os.path.exists(path):
+            return None
+        return {**info, 'path': path}
+
+    def close(self):
+        """
+        Removes the directory if the spool created it.
+        """
+        if self.temporary:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _release(self, upload: Upload):
+        self._release_id(upload.id)
+
+    def _release_id(self, file_id: int):
+        with self._lock:
+            self._uploading.discard(file_id)
+
+    def _evict(self):
+        """
+        Removes the oldest files, and partial uploads not in progress,
+        until the spool is back within max_total_bytes. Must be called
+        with the lock held.
+        """
+        for file_id in list(self._files):
+            if self.total_bytes <= self.max_total_bytes:
+                return
+            if file_id in self._uploading:
+                continue
+            info = self._files.pop(file_id)
+            self.total_bytes -= info['size']
+            self.stats['evicted'] += 1
+            for path in (self.path(file_id, partial=True),
+                         self.path(file_id), self._info_path(file_id)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _info_path(self, file_id: int):
+        return os.path.join(self.directory, f'{file_id}.json')
+
+    def _write_info(self, info: dict):
+        """
+        Writes a file's details. They are renamed into place so that other
+        processes never read half of them.
+        """
+        path = self._info_path(info['id'])
+        with open(path + '.tmp', 'w') as f:
+            json.dump(info, f)
+        os.replace(path + '.tmp', path)
+
+    def _read_info(self, file_id: int):
+        try:
+            with open(self._info_path(file_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _load(self):
+        """
+        Picks up the files in the directory with ids in this spool's range,
+        left by an earlier run.
+        """
+        found = []
+        for entry in os.listdir(self.directory):
+            stem, ext = os.path.splitext(entry)
+            if ext != '.json' or not stem.isdigit():
+                continue
+            file_id = int(stem)
+            if self.first_id <= file_id <= self.last_id:
+                info = self._read_info(file_id)
+                if info is not None:
+                    found.append(info)
+        for info in sorted(found, key=lambda info: info['created']):
+            self._files[info['id']] = info
+            self.total_bytes += info['size']
+            self._next_id = max(self._next_id, info['id'] + 1)
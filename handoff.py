@@ -0,0 +1,170 @@
+import json
+import os
+import socket
+import struct
+import threading
+
+# Lengths of the json and of the data following it in each message
+HEADER = struct.Struct('!II')
+MAX_FDS = 200   # File descriptors sent in one message, Linux allows 253
+# Passing file descriptors needs Unix sockets and SCM_RIGHTS
+SUPPORTED = hasattr(socket, 'AF_UNIX') and hasattr(socket, 'send_fds')
+
+
+class Channel:
+    """
+    Connection between a server and the process taking over from it, over
+    a Unix socket. Each message is json, optionally followed by bytes of
+    data and carrying open file descriptors, which the other process
+    recieves as its own (SCM_RIGHTS). Sending is thread safe.
+
+    Parameters:
+        sock (socket): Connected Unix socket
+    """
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self._lock = threading.Lock()
+
+    def send(self, msg: dict, data: bytes = b'', fds=()):
+        """
+        Sends a message.
+
+        Parameters:
+            msg (dict): The message, anything json can hold
+            data (bytes): Data to send after it
+            fds (list): File descriptors to send, at most MAX_FDS
+        """
+        body = json.dumps(msg).encode()
+        packet = HEADER.pack(len(body), len(data)) + body + data
+        with self._lock:
+            sent = 0
+            if fds:
+                # The descriptors go with the first bytes of the message
+                sent = socket.send_fds(self.sock, [packet], list(fds))
+            self.sock.sendall(memoryview(packet)[sent:])
+
+    def recv(self):
+        """
+        Recieves the next message.
+
+        Returns:
+            (dict, bytes, list): The message, its data and the file
+                descriptors sent with it, or None once the other process
+                has closed the channel
+
+        Errors:
+            ConnectionResetError: If the channel closes part way through
+                a message
+        """
+        fds = []
+        header = self._recv_exactly(HEADER.size, fds)
+        if header is None:
+            return None
+        body_size, data_size = HEADER.unpack(header)
+        body = self._recv_exactly(body_size, fds)
+        data = self._recv_exactly(data_size, fds) if data_size else b''
+        if body is None or data is None:
+            for fd in fds:
+                os.close(fd)
+            raise ConnectionResetError('Channel closed part way through')
+        return (json.loads(body), data, fds)
+
+    def __iter__(self):
+        """
+        Yields messages until the other process closes the channel.
+        """
+        msg = self.recv()
+        while msg is not None:
+            yield msg
+            msg = self.recv()
+
+    def close(self):
+        self.sock.close()
+
+    def _recv_exactly(self, size: int, fds: list):
+        """
+        Recieves size bytes, adding any file descriptors that come with
+        them to fds.
+
+        Returns:
+            (bytes): The data, or None if the channel closed first
+        """
+        data = bytearray()
+        while len(data) < size:
+            chunk, new_fds, _, _ = socket.recv_fds(self.sock,
+                                                   size - len(data), MAX_FDS)
+            fds.extend(new_fds)
+            if not chunk:
+                return None
+            data += chunk
+        return bytes(data)
+
+
+def connect(path: str):
+    """
+    Asks the server listening on a Unix socket to hand over to this
+    process.
+
+    Parameters:
+        path (str): Path of the socket
+
+    Returns:
+        (Channel): Channel to recieve the server's state on, or None if no
+            server is listening there
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    channel = Channel(sock)
+    channel.send({'type': 'takeover', 'pid': os.getpid()})
+    return channel
+
+
+def listen(path: str, on_takeover):
+    """
+    Waits on a Unix socket for processes asking to take over from this
+    one, from a daemon thread. A socket left at the path by a server that
+    has already handed over is replaced.
+
+    Parameters:
+        path (str): Path of the socket
+        on_takeover (function): Called with the Channel to the new process
+
+    Returns:
+        (socket): The listening socket
+    """
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(1)
+    threading.Thread(target=wait_for_takeover, args=(sock, on_takeover),
+                     daemon=True).start()
+    return sock
+
+
+def wait_for_takeover(sock: socket.socket, on_takeover):
+    """
+    Accepts processes on the socket until one asks to take over.
+    """
+    while True:
+        try:
+            conn, _ = sock.accept()
+        except OSError:
+            # The socket was closed
+            return
+        channel = Channel(conn)
+        try:
+            request = channel.recv()
+        except (OSError, ValueError):
+            request = None
+        if request and request[0].get('type') == 'takeover':
+            on_takeover(channel)
+            return
+        channel.close()
@@ -0,0 +1,213 @@
+import threading
+import time
+
+TICK = 1.0      # Seconds between checks of the heartbeat timers
+SLOTS = 512     # Slots in the timer wheel, one turn is SLOTS * TICK seconds
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel. Time is split into ticks and each timer is put in
+    the slot of the tick it is due on, the slots being reused every turn of
+    the wheel. Adding, cancelling and expiring a timer cost the same however
+    many timers there are, and advancing the wheel only looks at the slots
+    of the ticks that have passed. A timer due more than a turn away waits
+    in its slot until the wheel comes round to it again.
+
+    Not thread safe, callers must hold their own lock.
+
+    Parameters:
+        tick (float): Seconds per slot
+        slots (int): Number of slots
+        now (float): Current time, defaults to time.monotonic()
+    """
+
+    def __init__(self, tick: float = TICK, slots: int = SLOTS,
+                 now: float = None):
+        self.tick = tick
+        self._slots = [{} for _ in range(slots)]   # Key -> tick it is due
+        self._where = {}    # Key -> its slot
+        self._current = int((time.monotonic() if now is None else now)
+                            / tick)
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def schedule(self, key, when: float):
+        """
+        Sets a timer, replacing any timer already set for the key. Timers
+        due in the past expire on the next tick.
+
+        Parameters:
+            key: Anything hashable, given back when the timer expires
+            when (float): Time it is due
+        """
+        self.cancel(key)
+        due = max(-int(-when // self.tick), self._current + 1)
+        slot = self._slots[due % len(self._slots)]
+        slot[key] = due
+        self._where[key] = slot
+
+    def cancel(self, key):
+        """
+        Removes the timer for a key, if there is one.
+        """
+        slot = self._where.pop(key, None)
+        if slot is not None:
+            del slot[key]
+
+    def advance(self, now: float = None):
+        """
+        Moves the wheel on to the current time.
+
+        Parameters:
+            now (float): Current time, defaults to time.monotonic()
+
+        Returns:
+            (list): Keys of the timers that expired
+        """
+        target = int((time.monotonic() if now is None else now) / self.tick)
+        expired = []
+        # After a long pause every slot only needs looking at once
+        start = max(self._current + 1, target - len(self._slots) + 1)
+        for tick in range(start, target + 1):
+            slot = self._slots[tick % len(self._slots)]
+            if not slot:
+                continue
+            due = [key for key, at in slot.items() if at <= target]
+            for key in due:
+                del slot[key]
+                del self._where[key]
+            expired.extend(due)
+        self._current = max(self._current, target)
+        return expired
+
+
+class HeartbeatMonitor:
+    """
+    Finds connections that have gone quiet. Each connection records when
+    it was last heard from in its last_heard attribute, which costs a
+    single assignment per frame. The monitor keeps one timer per
+    connection on a TimerWheel and only looks at a connection when its
+    timer expires: if it has been heard from since, the timer is moved on,
+    while it has been quiet for interval seconds it is pinged every
+    interval, and if it is still quiet timeout seconds after it was last
+    heard from it is evicted. The cost of a check does not depend on how
+    many connections there are.
+
+    The monitor does not send anything itself. ping and evict are called
+    with the connection, outside the monitor's lock.
+
+    Parameters:
+        ping (function): Sends a ping to a connection
+        evict (function): Closes a connection that stopped responding
+        interval (float): Seconds of quiet before a connection is pinged
+        timeout (float): Seconds of quiet before a connection is evicted
+        tick (float): Seconds between checks
+        now (float): Current time, defaults to time.monotonic()
+    """
+
+    def __init__(self, ping, evict, interval: float = 30,
+                 timeout: float = 90, tick: float = TICK,
+                 now: float = None):
+        self.ping = ping
+        self.evict = evict
+        self.configure(interval, timeout)
+        self.tick = tick
+        self._lock = threading.Lock()
+        self._wheel = TimerWheel(tick, now=now)
+        self._stopped = False
+        self.stats = {'pings': 0, 'evicted': 0}
+
+    def __len__(self):
+        return len(self._wheel)
+
+    def __contains__(self, conn):
+        with self._lock:
+            return conn in self._wheel
+
+    def configure(self, interval: float, timeout: float):
+        """
+        Changes the interval and timeout. Connections already watched pick
+        them up when their timer next expires.
+        """
+        self.interval = interval
+        self.timeout = max(timeout, interval)
+
+    def add(self, conn, now: float = None):
+        """
+        Starts watching a connection, counting it as just heard from.
+
+        Parameters:
+            conn (Connection): The connection
+            now (float): Current time, defaults to time.monotonic()
+        """
+        now = time.monotonic() if now is None else now
+        conn.last_heard = now
+        with self._lock:
+            self._wheel.schedule(conn, now + self.interval)
+
+    def remove(self, conn):
+        """
+        Stops watching a connection.
+
+        Parameters:
+            conn (Connection): The connection
+        """
+        with self._lock:
+            self._wheel.cancel(conn)
+
+    def poll(self, now: float = None):
+        """
+        Pings and evicts the connections whose timers have expired. Called
+        every tick seconds.
+
+        Parameters:
+            now (float): Current time, defaults to time.monotonic()
+        """
+        now = time.monotonic() if now is None else now
+        to_ping = []
+        to_evict = []
+        with self._lock:
+            if self._stopped:
+                return
+            for conn in self._wheel.advance(now):
+                quiet = now - conn.last_heard
+                if quiet >= self.timeout:
+                    to_evict.append(conn)
+                    continue
+                if quiet >= self.interval:
+                    # Pinged every interval until it answers or times out
+                    to_ping.append(conn)
+                    due = min(now + self.interval,
+                              conn.last_heard + self.timeout)
+                else:
+                    due = conn.last_heard + self.interval
+                self._wheel.schedule(conn, due)
+        for conn in to_ping:
+            self.stats['pings'] += 1
+            self.ping(conn)
+        for conn in to_evict:
+            self.stats['evicted'] += 1
+            self.evict(conn)
+
+    def start(self):
+        """
+        Polls from a daemon thread, for servers without an event loop.
+        """
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        """
+        Stops pinging and evicting connections, for good.
+        """
+        with self._lock:
+            self._stopped = True
+
+    def _run(self):
+        while not self._stopped:
+            time.sleep(self.tick)
+            self.poll()
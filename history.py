@@ -0,0 +1,156 @@
+import threading
+from collections import OrderedDict, deque
+from itertools import islice
+
+ENTRY_OVERHEAD = 100    # Rough bytes a stored message uses besides its text
+
+
+class RoomHistory:
+    """
+    The recent messages of one room, oldest first. Each is kept as the
+    sender's id and the utf-8 text, which can be framed for any protocol
+    version when it is replayed.
+    """
+    __slots__ = ('messages', 'size')
+
+    def __init__(self):
+        self.messages = deque()     # (sender id, text bytes) tuples
+        self.size = 0               # Bytes used, counting the overhead
+
+    def pop(self):
+        """
+        Drops the oldest message.
+
+        Returns:
+            (int): Bytes freed
+        """
+        _, body = self.messages.popleft()
+        cost = len(body) + ENTRY_OVERHEAD
+        self.size -= cost
+        return cost
+
+
+class HistoryStore:
+    """
+    Keeps the recent messages of every room so they can be replayed to
+    clients joining it. Each room keeps at most max_messages messages and
+    max_bytes bytes, the oldest being dropped first. All rooms together
+    keep at most total_bytes, past which the rooms that have gone longest
+    without a message lose theirs first, so thousands of rooms cannot use
+    up the server's memory. The last replay messages of a room are sent to
+    a joining client. A max_messages or replay of 0 turns history off.
+    """
+
+    def __init__(self, max_messages: int = 100, max_bytes: int = 2**16,
+                 total_bytes: int = 2**26, replay: int = 20):
+        self._lock = threading.Lock()
+        self._rooms = OrderedDict()     # Least recently used room first
+        self.total_size = 0
+        self.evicted = 0    # Messages dropped to stay within the limits
+        self.configure(max_messages, max_bytes, total_bytes, replay)
+
+    def configure(self, max_messages: int, max_bytes: int, total_bytes: int,
+                  replay: int):
+        """
+        Changes the limits. Rooms over the new limits are trimmed when they
+        are next added to.
+        """
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.total_bytes = total_bytes
+        self.replay = min(replay, max_messages)
+
+    def append(self, chat_room: str, sender_id: int, body: bytes):
+        """
+        Adds a message sent to a room. Messages larger than a room may hold
+        are not kept.
+
+        Parameters:
+            chat_room (str): Room the message was sent to
+            sender_id (int): Id of the client that sent it
+            body (bytes): The message as utf-8
+        """
+        cost = len(body) + ENTRY_OVERHEAD
+        if not self.replay or cost > self.max_bytes:
+            return
+        with self._lock:
+            room = self._rooms.get(chat_room)
+            if room is None:
+                room = self._rooms[chat_room] = RoomHistory()
+            else:
+                self._rooms.move_to_end(chat_room)
+            room.messages.append((sender_id, body))
+            room.size += cost
+            self.total_size += cost
+            while (len(room.messages) > self.max_messages
+                   or room.size > self.max_bytes):
+                self.total_size -= room.pop()
+                self.evicted += 1
+            while self.total_size > self.total_bytes:
+                self._evict_oldest()
+
+    def recent(self, chat_room: str):
+        """
+        Returns the messages to replay to a client joining a room.
+
+        Parameters:
+            chat_room (str): The room
+
+        Returns:
+            (list): (sender id, text bytes) tuples, oldest first
+        """
+        with self._lock:
+            room = self._rooms.get(chat_room)
+            if room is None or not self.replay:
+                return []
+            skip = max(0, len(room.messages) - self.replay)
+            return list(islice(room.messages, skip, None))
+
+    def export(self):
+        """
+        Returns every message kept, so they can be appended to another
+        store in the same order to rebuild it.
+
+        Returns:
+            (list): (room, sender id, text bytes) tuples, the rooms that
+                have gone longest without a message first
+        """
+        with self._lock:
+            return [(name, sender_id, body)
+                    for name, room in self._rooms.items()
+                    for sender_id, body in room.messages]
+
+    def room_sizes(self):
+        """
+        Returns the bytes used by each room.
+
+        Returns:
+            (dict): Room name -> bytes
+        """
+        with self._lock:
+            return {name: room.size for name, room in self._rooms.items()}
+
+    def stats(self):
+        """
+        Returns what the store holds in total.
+
+        Returns:
+            (dict): Counters keyed by name
+        """
+        with self._lock:
+            return {'rooms': len(self._rooms),
+                    'messages': sum(len(room.messages)
+                                    for room in self._rooms.values()),
+                    'bytes': self.total_size,
+                    'evicted': self.evicted}
+
+    def _evict_oldest(self):
+        """
+        Drops the oldest message of the room that has gone longest without
+        a new one, forgetting the room once it is empty.
+        """
+        name, room = next(iter(self._rooms.items()))
+        self.total_size -= room.pop()
+        self.evicted += 1
+        if not room.messages:
+            del self._rooms[name]
@@ -0,0 +1,353 @@
+"""
+Headless load generator for the ChatRoom server.
+
+Connects many simulated users to a running server over the real message
+protocol and spreads them over a number of rooms. Once every user has
+connected they chat, /move between rooms and ask for /rooms at a target
+rate for the length of the run. The throughput and the percentiles of the
+delay between a message being sent and each recipient receiving it are
+printed, and written as json with --output so runs can be compared.
+
+Usage:
+    python loadgen.py --port 5000 --clients 1000 --rooms 10 --rate 500
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import sys
+import time
+from collections import deque
+from ChatRoomHelpers import MessageProtocol as mp
+from async_client import ChatClient
+from async_server import raise_fd_limit
+
+MARKER = 'lg '              # Starts every chat message, before the send time
+WELCOME = 'Welcome to ChatRooms'    # Start of the help message
+GRACE = 2       # Seconds to wait for messages in flight at the end of a run
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class Stats:
+    """
+    Counts what the users of one process sent and received during the
+    measured part of the run, from start to end. Messages are counted
+    by the time they were sent, so messages still arriving after the end
+    are counted as well.
+    """
+
+    def __init__(self, start: float, end: float):
+        self.start = start
+        self.end = end
+        self.sent = {'chat': 0, 'move': 0, 'rooms': 0}
+        self.delivered = 0
+        self.latencies = []         # Seconds from send to delivery
+        self.command_latencies = []     # Seconds from /rooms to its reply
+        self.connect_latencies = []     # Seconds to connect and be greeted
+        self.connected = 0
+        self.failed = 0
+        self.disconnected = 0
+
+    def measured(self, when: float):
+        return self.start <= when < self.end
+
+    def to_dict(self):
+        return {'sent': self.sent, 'delivered': self.delivered,
+                'latencies': self.latencies,
+                'command_latencies': self.command_latencies,
+                'connect_latencies': self.connect_latencies,
+                'connected': self.connected, 'failed': self.failed,
+                'disconnected': self.disconnected}
+
+
+class SimUser:
+    """
+    A simulated user with one connection to the server.
+
+    Parameters:
+        number (int): Number of the user, used in its name
+        rooms (list): Rooms the user moves between
+        args (Namespace): The load generator's settings
+        stats (Stats): Where the user records what it sends and receives
+    """
+
+    def __init__(self, number: int, rooms: list, args, stats: Stats):
+        self.client = ChatClient(f'user{number}')
+        self.rooms = rooms
+        self.room = rooms[number % len(rooms)]
+        self.args = args
+        self.stats = stats
+        self.pending = deque()      # Send times of unanswered /rooms
+        self.padding = 'x' * max(0, args.size - 32)
+
+    async def connect(self):
+        """
+        Connects, agrees on a protocol version and moves into the user's
+        room.
+        """
+        if self.args.protocol == 1:
+            versions = (1,)
+        else:
+            versions = mp.supported_versions
+        await self.client.connect(self.args.host, self.args.port, versions)
+        self.client.move(self.room)
+
+    async def receive(self):
+        """
+        Records the messages received until the connection closes.
+        """
+        while True:
+            message = await self.client.recv()
+            now = time.monotonic()
+            if message.replayed:
+                # Sent before the user joined the room, and already counted
+                # for the users that were in it
+                continue
+            if message.sender is not None:
+                # A message sent to the room
+                if message.body.startswith(MARKER):
+                    sent_at = float(message.body.split(' ', 2)[1])
+                    if self.stats.measured(sent_at):
+                        self.stats.delivered += 1
+                        self.stats.latencies.append(now - sent_at)
+            elif not message.text.startswith(WELCOME) and self.pending:
+                # Reply to a /rooms
+                sent_at = self.pending.popleft()
+                if self.stats.measured(sent_at):
+                    self.stats.command_latencies.append(now - sent_at)
+
+    async def drive(self, begin: float, end: float):
+        """
+        Sends messages and commands at the user's share of the target rate
+        from begin until end. Messages are sent on a fixed schedule rather
+        than waiting for earlier ones, so a slow server builds up a backlog
+        as it would with real users.
+        """
+        loop = asyncio.get_running_loop()
+        interval = self.args.clients / self.args.rate
+        next_send = begin + random.uniform(0, interval)
+        while next_send < end:
+            await asyncio.sleep(max(0, next_send - loop.time()))
+            now = time.monotonic()
+            kind = self.pick_action()
+            if kind == 'move':
+                self.room = random.choice(self.rooms)
+                self.client.move(self.room)
+            elif kind == 'rooms':
+                self.pending.append(now)
+                self.client.rooms()
+            else:
+                self.client.send(f'{MARKER}{now:.6f} {self.padding}')
+            if self.stats.measured(now):
+                self.stats.sent[kind] += 1
+            next_send += interval
+            await self.client.drain()
+
+    def pick_action(self):
+        roll = random.random()
+        if roll < self.args.move_ratio:
+            return 'move'
+        if roll < self.args.move_ratio + self.args.rooms_ratio:
+            return 'rooms'
+        return 'chat'
+
+    async def run(self, connect_at: float, begin: float, end: float):
+        """
+        Connects at connect_at, sends from begin until end and keeps
+        receiving for a short while after.
+        """
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(max(0, connect_at - loop.time()))
+        start = time.monotonic()
+        try:
+            await self.connect()
+        except (OSError, ValueError):
+            self.stats.failed += 1
+            return
+        self.stats.connect_latencies.append(time.monotonic() - start)
+        self.stats.connected += 1
+        receiver = asyncio.ensure_future(self.receive())
+        try:
+            await self.drive(begin, end)
+            # Give messages still on their way time to arrive
+            await asyncio.wait([receiver],
+                               timeout=max(0, end + GRACE - loop.time()))
+            # The receiver only stops if the connection was lost
+            lost = receiver.done()
+        except (OSError, ValueError):
+            lost = True
+        if lost:
+            self.stats.disconnected += 1
+        if receiver.done():
+            receiver.exception()
+        else:
+            receiver.cancel()
+        await self.client.close()
+
+
+async def run_users(numbers: range, args, connect_from: float):
+    """
+    Runs some of the users in this process.
+
+    Parameters:
+        numbers (range): Numbers of the users to run
+        args (Namespace): The load generator's settings
+        connect_from (float): time.monotonic() at which the first user
+            connects
+
+    Returns:
+        (dict): The Stats of these users as a dict
+    """
+    ramp = args.clients / args.connect_rate
+    begin = connect_from + ramp + 1
+    stats = Stats(begin + args.warmup, begin + args.warmup + args.duration)
+    rooms = [f'Room{i}' for i in range(args.rooms)]
+    users = [SimUser(n, rooms, args, stats) for n in numbers]
+    await asyncio.gather(*(
+        user.run(connect_from + n / args.connect_rate, begin, stats.end)
+        for n, user in zip(numbers, users)))
+    return stats.to_dict()
+
+
+def run_process(numbers: range, args, connect_from: float, results):
+    """
+    Entry point of a worker process.
+    """
+    raise_fd_limit()
+    results.put(asyncio.run(run_users(numbers, args, connect_from)))
+
+
+def percentile(values: list, pct: float):
+    """
+    Returns a percentile of already sorted values, or None if empty.
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def summarise(results: list, args):
+    """
+    Merges the results of every process into the report.
+
+    Parameters:
+        results (list): Stats dicts of every process
+        args (Namespace): The load generator's settings
+
+    Returns:
+        (dict): The report
+    """
+    sent = {kind: sum(r['sent'][kind] for r in results)
+            for kind in results[0]['sent']}
+    delivered = sum(r['delivered'] for r in results)
+    latencies = sorted(lat for r in results for lat in r['latencies'])
+    commands = sorted(lat for r in results for lat in r['command_latencies'])
+    connects = sorted(lat for r in results for lat in r['connect_latencies'])
+
+    def latency_summary(values):
+        summary = {f'p{pct:g}_ms': (percentile(values, pct) or 0) * 1000
+                   for pct in PERCENTILES}
+        summary['max_ms'] = values[-1] * 1000 if values else 0
+        summary['samples'] = len(values)
+        return summary
+
+    return {
+        'settings': vars(args),
+        'connected': sum(r['connected'] for r in results),
+        'failed': sum(r['failed'] for r in results),
+        'disconnected': sum(r['disconnected'] for r in results),
+        'sent': sent,
+        'delivered': delivered,
+        'sent_per_second': sum(sent.values()) / args.duration,
+        'delivered_per_second': delivered / args.duration,
+        'delivery_latency': latency_summary(latencies),
+        'rooms_latency': latency_summary(commands),
+        'connect_latency': latency_summary(connects),
+    }
+
+
+def print_report(report: dict):
+    print(f'Connected {report["connected"]} users, {report["failed"]}'
+          f' failed, {report["disconnected"]} disconnected early')
+    print(f'Sent {report["sent"]}'
+          f' ({report["sent_per_second"]:.0f} per second)')
+    print(f'Delivered {report["delivered"]}'
+          f' ({report["delivered_per_second"]:.0f} per second)')
+    for name in ('delivery_latency', 'rooms_latency', 'connect_latency'):
+        summary = report[name]
+        print(f'{name:>16}: ' + '  '.join(
+            f'{key[:-3]} {value:.2f}ms' for key, value in summary.items()
+            if key.endswith('_ms')) + f'  ({summary["samples"]} samples)')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Puts load on a ChatRoom server with simulated users')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--clients', type=int, default=100,
+                        help='Number of simulated users')
+    parser.add_argument('--rooms', type=int, default=10,
+                        help='Number of rooms the users are spread over')
+    parser.add_argument('--rate', type=float, default=100,
+                        help='Messages and commands sent per second by all'
+                             ' users together')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Seconds measured')
+    parser.add_argument('--warmup', type=float, default=2,
+                        help='Seconds of traffic before measuring starts')
+    parser.add_argument('--move-ratio', type=float, default=0.01,
+                        help='Fraction of sends that are /move')
+    parser.add_argument('--rooms-ratio', type=float, default=0.01,
+                        help='Fraction of sends that are /rooms')
+    parser.add_argument('--size', type=int, default=64,
+                        help='Approximate size of chat messages in bytes')
+    parser.add_argument('--protocol', type=int, choices=(1, 2), default=2,
+                        help='Newest protocol version to offer')
+    parser.add_argument('--connect-rate', type=float, default=500,
+                        help='Users connected per second')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Processes to share the users between')
+    parser.add_argument('--output', help='File to write the results to as'
+                                         ' json')
+    args = parser.parse_args(argv)
+    if args.move_ratio + args.rooms_ratio > 1:
+        parser.error('--move-ratio and --rooms-ratio add up to more than 1')
+    if min(args.clients, args.rooms, args.processes) < 1:
+        parser.error('--clients, --rooms and --processes must be positive')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Leave time for the processes to start before connecting
+    connect_from = time.monotonic() + 0.5 * args.processes
+    if args.processes == 1:
+        raise_fd_limit()
+        results = [asyncio.run(run_users(range(args.clients), args,
+                                         connect_from))]
+    else:
+        # time.monotonic() is shared by every process on the machine, so
+        # send times can be compared between them
+        queue = multiprocessing.Queue()
+        processes = [multiprocessing.Process(
+                         target=run_process,
+                         args=(range(p, args.clients, args.processes), args,
+                               connect_from, queue))
+                     for p in range(args.processes)]
+        for process in processes:
+            process.start()
+        results = [queue.get() for _ in processes]
+        for process in processes:
+            process.join()
+    report = summarise(results, args)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0 if report['connected'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,514 @@
+"""
+Durable log of the messages sent to rooms.
+
+The log is a directory of append-only segment files. Each record holds the
+time, room, sender id and text of one message, with a crc32 so a record
+only partly written when the server died can be told apart from a good
+one. Records are written by a background thread that writes and fsyncs
+everything appended since its last commit in one go, so sending a message
+never waits for the disk.
+
+Each segment keeps a sparse index by room and time, so replaying a room
+from a point in time skips the segments without the room and starts close
+to the first record wanted. Segments are read through mmap. Once a segment
+is full it is sealed and its index saved alongside it. Old segments are
+removed once they are older than the retention time, or once the log is
+larger than the retention size.
+
+Usage:
+    python message_log.py LOG_DIR [--room NAME] [--minutes N]
+"""
+import argparse
+import bisect
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+RECORD_HEADER = struct.Struct('!II')    # Length of the rest, crc32 of the rest
+RECORD_FIELDS = struct.Struct('!dIH')   # Time, sender id, length of room name
+SEGMENT_SUFFIX = '.log'
+INDEX_SUFFIX = '.idx'
+
+
+def encode_record(timestamp: float, chat_room: str, sender_id: int,
+                  body: bytes):
+    """
+    Creates the bytes of a log record.
+
+    Parameters:
+        timestamp (float): When the message was sent, as time.time()
+        chat_room (str): Room the message was sent to
+        sender_id (int): Id of the client that sent it
+        body (bytes): The message as utf-8
+
+    Returns:
+        (bytes): The record
+
+    Errors:
+        ValueError: If the room name or sender id is too large to store
+    """
+    room = chat_room.encode()
+    try:
+        fields = RECORD_FIELDS.pack(timestamp, sender_id, len(room))
+    except struct.error as e:
+        raise ValueError(f'Cannot log message: {e}') from None
+    rest = fields + room + body
+    return RECORD_HEADER.pack(len(rest), zlib.crc32(rest)) + rest
+
+
+def read_records(view, start: int = 0, end: int = None):
+    """
+    Reads records from a buffer until its end or the first record that is
+    incomplete or fails its crc.
+
+    Parameters:
+        view (memoryview): The buffer, usually a mapped segment
+        start (int): Position of the first record to read
+        end (int): Position to stop at, defaults to the end of the buffer
+
+    Returns:
+        (generator): Yields (position, end position, time, room, sender id,
+            text bytes) for each record
+    """
+    end = len(view) if end is None else end
+    pos = start
+    while pos + RECORD_HEADER.size <= end:
+        length, crc = RECORD_HEADER.unpack_from(view, pos)
+        rest = pos + RECORD_HEADER.size
+        record_end = rest + length
+        if (length < RECORD_FIELDS.size or record_end > end
+                or zlib.crc32(view[rest:record_end]) != crc):
+            return
+        timestamp, sender_id, room_len = RECORD_FIELDS.unpack_from(view, rest)
+        room_start = rest + RECORD_FIELDS.size
+        body_start = room_start + room_len
+        yield (pos, record_end, timestamp,
+               str(view[room_start:body_start], 'utf-8'), sender_id,
+               bytes(view[body_start:record_end]))
+        pos = record_end
+
+
+class Segment:
+    """
+    One file of the log, with its sparse index. A room's records are
+    indexed once every index_interval bytes of the segment, and its first
+    record always is, so a room with no entries is not in the segment.
+
+    Parameters:
+        path (str): Path of the segment file
+        number (int): Number of the segment, the oldest being lowest
+        index_interval (int): Bytes between index entries of a room
+    """
+
+    def __init__(self, path: str, number: int, index_interval: int):
+        self.path = path
+        self.number = number
+        self.index_interval = index_interval
+        self.size = 0           # Bytes written and synced
+        self.first_time = None
+        self.last_time = None
+        self.rooms = {}         # Room -> [(time, position)], oldest first
+        self.times = []         # Same for records of any room
+
+    @property
+    def index_path(self):
+        return self.path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+
+    def note(self, position: int, timestamp: float, chat_room: str):
+        """
+        Adds a record to the index.
+        """
+        if self.first_time is None:
+            self.first_time = timestamp
+        self.last_time = timestamp
+        entries = self.rooms.setdefault(chat_room, [])
+        if not entries or position - entries[-1][1] >= self.index_interval:
+            entries.append((timestamp, position))
+        if (not self.times
+                or position - self.times[-1][1] >= self.index_interval):
+            self.times.append((timestamp, position))
+
+    def start_position(self, chat_room: str, since: float):
+        """
+        Finds where to start reading to find the records of a room sent at
+        or after a time.
+
+        Parameters:
+            chat_room (str): The room, or None for every room
+            since (float): The time
+
+        Returns:
+            (int): The position, or None if the segment has nothing wanted
+        """
+        if self.last_time is None or self.last_time < since:
+            return None
+        entries = self.times if chat_room is None else \
+            self.rooms.get(chat_room)
+        if not entries:
+            return None
+        # The last entry before the time, as records after it may be wanted
+        i = bisect.bisect_left(entries, (since,))
+        return entries[max(0, i - 1)][1]
+
+    def save_index(self):
+        with open(self.index_path, 'w') as f:
+            json.dump({'size': self.size, 'first_time': self.first_time,
+                       'last_time': self.last_time, 'rooms': self.rooms,
+                       'times': self.times}, f)
+
+    def load_index(self):
+        """
+        Loads the saved index, if there is one for the whole file.
+
+        Returns:
+            (boolean): True if it was loaded
+        """
+        try:
+            with open(self.index_path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if saved['size'] != os.path.getsize(self.path):
+            return False
+        self.size = saved['size']
+        self.first_time = saved['first_time']
+        self.last_time = saved['last_time']
+        self.rooms = {room: [tuple(e) for e in entries]
+                      for room, entries in saved['rooms'].items()}
+        self.times = [tuple(e) for e in saved['times']]
+        return True
+
+    def recover(self, truncate: bool = True):
+        """
+        Rebuilds the index by reading the file, cutting off anything after
+        the last complete record.
+
+        Parameters:
+            truncate (bool): Cut the file, rather than only ignoring what
+                is after the last complete record
+
+        Returns:
+            (int): Bytes after the last complete record
+        """
+        file_size = os.path.getsize(self.path)
+        end = 0
+        if file_size:
+            with open(self.path, 'rb') as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as view:
+                    for pos, end, timestamp, room, _, _ in \
+                            read_records(view):
+                        self.note(pos, timestamp, room)
+        if truncate and end < file_size:
+            os.truncate(self.path, end)
+        self.size = end
+        return file_size - end
+
+    def read(self, chat_room: str, since: float):
+        """
+        Reads the records of a room sent at or after a time.
+
+        Parameters:
+            chat_room (str): The room, or None for every room
+            since (float): The time
+
+        Returns:
+            (generator): Yields (time, room, sender id, text bytes)
+        """
+        start = self.start_position(chat_room, since)
+        end = self.size
+        if start is None or start >= end:
+            return
+        with open(self.path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                for _, _, timestamp, room, sender_id, body in \
+                        read_records(view, start, end):
+                    if timestamp >= since and chat_room in (None, room):
+                        yield (timestamp, room, sender_id, body)
+
+    def remove(self):
+        for path in (self.path, self.index_path):
+            try:
+                os.remove(path)
+            except OSError:
+                # Already gone, or still open on Windows
+                pass
+
+
+class MessageLog:
+    """
+    Append-only log of room messages kept in a directory.
+
+    Parameters:
+        directory (str): Directory holding the segments, created if needed
+        segment_bytes (int): Size at which a segment is sealed
+        index_interval (int): Bytes between index entries of a room
+        retention_seconds (float): Age past which segments are removed, or
+            None to keep them
+        retention_bytes (int): Size past which the oldest segments are
+            removed, or None for no limit
+        fsync (bool): Sync each commit to disk. Without it a commit only
+            survives the process dying, not the machine
+        read_only (bool): Only replay the log, leaving the files as they
+            are, so it can be read while a server is writing to it
+    """
+
+    def __init__(self, directory: str, segment_bytes: int = 2**24,
+                 index_interval: int = 2**12, retention_seconds: float = None,
+                 retention_bytes: int = None, fsync: bool = True,
+                 read_only: bool = False):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.retention_seconds = retention_seconds
+        self.retention_bytes = retention_bytes
+        self.fsync = fsync
+        self.read_only = read_only
+        self.stats = {'records': 0, 'commits': 0, 'bytes': 0,
+                      'truncated': 0, 'removed': 0, 'commit_seconds': 0.0}
+        self._cond = threading.Condition()
+        self._pending = []          # (record, time, room) waiting to write
+        self._appended = 0          # Records appended since opened
+        self._committed = 0         # Records written and synced
+        self._last_time = 0
+        self._closed = read_only
+        if not read_only:
+            os.makedirs(directory, exist_ok=True)
+        self.segments = self._load_segments()
+        if read_only:
+            return
+        self._file = open(self.segments[-1].path, 'ab')
+        self._writer = threading.Thread(target=self._run, daemon=True)
+        self._writer.start()
+
+    def append(self, chat_room: str, sender_id: int, body: bytes):
+        """
+        Adds a message to the log. Returns straight away, the message is
+        written with the next commit. Messages added once the log is closed
+        are ignored.
+
+        Parameters:
+            chat_room (str): Room the message was sent to
+            sender_id (int): Id of the client that sent it
+            body (bytes): The message as utf-8
+
+        Errors:
+            ValueError: If the room name or sender id is too large to store
+        """
+        with self._cond:
+            if self._closed:
+                return
+            # Kept in order so the index can be searched by time
+            timestamp = self._last_time = max(time.time(), self._last_time)
+            self._pending.append(
+                (encode_record(timestamp, chat_room, sender_id, body),
+                 timestamp, chat_room))
+            self._appended += 1
+            self._cond.notify_all()
+
+    def flush(self):
+        """
+        Waits until every message appended so far has been committed.
+        """
+        if self.read_only:
+            return
+        with self._cond:
+            target = self._appended
+            self._cond.wait_for(lambda: self._committed >= target
+                                or not self._writer.is_alive())
+
+    def close(self):
+        """
+        Commits what has been appended, then closes the log.
+        """
+        if self.read_only:
+            return
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._writer.join()
+        self._file.close()
+
+    def replay(self, chat_room: str = None, since: float = 0,
+               last_bytes: int = None):
+        """
+        Reads committed messages back, oldest first.
+
+        Parameters:
+            chat_room (str): Room to read, or None for every room
+            since (float): Only messages sent at or after this time
+            last_bytes (int): Only read the newest segments, enough to hold
+                this many bytes
+
+        Returns:
+            (generator): Yields (time, room, sender id, text bytes)
+        """
+        with self._cond:
+            segments = list(self.segments)
+        if last_bytes is not None:
+            total = 0
+            for i in range(len(segments) - 1, -1, -1):
+                total += segments[i].size
+                if total >= last_bytes:
+                    segments = segments[i:]
+                    break
+        for segment in segments:
+            yield from segment.read(chat_room, since)
+
+    def size(self):
+        """
+        Returns the bytes committed to every segment.
+        """
+        return sum(segment.size for segment in self.segments)
+
+    def _load_segments(self):
+        """
+        Opens the segments already in the directory, recovering any that
+        were not sealed cleanly, or starts the first one.
+
+        Returns:
+            (list): The segments, oldest first
+        """
+        numbers = sorted(int(name[:-len(SEGMENT_SUFFIX)])
+                         for name in os.listdir(self.directory)
+                         if name.endswith(SEGMENT_SUFFIX)
+                         and name[:-len(SEGMENT_SUFFIX)].isdigit())
+        segments = []
+        for number in numbers:
+            segment = self._segment(number)
+            last = number == numbers[-1]
+            if last or not segment.load_index():
+                self.stats['truncated'] += segment.recover(
+                    truncate=not self.read_only)
+                if not last and not self.read_only:
+                    segment.save_index()
+            if segment.last_time is not None:
+                self._last_time = max(self._last_time, segment.last_time)
+            segments.append(segment)
+        if not segments and not self.read_only:
+            segments.append(self._segment(1))
+            open(segments[0].path, 'ab').close()
+        return segments
+
+    def _segment(self, number: int):
+        path = os.path.join(self.directory,
+                            f'{number:020d}{SEGMENT_SUFFIX}')
+        return Segment(path, number, self.index_interval)
+
+    def _run(self):
+        """
+        Commits appended messages until the log is closed. Messages
+        appended while a commit is being written wait for the next one,
+        which takes all of them together.
+        """
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._closed,
+                                    self._retention_check_interval())
+                batch = self._pending
+                self._pending = []
+                closing = self._closed
+            if batch:
+                self._commit(batch)
+            self._apply_retention()
+            if closing and not batch:
+                return
+
+    def _commit(self, batch: list):
+        """
+        Writes a batch of records, sealing segments as they fill, then
+        syncs them to disk.
+        """
+        start = time.perf_counter()
+        segment = self.segments[-1]
+        chunk = []
+        position = segment.size
+        for record, timestamp, chat_room in batch:
+            if position and position + len(record) > self.segment_bytes:
+                self._write(chunk, segment, position)
+                chunk = []
+                segment = self._roll(segment)
+                position = 0
+            segment.note(position, timestamp, chat_room)
+            chunk.append(record)
+            position += len(record)
+        self._write(chunk, segment, position)
+        with self._cond:
+            self._committed += len(batch)
+            self.stats['records'] += len(batch)
+            self.stats['commits'] += 1
+            self.stats['bytes'] += sum(len(r) for r, _, _ in batch)
+            self.stats['commit_seconds'] += time.perf_counter() - start
+            self._cond.notify_all()
+
+    def _write(self, chunk: list, segment: Segment, end: int):
+        """
+        Writes records to the open segment and syncs it.
+        """
+        if chunk:
+            self._file.write(b''.join(chunk))
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+        segment.size = end
+
+    def _roll(self, segment: Segment):
+        """
+        Seals a full segment and starts the next one.
+
+        Returns:
+            (Segment): The new segment
+        """
+        self._file.close()
+        segment.save_index()
+        new = self._segment(segment.number + 1)
+        self._file = open(new.path, 'ab')
+        with self._cond:
+            self.segments.append(new)
+        return new
+
+    def _retention_check_interval(self):
+        return 60 if self.retention_seconds else None
+
+    def _apply_retention(self):
+        """
+        Removes the oldest sealed segments while they are too old or the
+        log is too large. The segment being written is always kept.
+        """
+        cutoff = time.time() - (self.retention_seconds or float('inf'))
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            too_old = (oldest.last_time is None or oldest.last_time < cutoff)
+            too_big = (self.retention_bytes is not None
+                       and self.size() > self.retention_bytes)
+            if not too_old and not too_big:
+                break
+            with self._cond:
+                self.segments.pop(0)
+            oldest.remove()
+            self.stats['removed'] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Prints the messages kept in a message log')
+    parser.add_argument('directory')
+    parser.add_argument('--room', default=None,
+                        help='Only print messages sent to this room')
+    parser.add_argument('--minutes', type=float, default=None,
+                        help='Only print messages from the last N minutes')
+    args = parser.parse_args()
+    since = time.time() - args.minutes * 60 if args.minutes else 0
+    log = MessageLog(args.directory, read_only=True)
+    for timestamp, room, sender_id, body in log.replay(args.room, since):
+        when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+        print(f'[{when}] ({room}) {body.decode()}')
+
+
+if __name__ == '__main__':
+    main()
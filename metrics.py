@@ -0,0 +1,299 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the histogram buckets, from 10us to 10s
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+
+def label_key(labels: dict):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key: tuple):
+    """
+    Formats labels the way the Prometheus text format writes them.
+
+    Parameters:
+        key (tuple): (name, value) pairs
+
+    Returns:
+        (str): The labels in braces, or '' if there are none
+    """
+    parts = [f'{name}="{escape(str(value))}"' for name, value in key]
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def escape(value: str):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n',
+                                                                  '\\n')
+
+
+class Metric:
+    """
+    A named value kept for each set of labels it is recorded with. Can be
+    recorded from any thread.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+        self._values = {}   # label_key -> value
+
+    def samples(self):
+        """
+        Returns the metric's values for the Prometheus text format.
+
+        Returns:
+            (list): (name, labels key, value) tuples
+        """
+        with self._lock:
+            return [(self.name, key, value)
+                    for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} {self.kind}']
+        for name, key, value in self.samples():
+            lines.append(f'{name}{format_labels(key)} {value}')
+        return lines
+
+    def remove(self, **labels):
+        """
+        Forgets the value kept for a set of labels, such as a room that has
+        been emptied.
+        """
+        with self._lock:
+            self._values.pop(label_key(labels), None)
+
+
+class Counter(Metric):
+    """
+    A total that only goes up, such as the number of messages recieved.
+    """
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(label_key(labels), 0)
+
+    def total(self):
+        """
+        Returns the sum over every set of labels.
+        """
+        with self._lock:
+            return sum(self._values.values())
+
+
+class Gauge(Metric):
+    """
+    A value read when the metrics are collected, such as the number of
+    open connections. The function returns the value, or if the gauge has
+    labels a dict of values keyed by tuples of (label, value) pairs. A
+    total kept elsewhere that only goes up, such as the pings sent by the
+    heartbeat monitor, is read the same way with kind 'counter', so that
+    Prometheus treats it as one.
+    """
+
+    def __init__(self, name: str, help_text: str, func, kind: str = 'gauge'):
+        super().__init__(name, help_text)
+        self.func = func
+        self.kind = kind
+
+    def samples(self):
+        value = self.func()
+        if isinstance(value, dict):
+            return [(self.name, key, v) for key, v in value.items()]
+        return [(self.name, (), value)]
+
+
+class Histogram(Metric):
+    """
+    Counts values, such as how long something took, in buckets so that
+    percentiles can be estimated. Each bucket counts the values up to its
+    bound, as in the Prometheus text format.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # Counts of each bucket, the last for values above them all
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1),
+                                             0, 0.0]
+            entry[0][index] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Records how long the body of a with statement takes.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            entries = [(key, list(counts), count, total)
+                       for key, (counts, count, total)
+                       in self._values.items()]
+        for key, counts, count, total in entries:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket
+                samples.append((f'{self.name}_bucket',
+                                key + (('le', bound),), cumulative))
+            samples.append((f'{self.name}_count', key, count))
+            samples.append((f'{self.name}_sum', key, total))
+        return samples
+
+    def summary(self):
+        """
+        Returns the count, mean and estimated percentiles for each set of
+        labels.
+
+        Returns:
+            (dict): Labels key -> dict of the count, mean, p50 and p99
+        """
+        with self._lock:
+            entries = [(key, list(counts), count, total)
+                       for key, (counts, count, total)
+                       in self._values.items()]
+        return {key: {'count': count, 'mean': total / count if count else 0,
+                      'p50': self.quantile(counts, count, 0.5),
+                      'p99': self.quantile(counts, count, 0.99)}
+                for key, counts, count, total in entries}
+
+    def quantile(self, counts: list, count: int, q: float):
+        """
+        Estimates a quantile from bucket counts, assuming values are spread
+        evenly through each bucket.
+        """
+        if not count:
+            return 0
+        rank = q * count
+        seen = 0
+        lower = 0
+        for bound, bucket in zip(self.buckets, counts):
+            if seen + bucket >= rank:
+                return lower + (bound - lower) * (rank - seen) / bucket
+            seen += bucket
+            lower = bound
+        # In the overflow bucket
+        return self.buckets[-1]
+
+
+class Registry:
+    """
+    Holds every metric so they can be written out together.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric {metric.name} already exists')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str):
+        return self.register(Counter(name, help_text))
+
+    def gauge(self, name: str, help_text: str, func, kind: str = 'gauge'):
+        return self.register(Gauge(name, help_text, func, kind))
+
+    def histogram(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, buckets))
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def render_prometheus(self):
+        """
+        Writes every metric in the Prometheus text exposition format.
+
+        Returns:
+            (str): The metrics
+        """
+        lines = []
+        for metric in self.metrics():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def metrics_handler():
+    """
+    Returns a request handler that serves the registry of its server at
+    /metrics.
+
+    Returns:
+        (type): Subclass of BaseHTTPRequestHandler
+    """
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = self.server.registry.render_prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes are frequent, don't fill the server's output with them
+            pass
+
+    return MetricsHandler
+
+
+def serve_metrics(registry: Registry, port: int, host: str = '127.0.0.1'):
+    """
+    Serves the metrics over http on a background thread. Only listens on
+    the local machine unless another host is given.
+
+    Parameters:
+        registry (Registry): Metrics to serve
+        port (int): Port to listen on
+        host (str): Address to listen on
+
+    Returns:
+        (ThreadingHTTPServer): The http server
+    """
+    # Only servers with a metrics port load http.server, it is slow to
+    # import
+    from http.server import ThreadingHTTPServer
+    httpd = ThreadingHTTPServer((host, port), metrics_handler())
+    httpd.daemon_threads = True
+    httpd.registry = registry
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
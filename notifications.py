@@ -0,0 +1,241 @@
+from abc import ABC, abstractmethod
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+try:
+    from win10toast_persist import ToastNotifier
+except ImportError:
+    # Only available on Windows
+    ToastNotifier = None
+
+APP_NAME = 'Chat Room'
+
+
+class NotificationBackend(ABC):
+    """
+    Shows notifications to the user. Called from the Notifier's thread, so
+    show may block.
+    """
+
+    @abstractmethod
+    def show(self, title: str, body: str):
+        """
+        Shows a notification.
+        """
+
+
+class NullBackend(NotificationBackend):
+    """
+    Shows nothing, for platforms without notifications.
+    """
+
+    def show(self, title: str, body: str):
+        pass
+
+
+class RecordingBackend(NotificationBackend):
+    """
+    Keeps every notification instead of showing it, for tests.
+    """
+
+    def __init__(self):
+        self.shown = []     # (title, body) tuples
+
+    def show(self, title: str, body: str):
+        self.shown.append((title, body))
+
+
+class ToastBackend(NotificationBackend):
+    """
+    Notifications placed in the Windows 10 Action Center.
+
+    Parameters:
+        icon_path (str): Icon to show with them
+    """
+
+    def __init__(self, icon_path: str = None):
+        self.icon_path = icon_path
+        self.notifier = ToastNotifier()
+
+    def show(self, title: str, body: str):
+        self.notifier.show_toast(title=title, msg=body,
+                                 icon_path=self.icon_path, duration=None)
+
+
+class NotifySendBackend(NotificationBackend):
+    """
+    Desktop notifications on Linux, through the notify-send command.
+
+    Parameters:
+        icon_path (str): Icon to show with them
+    """
+
+    def __init__(self, icon_path: str = None):
+        self.command = [shutil.which('notify-send'), f'--app-name={APP_NAME}']
+        if icon_path:
+            self.command.append(f'--icon={icon_path}')
+
+    def show(self, title: str, body: str):
+        subprocess.run(self.command + [title, body], timeout=5,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def default_backend(icon_path: str = None):
+    """
+    Picks the backend for the platform, or NullBackend if it has no
+    supported notifications.
+
+    Parameters:
+        icon_path (str): Icon to show with notifications
+
+    Returns:
+        (NotificationBackend): The backend
+    """
+    if sys.platform == 'win32' and ToastNotifier is not None:
+        return ToastBackend(icon_path)
+    if sys.platform.startswith('linux') and shutil.which('notify-send'):
+        return NotifySendBackend(icon_path)
+    return NullBackend()
+
+
+class Notifier:
+    """
+    Shows notifications of new messages from a background thread, so a
+    backend that is slow to show them does not hold up the window.
+
+    Messages that arrive close together are grouped by sender, or all
+    together if group_by is 'room', and shown as one notification once
+    delay seconds pass from the first of them. At most one notification is
+    shown every min_interval seconds, messages arriving in between being
+    added to the next one. Nothing is shown while the window has focus, as
+    the user can already see the messages.
+
+    Parameters:
+        backend (NotificationBackend): Shows the notifications
+        group_by (str): 'sender' or 'room'
+        delay (float): Seconds to wait for more messages of a burst
+        min_interval (float): Least seconds between notifications
+    """
+
+    def __init__(self, backend: NotificationBackend, group_by: str = 'sender',
+                 delay: float = 1.0, min_interval: float = 5.0):
+        self.backend = backend
+        self.group_by = group_by
+        self.delay = delay
+        self.min_interval = min_interval
+        self.focused = False
+        self._cond = threading.Condition()
+        self._pending = OrderedDict()   # Group -> [count, last message]
+        self._first = None      # When the oldest pending message arrived
+        self._last_shown = None
+        self._closed = False
+        self.stats = {'messages': 0, 'shown': 0, 'skipped': 0, 'failed': 0}
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def notify(self, sender: str, msg: str):
+        """
+        Adds a message to the next notification. Returns straight away.
+
+        Parameters:
+            sender (str): Who sent the message
+            msg (str): The message
+        """
+        if self.focused:
+            self.stats['skipped'] += 1
+            return
+        key = sender if self.group_by == 'sender' else None
+        with self._cond:
+            self.stats['messages'] += 1
+            group = self._pending.setdefault(key, [0, None])
+            group[0] += 1
+            group[1] = (sender, msg)
+            self._pending.move_to_end(key)
+            if self._first is None:
+                self._first = time.monotonic()
+                self._cond.notify()
+
+    def set_focus(self, focused: bool):
+        """
+        Tells the notifier whether the window has focus. Messages waiting
+        to be shown are dropped when it gains focus.
+        """
+        self.focused = focused
+        if focused:
+            with self._cond:
+                self.stats['skipped'] += sum(
+                    count for count, _ in self._pending.values())
+                self._pending.clear()
+                self._first = None
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def _run(self):
+        """
+        Waits for messages, then shows them once they are due.
+        """
+        while True:
+            with self._cond:
+                while not self._closed:
+                    due = self._due()
+                    now = time.monotonic()
+                    if due is not None and now >= due:
+                        break
+                    self._cond.wait(None if due is None else due - now)
+                if self._closed:
+                    return
+                groups = self._pending
+                self._pending = OrderedDict()
+                self._first = None
+                self._last_shown = time.monotonic()
+            title, body = self.summarise(groups)
+            try:
+                self.backend.show(title, body)
+                self.stats['shown'] += 1
+            except Exception:
+                # A broken backend should not stop the client
+                self.stats['failed'] += 1
+
+    def _due(self):
+        """
+        Returns when the pending messages should be shown, or None if there
+        are none. Must be called with the lock held.
+        """
+        if self._first is None:
+            return None
+        due = self._first + self.delay
+        if self._last_shown is not None:
+            due = max(due, self._last_shown + self.min_interval)
+        return due
+
+    def summarise(self, groups: OrderedDict):
+        """
+        Writes one notification for groups of messages.
+
+        Parameters:
+            groups (OrderedDict): Group -> [count, (sender, last message)],
+                the group with the newest message last
+
+        Returns:
+            (str, str): Title and text of the notification
+        """
+        total = sum(count for count, _ in groups.values())
+        sender, msg = next(reversed(groups.values()))[1]
+        if total == 1:
+            return (sender, msg)
+        if len(groups) == 1 and self.group_by == 'sender':
+            return (f'{sender} ({total} messages)', msg)
+        title = f'{total} new messages'
+        if self.group_by == 'sender':
+            # Most recent senders first
+            senders = [f'{s} ({count})'
+                       for count, (s, _) in reversed(groups.values())]
+            if len(senders) > 3:
+                senders = senders[:3] + [f'{len(senders) - 3} others']
+            title += ' from ' + ', '.join(senders)
+        return (title, f'{sender}: {msg}')
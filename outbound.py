@@ -0,0 +1,637 @@
+import os
+import socket
+import threading
+from collections import deque, namedtuple
+
+DROP_OLDEST = 'drop-oldest'     # Make room by dropping the oldest frames
+DISCONNECT = 'disconnect'       # Disconnect the client that fell behind
+PAUSE = 'pause'                 # Make the sender wait for the client
+POLICIES = (DROP_OLDEST, DISCONNECT, PAUSE)
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')     # Not on Windows
+try:
+    # Most buffers one sendmsg call accepts
+    MAX_BATCH_FRAMES = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    MAX_BATCH_FRAMES = 1024
+
+# Part of a file to send as one frame: the frame's prefix, then count bytes
+# of file from offset. last is True for the final slice of the file.
+FileSlice = namedtuple('FileSlice', ['prefix', 'file', 'offset', 'count',
+                                     'last'])
+
+
+class FileTransfer:
+    """
+    A file being sent to a connection straight from disk. It is sent in
+    slices of at most chunk_bytes, each a frame of its own, so that other
+    frames can be sent in between. Writers send the contents with sendfile,
+    so they are never read into Python.
+
+    Parameters:
+        path (str): The file
+        offset (int): Where in the file to start
+        end (int): Where in the file to stop
+        prefix (function): Given the length of a slice, returns the bytes
+            sent before it
+        chunk_bytes (int): Most bytes of the file in a slice
+
+    Errors:
+        OSError: If the file cannot be opened
+    """
+
+    def __init__(self, path: str, offset: int, end: int, prefix,
+                 chunk_bytes: int = 2**17):
+        self.file = open(path, 'rb')
+        self.offset = offset
+        self.end = end
+        self.prefix = prefix
+        self.chunk_bytes = chunk_bytes
+
+    @property
+    def remaining(self):
+        return max(0, self.end - self.offset)
+
+    def next_slice(self):
+        """
+        Takes the next slice of the file.
+
+        Returns:
+            (FileSlice): The slice
+        """
+        count = min(self.chunk_bytes, self.remaining)
+        piece = FileSlice(self.prefix(count), self.file, self.offset, count,
+                          self.offset + count >= self.end)
+        self.offset += count
+        return piece
+
+    def close(self):
+        self.file.close()
+
+
+class OutboundQueue:
+    """
+    Bounded queue of frames waiting to be written to one connection.
+
+    Once more than high_watermark bytes are queued the client is treated as
+    a slow consumer and the policy decides what happens: the oldest frames
+    are dropped, the client is disconnected, or the sender is paused until
+    the queue drains below low_watermark. Paused senders that wait longer
+    than pause_timeout disconnect the client instead.
+
+    Writers take frames off in batches so that several can be flushed with
+    one send. A batch is waited for up to flush_delay seconds to fill and
+    holds up to batch_bytes (at least one frame). send_calls counts the
+    sends made, which against frames_sent shows how much batching saves.
+
+    Files are queued separately as FileTransfers and do not count towards
+    the watermarks, as they wait on disk rather than in memory. When no
+    frames are waiting the writer is given the next slice of a file instead
+    of a batch, taking a slice from each file in turn, so a large file only
+    delays a chat message by the time to send one slice.
+
+    writing is True from the writer taking a batch until it asks for the
+    next, so a queue that is empty and not writing has sent everything
+    given to it.
+
+    This class holds the frames and the accounting. BlockingOutboundQueue
+    and AsyncOutboundQueue add waiting for threads and tasks.
+    """
+
+    def __init__(self, high_watermark: int = 2**20,
+                 low_watermark: int = 2**18, policy: str = DROP_OLDEST,
+                 pause_timeout: float = 5, flush_delay: float = 0,
+                 batch_bytes: int = 2**16):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown slow consumer policy {policy}')
+        if low_watermark > high_watermark:
+            raise ValueError('Low watermark is above the high watermark')
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.policy = policy
+        self.pause_timeout = pause_timeout
+        self.flush_delay = flush_delay
+        self.batch_bytes = batch_bytes
+        self.closed = False
+        self.writing = False
+        self._frames = deque()
+        self._transfers = deque()   # Files being sent, in turn
+        self.queued_bytes = 0       # Bytes waiting to be written
+        self.peak_bytes = 0         # Most bytes ever waiting
+        self.bytes_queued = 0       # Totals since the queue was created
+        self.frames_queued = 0
+        self.bytes_sent = 0
+        self.frames_sent = 0
+        self.bytes_dropped = 0
+        self.frames_dropped = 0
+        self.send_calls = 0
+        self.files_queued = 0
+        self.file_bytes_sent = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    @property
+    def congested(self):
+        """
+        True when more than high_watermark bytes are queued.
+        """
+        return self.queued_bytes > self.high_watermark
+
+    @property
+    def writable(self):
+        """
+        True when a paused sender may carry on.
+        """
+        return self.closed or self.queued_bytes <= self.low_watermark
+
+    def _push(self, frame: bytes):
+        """
+        Adds a frame, applying the policy if the queue is full.
+
+        Parameters:
+            frame (bytes): The frame to queue
+
+        Returns:
+            (boolean): True if the frame was queued
+        """
+        if self.closed:
+            return False
+        size = len(frame)
+        if self.queued_bytes + size > self.high_watermark:
+            if self.policy == DROP_OLDEST:
+                while (self._frames and
+                       self.queued_bytes + size > self.high_watermark):
+                    old = self._frames.popleft()
+                    self.queued_bytes -= len(old)
+                    self.bytes_dropped += len(old)
+                    self.frames_dropped += 1
+            elif self.policy == DISCONNECT:
+                self.bytes_dropped += size
+                self.frames_dropped += 1
+                self._close()
+                return False
+        self._frames.append(frame)
+        self.queued_bytes += size
+        self.peak_bytes = max(self.peak_bytes, self.queued_bytes)
+        self.bytes_queued += size
+        self.frames_queued += 1
+        return True
+
+    def _push_file(self, transfer: FileTransfer):
+        """
+        Adds a file to send, unless the queue is closed.
+
+        Parameters:
+            transfer (FileTransfer): The file
+
+        Returns:
+            (boolean): True if the file was queued
+        """
+        if self.closed or not transfer.remaining:
+            transfer.close()
+            return not self.closed
+        self._transfers.append(transfer)
+        self.files_queued += 1
+        return True
+
+    def _pop_slice(self):
+        """
+        Takes the next slice of the file whose turn it is. A file with
+        more to send goes to the back of the line.
+
+        Returns:
+            (FileSlice): The slice
+        """
+        transfer = self._transfers.popleft()
+        piece = transfer.next_slice()
+        if not piece.last:
+            self._transfers.append(transfer)
+        self.file_bytes_sent += piece.count
+        return piece
+
+    def _pop_next(self):
+        """
+        Takes what the writer should send next, frames before files.
+
+        Returns:
+            (list or FileSlice): A batch of frames, or a slice of a file
+        """
+        if self._frames:
+            return self._pop_batch()
+        return self._pop_slice()
+
+    @property
+    def _pending(self):
+        return bool(self._frames or self._transfers)
+
+    @property
+    def idle(self):
+        """
+        True when everything queued has been written.
+        """
+        return not (self._pending or self.writing)
+
+    def _drop_files(self):
+        """
+        Stops sending the files queued. The frames waiting are kept.
+
+        Returns:
+            (int): Files dropped
+        """
+        dropped = len(self._transfers)
+        while self._transfers:
+            self._transfers.popleft().close()
+        return dropped
+
+    def _pop(self):
+        """
+        Takes the oldest frame off the queue.
+
+        Returns:
+            (bytes): The frame
+        """
+        frame = self._frames.popleft()
+        self.queued_bytes -= len(frame)
+        self.bytes_sent += len(frame)
+        self.frames_sent += 1
+        return frame
+
+    def _pop_batch(self):
+        """
+        Takes frames off the queue until batch_bytes have been taken, or
+        MAX_BATCH_FRAMES, whichever comes first. At least one frame is
+        taken.
+
+        Returns:
+            (list): The frames
+        """
+        frames = [self._pop()]
+        size = len(frames[0])
+        while (self._frames and size < self.batch_bytes
+               and len(frames) < MAX_BATCH_FRAMES):
+            size += len(self._frames[0])
+            frames.append(self._pop())
+        return frames
+
+    @property
+    def batch_ready(self):
+        """
+        True when a batch does not need to wait any longer to fill.
+        """
+        return self.closed or self.queued_bytes >= self.batch_bytes
+
+    def _close(self):
+        """
+        Stops any more frames being queued and discards those waiting,
+        files included.
+        """
+        self.closed = True
+        self.bytes_dropped += self.queued_bytes
+        self.frames_dropped += len(self._frames)
+        self._frames.clear()
+        self.queued_bytes = 0
+        while self._transfers:
+            self._transfers.popleft().close()
+
+    def stats(self):
+        """
+        Returns the queue depth and the totals for this connection.
+
+        Returns:
+            (dict): Counters keyed by name
+        """
+        return {'queued_frames': len(self._frames),
+                'queued_bytes': self.queued_bytes,
+                'peak_bytes': self.peak_bytes,
+                'frames_queued': self.frames_queued,
+                'bytes_queued': self.bytes_queued,
+                'frames_sent': self.frames_sent,
+                'bytes_sent': self.bytes_sent,
+                'frames_dropped': self.frames_dropped,
+                'bytes_dropped': self.bytes_dropped,
+                'send_calls': self.send_calls,
+                'queued_files': len(self._transfers),
+                'files_queued': self.files_queued,
+                'file_bytes_sent': self.file_bytes_sent}
+
+
+class BlockingOutboundQueue(OutboundQueue):
+    """
+    OutboundQueue shared between the threads sending to a connection and
+    the thread writing to it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cond = threading.Condition()
+
+    def put(self, frame: bytes):
+        """
+        Queues a frame. With the pause policy this blocks while the queue is
+        full.
+
+        Parameters:
+            frame (bytes): The frame to queue
+
+        Returns:
+            (boolean): True if the frame was queued
+        """
+        with self._cond:
+            if self.policy == PAUSE and self.congested:
+                if not self._cond.wait_for(lambda: self.writable,
+                                           self.pause_timeout):
+                    # Waited too long, give up on this client
+                    self._close()
+            queued = self._push(frame)
+            self._cond.notify_all()
+            return queued
+
+    def put_file(self, transfer: FileTransfer):
+        """
+        Queues a file to send. Never blocks.
+
+        Parameters:
+            transfer (FileTransfer): The file
+
+        Returns:
+            (boolean): True if the file was queued
+        """
+        with self._cond:
+            queued = self._push_file(transfer)
+            self._cond.notify_all()
+            return queued
+
+    def get_batch(self):
+        """
+        Waits for the next batch of frames, or slice of a file, to write.
+
+        Returns:
+            (list or FileSlice): The frames or slice, or None once the
+                queue is closed
+        """
+        with self._cond:
+            if self.writing:
+                # The last batch has been written
+                self.writing = False
+                self._cond.notify_all()
+            self._cond.wait_for(lambda: self._pending or self.closed)
+            if (self.flush_delay and self._frames
+                    and not self.batch_ready):
+                self._cond.wait_for(lambda: self.batch_ready,
+                                    self.flush_delay)
+            if self.closed:
+                return None
+            batch = self._pop_next()
+            self.writing = True
+            if self.writable:
+                self._cond.notify_all()
+            return batch
+
+    def wait_idle(self, timeout: float = None):
+        """
+        Waits for the writer to write everything queued.
+
+        Parameters:
+            timeout (float): Most seconds to wait, None to wait forever
+
+        Returns:
+            (boolean): True if it did, False if the queue was closed or
+                the timeout passed first
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self.idle or self.closed, timeout)
+            return self.idle and not self.closed
+
+    def drop_files(self):
+        """
+        Stops sending the files queued, the slice being written finishing.
+
+        Returns:
+            (int): Files dropped
+        """
+        with self._cond:
+            return self._drop_files()
+
+    def close(self):
+        """
+        Closes the queue, waking the writer and any paused senders.
+        """
+        with self._cond:
+            self._close()
+            self._cond.notify_all()
+
+
+class AsyncOutboundQueue(OutboundQueue):
+    """
+    OutboundQueue for a connection served by an event loop. Frames are
+    queued without blocking. Senders that should pause wait on
+    wait_writable once they have finished handling their message. asyncio
+    is imported by its methods, so the threaded engine never loads it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        import asyncio
+        super().__init__(*args, **kwargs)
+        self._ready = asyncio.Event()       # Set while frames are queued
+        self._drained = asyncio.Event()     # Set while writable
+        self._drained.set()
+        self._idle = asyncio.Event()        # Set while idle
+        self._idle.set()
+
+    def put(self, frame: bytes):
+        """
+        Queues a frame.
+
+        Parameters:
+            frame (bytes): The frame to queue
+
+        Returns:
+            (boolean): True if the frame was queued
+        """
+        queued = self._push(frame)
+        self._update()
+        return queued
+
+    def put_file(self, transfer: FileTransfer):
+        """
+        Queues a file to send.
+
+        Parameters:
+            transfer (FileTransfer): The file
+
+        Returns:
+            (boolean): True if the file was queued
+        """
+        queued = self._push_file(transfer)
+        self._update()
+        return queued
+
+    async def get_batch(self):
+        """
+        Waits for the next batch of frames, or slice of a file, to write.
+
+        Returns:
+            (list or FileSlice): The frames or slice, or None once the
+                queue is closed
+        """
+        if self.writing:
+            # The last batch has been written
+            self.writing = False
+            self._update()
+        await self._ready.wait()
+        if self.flush_delay and self._frames and not self.batch_ready:
+            import asyncio
+            await asyncio.sleep(self.flush_delay)
+        if self.closed:
+            return None
+        batch = self._pop_next()
+        self.writing = True
+        self._update()
+        return batch
+
+    async def wait_idle(self, timeout: float = None):
+        """
+        Waits for the writer to write everything queued.
+
+        Parameters:
+            timeout (float): Most seconds to wait, None to wait forever
+
+        Returns:
+            (boolean): True if it did, False if the queue was closed or
+                the timeout passed first
+        """
+        import asyncio
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return not self.closed
+
+    def drop_files(self):
+        """
+        Stops sending the files queued, the slice being written finishing.
+
+        Returns:
+            (int): Files dropped
+        """
+        dropped = self._drop_files()
+        self._update()
+        return dropped
+
+    async def wait_writable(self):
+        """
+        Waits until the queue drains below the low watermark. If that takes
+        longer than pause_timeout the queue is closed.
+        """
+        import asyncio
+        try:
+            await asyncio.wait_for(self._drained.wait(), self.pause_timeout)
+        except asyncio.TimeoutError:
+            self.close()
+
+    def close(self):
+        """
+        Closes the queue, waking the writer and any paused senders.
+        """
+        self._close()
+        self._update()
+
+    def _update(self):
+        """
+        Sets the events to match the state of the queue.
+        """
+        if self._pending or self.closed:
+            self._ready.set()
+        else:
+            self._ready.clear()
+        if self.writable:
+            self._drained.set()
+        else:
+            self._drained.clear()
+        if self.idle or self.closed:
+            self._idle.set()
+        else:
+            self._idle.clear()
+
+
+class ConnectionWriter(threading.Thread):
+    """
+    Thread that writes the frames in a connection's queue to its socket.
+    Each batch is flushed with one sendmsg call where the platform has it,
+    and files are sent with sendfile.
+    When the queue is closed because the client fell too far behind, the
+    socket is shut down so that the thread reading from it stops as well.
+    """
+
+    def __init__(self, conn, queue: BlockingOutboundQueue):
+        super().__init__(daemon=True)
+        self.conn = conn
+        self.queue = queue
+
+    def run(self):
+        batch = self.queue.get_batch()
+        while batch is not None:
+            try:
+                if isinstance(batch, FileSlice):
+                    self._send_file(batch)
+                else:
+                    self._send(batch)
+            except OSError:
+                self.queue.close()
+                break
+            batch = self.queue.get_batch()
+        try:
+            self.conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # Already closed
+            pass
+
+    def _send(self, frames: list):
+        """
+        Sends all of a batch of frames. Unlike sendall, a send that times
+        out is retried rather than losing track of how much was written.
+
+        Parameters:
+            frames (list): The frames to send
+        """
+        sock = self.conn.sock
+        if HAS_SENDMSG:
+            views = [memoryview(frame) for frame in frames]
+        else:
+            views = [memoryview(b''.join(frames))]
+        first = 0   # Index of the first view not completely sent
+        while first < len(views):
+            try:
+                if HAS_SENDMSG:
+                    sent = sock.sendmsg(views[first:])
+                else:
+                    sent = sock.send(views[first])
+            except socket.timeout:
+                if self.queue.closed:
+                    return
+                continue
+            self.queue.send_calls += 1
+            while sent:
+                if sent >= len(views[first]):
+                    sent -= len(views[first])
+                    first += 1
+                else:
+                    views[first] = views[first][sent:]
+                    sent = 0
+
+    def _send_file(self, piece: FileSlice):
+        """
+        Sends a slice of a file, closing the file after its last slice.
+
+        Parameters:
+            piece (FileSlice): The slice
+        """
+        try:
+            self._send([piece.prefix])
+            if piece.count:
+                self.conn.sock.sendfile(piece.file, piece.offset,
+                                        piece.count)
+                self.queue.send_calls += 1
+        finally:
+            if piece.last:
+                piece.file.close()
@@ -0,0 +1,369 @@
+from abc import ABC, abstractmethod
+import argparse
+import json
+import os
+import socket
+import threading
+from ChatRoomHelpers import Connection, MessageProtocol as mp
+from outbound import BlockingOutboundQueue, ConnectionWriter, PAUSE
+
+# Broker events, sent as version 2 frames. The frame type is the event, the
+# sender id is the node and the message is the event's fields as json.
+JOIN = 1
+MOVE = 2
+LEAVE = 3
+CHAT = 4
+NODE_GONE = 5
+WELCOME = 6     # Sent by the broker to a new node, holding its id
+
+NODE_ID_BITS = 24   # Client ids on node n start at n << 24
+
+# Events must not be dropped, so a full queue pauses whoever publishes
+BROKER_QUEUE = {'high_watermark': 2**26, 'low_watermark': 2**24,
+                'policy': PAUSE}
+
+
+def open_broker_connection(sock: socket.socket):
+    """
+    Wraps a broker socket in a Connection with its own writer thread.
+
+    Parameters:
+        sock (socket): Connected broker socket
+
+    Returns:
+        (Connection): The connection
+    """
+    if sock.family != socket.AF_UNIX:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    conn = Connection(sock)
+    conn.version = 2
+    conn.outbound = BlockingOutboundQueue(**BROKER_QUEUE)
+    ConnectionWriter(conn, conn.outbound).start()
+    return conn
+
+
+def broker_socket(addr):
+    """
+    Creates a socket for a broker address.
+
+    Parameters:
+        addr (str or tuple): Path of a Unix socket, or a (host, port) tuple
+
+    Returns:
+        (socket): The socket, not yet bound or connected
+    """
+    if isinstance(addr, str):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+
+def encode_event(event: int, node: int, **fields):
+    """
+    Creates the frame for a broker event.
+
+    Parameters:
+        event (int): The event type
+        node (int): Id of the node the event came from
+        fields: The event's fields
+
+    Returns:
+        (bytes): The frame
+    """
+    return mp.encode_frame(json.dumps(fields).encode(), '', 2, node, event)
+
+
+class RoomBackend(ABC):
+    """
+    Interface between the server and whatever carries room broadcasts.
+
+    The server tells the backend about its clients joining, moving and
+    leaving, and publishes every room message to it. The backend calls
+    deliver(room, text, sender_id) on every node, including the one the
+    message came from, to send the message to that node's clients in the
+    room. Calls to deliver go through dispatch, which an event loop can
+    replace so that delivery happens on its own thread.
+    """
+
+    def __init__(self, deliver):
+        self.deliver = deliver
+        self.dispatch = lambda func, *args: func(*args)
+        self.node = 0
+
+    def publish_join(self, client_id: int, name: str, room: str):
+        pass
+
+    def publish_move(self, client_id: int, room: str):
+        pass
+
+    def publish_leave(self, client_id: int):
+        pass
+
+    @abstractmethod
+    def publish_chat(self, room: str, text: str, sender_id: int):
+        """
+        Publishes a message sent to a room, to be delivered on every node.
+        """
+
+    def close(self):
+        pass
+
+
+class LocalBackend(RoomBackend):
+    """
+    Backend for a single server process. Messages are delivered straight
+    away on the publishing thread.
+    """
+
+    def publish_chat(self, room: str, text: str, sender_id: int):
+        self.deliver(room, text, sender_id)
+
+
+class BrokerBackend(RoomBackend):
+    """
+    Backend that shares rooms with other nodes through a Broker, over a
+    Unix socket for workers on one machine or TCP for several machines.
+
+    Chat messages are delivered when the broker relays them back, rather
+    than straight away, so every node delivers the messages of a room in
+    the same order. The clients of other nodes are added to the directory,
+    if one is given, as they join, move and leave.
+
+    If the connection to the broker is lost, the backend falls back to
+    delivering messages straight away like LocalBackend, so the clients of
+    this node can still talk to each other, and the clients of the other
+    nodes are removed from the directory.
+    """
+
+    def __init__(self, addr, deliver, directory=None):
+        super().__init__(deliver)
+        self.directory = directory
+        self.stats = {'published': 0, 'delivered': 0, 'bad_events': 0}
+        self.connected = True
+        self._closing = False
+        self._nodes = set()     # Other nodes whose clients were added
+        sock = broker_socket(addr)
+        sock.connect(addr)
+        self._conn = open_broker_connection(sock)
+        # The broker's first event gives this node its id
+        msg_header, _ = self._conn.recv_frame()
+        self.node = msg_header['sender']
+        threading.Thread(target=self._receive, daemon=True).start()
+
+    def publish_join(self, client_id: int, name: str, room: str):
+        self._publish(JOIN, id=client_id, name=name, room=room)
+
+    def publish_move(self, client_id: int, room: str):
+        self._publish(MOVE, id=client_id, room=room)
+
+    def publish_leave(self, client_id: int):
+        self._publish(LEAVE, id=client_id)
+
+    def publish_chat(self, room: str, text: str, sender_id: int):
+        if not self.connected:
+            self.deliver(room, text, sender_id)
+            return
+        self.stats['published'] += 1
+        self._publish(CHAT, room=room, text=text, sender=sender_id)
+
+    def close(self):
+        self._closing = True
+        self._conn.close()
+
+    def _publish(self, event: int, **fields):
+        if self.connected:
+            self._conn.sendall(encode_event(event, self.node, **fields))
+
+    def _receive(self):
+        """
+        Handles events relayed by the broker until it goes away. An event
+        that cannot be handled is logged and skipped.
+        """
+        while True:
+            try:
+                msg_header, msg = self._conn.recv_frame()
+            except (OSError, ValueError) as e:
+                reason = e
+                break
+            try:
+                self._handle(msg_header['type'], msg_header['sender'],
+                             json.loads(msg))
+            except Exception as e:
+                self.stats['bad_events'] += 1
+                print(f'[BROKER] Skipped an event that could not be handled:'
+                      f' {e!r}')
+        if not self._closing:
+            self._lost(reason)
+
+    def _lost(self, reason):
+        """
+        Falls back to delivering messages on this node once the broker
+        connection is lost.
+
+        Parameters:
+            reason: Why the connection was lost
+        """
+        self.connected = False
+        self._conn.close()
+        print(f'[BROKER] Lost the connection to the broker ({reason}),'
+              ' messages are now only delivered to clients on this node')
+        if self.directory is not None:
+            for node in self._nodes:
+                self.directory.remove_node(node, NODE_ID_BITS)
+
+    def _handle(self, event: int, node: int, fields: dict):
+        if event == CHAT:
+            self.stats['delivered'] += 1
+            self.dispatch(self.deliver, fields['room'], fields['text'],
+                          fields['sender'])
+            return
+        if node == self.node or self.directory is None:
+            # Our own clients are already in the directory
+            return
+        self._nodes.add(node)
+        if event == JOIN:
+            self.directory.join(fields['id'], fields['name'], fields['room'])
+        elif event == MOVE:
+            self.directory.move(fields['id'], fields['room'])
+        elif event == LEAVE:
+            self.directory.leave(fields['id'])
+        elif event == NODE_GONE:
+            self.directory.remove_node(node, NODE_ID_BITS)
+
+
+class Broker:
+    """
+    Relays events between the nodes sharing rooms. Every event is passed
+    on to all nodes, the one it came from included, in the order the
+    broker recieved it. That is what keeps the messages of each room in
+    the same order on every node.
+
+    The broker also keeps the membership of every room, so a node that
+    connects late is sent a JOIN for every client already connected, and
+    the clients of a node that goes away are removed from the others.
+    """
+
+    def __init__(self, addr):
+        self.addr = addr
+        self._lock = threading.Lock()
+        self._nodes = {}        # Connection -> node id
+        self._members = {}      # Client id -> JOIN fields
+        self._next_node = 1
+        self._sock = broker_socket(addr)
+        if not isinstance(addr, str):
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(addr)
+        self._sock.listen()
+        if not isinstance(addr, str):
+            # Pick up the port chosen by the system if 0 was asked for
+            self.addr = self._sock.getsockname()
+
+    def start(self):
+        """
+        Starts accepting nodes on a background thread.
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def serve_forever(self):
+        """
+        Accepts nodes until the broker is closed.
+        """
+        while True:
+            try:
+                sock, _ = self._sock.accept()
+            except OSError:
+                # Broker was closed
+                return
+            conn = open_broker_connection(sock)
+            with self._lock:
+                node = self._next_node
+                self._next_node += 1
+                conn.sendall(encode_event(WELCOME, node))
+                for client_id, fields in self._members.items():
+                    conn.sendall(encode_event(
+                        JOIN, client_id >> NODE_ID_BITS, **fields))
+                self._nodes[conn] = node
+            threading.Thread(target=self._serve, args=(conn, node),
+                             daemon=True).start()
+
+    def close(self):
+        """
+        Stops the broker, removing its socket file if it has one.
+        """
+        self._sock.close()
+        if isinstance(self.addr, str):
+            try:
+                os.unlink(self.addr)
+            except OSError:
+                pass
+
+    def _serve(self, conn: Connection, node: int):
+        """
+        Relays the events sent by one node until it disconnects.
+        """
+        try:
+            while True:
+                msg_header, msg = conn.recv_frame()
+                self._relay(msg_header['type'], node, msg)
+        except (OSError, ValueError):
+            pass
+        with self._lock:
+            del self._nodes[conn]
+            for client_id in [c for c in self._members
+                              if c >> NODE_ID_BITS == node]:
+                del self._members[client_id]
+        self._relay(NODE_GONE, node, '{}')
+        conn.close()
+
+    def _relay(self, event: int, node: int, msg: str):
+        """
+        Records membership changes and passes an event on to every node.
+        """
+        with self._lock:
+            if event in (JOIN, MOVE, LEAVE):
+                fields = json.loads(msg)
+                client_id = fields['id']
+                if event == JOIN:
+                    self._members[client_id] = fields
+                elif event == MOVE and client_id in self._members:
+                    self._members[client_id]['room'] = fields['room']
+                elif event == LEAVE:
+                    self._members.pop(client_id, None)
+            frame = mp.encode_frame(msg.encode(), '', 2, node, event)
+            for conn in self._nodes:
+                conn.sendall(frame)
+
+
+def parse_address(text: str):
+    """
+    Parses a broker address given on the command line.
+
+    Parameters:
+        text (str): host:port for TCP, or a path for a Unix socket
+
+    Returns:
+        (str or tuple): The path, or a (host, port) tuple
+    """
+    host, sep, port = text.rpartition(':')
+    if sep and port.isdigit():
+        return (host or '127.0.0.1', int(port))
+    return text
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Broker that lets several ChatRoom servers share rooms')
+    parser.add_argument('address', nargs='?', default='127.0.0.1:5100',
+                        help='host:port or Unix socket path to listen on')
+    args = parser.parse_args()
+    broker = Broker(parse_address(args.address))
+    print(f'[STARTING] Broker is listening on {broker.addr}')
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        print('[EXITING] Keyboard interrupt detected')
+    finally:
+        broker.close()
+
+
+if __name__ == '__main__':
+    main()
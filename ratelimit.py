@@ -0,0 +1,188 @@
+import threading
+import time
+
+DELAY = 'delay'
+DROP = 'drop'
+DISCONNECT = 'disconnect'
+POLICIES = (DELAY, DROP, DISCONNECT)
+MAX_ROOMS = 4096    # Room buckets kept before full ones are forgotten
+
+
+def parse_limit(text: str):
+    """
+    Parses a limit given on the command line.
+
+    Parameters:
+        text (str): 'rate,burst' such as '10,20', or just the rate, in
+            which case the burst is twice the rate. A rate of 0 is no limit
+
+    Returns:
+        (tuple): (rate, burst)
+
+    Errors:
+        ValueError: If the text is not a limit
+    """
+    rate, _, burst = text.partition(',')
+    rate = float(rate)
+    burst = float(burst) if burst else max(1.0, 2 * rate)
+    if rate < 0 or burst < 1:
+        raise ValueError(f'Invalid limit {text}')
+    return (rate, burst)
+
+
+class TokenBucket:
+    """
+    Allows rate events a second on average and up to burst at once. The
+    bucket holds up to burst tokens, refilled at rate a second, and each
+    event takes one.
+
+    Parameters:
+        rate (float): Tokens added a second
+        burst (float): Most tokens held
+        now (float): Current time, defaults to time.monotonic()
+    """
+
+    def __init__(self, rate: float, burst: float, now: float = None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, now: float):
+        """
+        Returns how many seconds until a token is available, 0 if one is
+        now.
+        """
+        self.refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self, now: float):
+        """
+        Takes a token, going into debt if there is none.
+
+        Returns:
+            (float): Seconds until the debt is paid off, 0 if there was
+                a token
+        """
+        self.refill(now)
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    @property
+    def full(self):
+        return self.tokens >= self.burst
+
+
+class RateLimiter:
+    """
+    Token bucket limits on what each client sends, and on what is sent in
+    each room by all its clients together, kept separately for chat
+    messages and commands.
+
+    With the delay policy a message over the limit is still handled, but
+    its token is borrowed and the client is not read from again until the
+    debt is paid off, so a fast sender is slowed to the limit by its own
+    socket filling up. With the drop and disconnect policies a message
+    over the limit is not handled and takes no tokens.
+
+    Client buckets are kept on the connection, so they go with it. Room
+    buckets are shared by the clients' threads and kept under a lock.
+
+    Parameters:
+        limits (dict): (kind, scope) -> (rate, burst), where kind is
+            'chat' or 'command' and scope is 'client' or 'room'. A rate of
+            0 or a missing entry is no limit
+        policy (str): One of POLICIES
+    """
+
+    def __init__(self, limits: dict, policy: str = DELAY):
+        self.limits = dict(limits)
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._rooms = {}    # (kind, room) -> TokenBucket
+
+    def configure(self, limits: dict, policy: str):
+        """
+        Changes the limits and policy. Existing buckets are dropped so
+        they are refilled to the new burst.
+        """
+        self.limits = dict(limits)
+        self.policy = policy
+        with self._lock:
+            self._rooms.clear()
+
+    def check(self, conn, room: str, kind: str, now: float = None):
+        """
+        Counts a message from a client against the limits.
+
+        Parameters:
+            conn (Connection): The client that sent it
+            room (str): The client's room
+            kind (str): 'chat' or 'command'
+            now (float): Current time, defaults to time.monotonic()
+
+        Returns:
+            (float, str): Seconds the client is over its limits by and
+                'client' or 'room' for the limit that was hit, or (0, None)
+                if it is within them
+        """
+        now = time.monotonic() if now is None else now
+        client = self._client_bucket(conn, kind, now)
+        with self._lock:
+            shared = self._room_bucket(room, kind, now)
+            buckets = [(b, scope) for b, scope in ((client, 'client'),
+                                                   (shared, 'room'))
+                       if b is not None]
+            if not buckets:
+                return (0, None)
+            if self.policy == DELAY:
+                waits = [(b.take(now), scope) for b, scope in buckets]
+            else:
+                waits = [(b.wait(now), scope) for b, scope in buckets]
+                if not any(wait for wait, _ in waits):
+                    for b, _ in buckets:
+                        b.take(now)
+        wait, scope = max(waits, key=lambda item: item[0])
+        return (wait, scope) if wait else (0, None)
+
+    def _client_bucket(self, conn, kind: str, now: float):
+        rate, burst = self.limits.get((kind, 'client'), (0, 0))
+        if not rate:
+            return None
+        bucket = conn.rate_buckets.get(kind)
+        if bucket is None or (bucket.rate, bucket.burst) != (rate, burst):
+            bucket = conn.rate_buckets[kind] = TokenBucket(rate, burst, now)
+        return bucket
+
+    def _room_bucket(self, room: str, kind: str, now: float):
+        """
+        Returns the bucket of a room. Must be called with the lock held.
+        """
+        rate, burst = self.limits.get((kind, 'room'), (0, 0))
+        if not rate:
+            return None
+        bucket = self._rooms.get((kind, room))
+        if bucket is None:
+            if len(self._rooms) >= MAX_ROOMS:
+                self._forget_full(now)
+            bucket = self._rooms[(kind, room)] = TokenBucket(rate, burst,
+                                                             now)
+        return bucket
+
+    def _forget_full(self, now: float):
+        """
+        Drops the room buckets that have refilled, as a full bucket is the
+        same as a new one. Must be called with the lock held.
+        """
+        full = []
+        for key, bucket in self._rooms.items():
+            bucket.refill(now)
+            if bucket.full:
+                full.append(key)
+        for key in full:
+            del self._rooms[key]
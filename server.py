@@ -1,112 +1,573 @@
+import argparse
+import ipaddress
+import json
+import os
+import select
 import socket
 import sys
 import threading
-from ChatRoomHelpers import ClientList
+import itertools
+import time
+from ChatRoomHelpers import (ClientList, Compression, Connection, HandedOff,
+                             SharedFrame)
+from ChatRoomHelpers import (DISCONNECT, ENTERED, FILE_HELP, GET_FILE, HELP,
+                             HELP_LINES, LEAVE_ROOM, LEFT, MOVE_ROOM,
+                             ROOM_DETAILS, SEND_FILE, WELCOME_MESSAGE, WHO)
 from ChatRoomHelpers import MessageProtocol as mp
+from directory import RoomDirectory, split_page
+from filespool import FileSpool
+import handoff
+from heartbeat import HeartbeatMonitor
+from history import HistoryStore
+from message_log import MessageLog
+from metrics import Histogram, Registry, serve_metrics
+from outbound import (BlockingOutboundQueue, ConnectionWriter, FileTransfer,
+                      POLICIES)
+from pubsub import (BrokerBackend, LocalBackend, NODE_ID_BITS, RoomBackend,
+                    parse_address)
+from ratelimit import DELAY, DROP, RateLimiter, parse_limit
+from ratelimit import POLICIES as LIMIT_POLICIES
 import re
-from tabulate import tabulate
-
-socket.setdefaulttimeout(5)
-
-DISCONNECT = '/disconnect'
-DISSCONNECT_MESSAGE = f'{DISCONNECT} - To disconnect from server'
-HELP = '/help'
-HELP_MESSAGE = f'{HELP} - To see this message again'
-MOVE_ROOM = '/move'
-MOVE_ROOM_MESSAGE = (f'{MOVE_ROOM} Name - To create/move into a'
-                     ' room called "Name"')
-LEAVE_ROOM = '/leave'
-LEAVE_ROOM_MESSAGE = (f'{LEAVE_ROOM} - To leave the current room and move'
-                      ' into General room')
-ROOM_DETAILS = '/rooms'
-ROOM_DETAILS_MESSGAE = f'{ROOM_DETAILS} - To get a list of available rooms'
+
+# Lets the threaded engine's accept loop see Ctrl+C on every platform
+ACCEPT_TIMEOUT = 5
+
+STATS = '/stats'    # Admin only, so not in the help message
 
 client_list = ClientList()
+# Rooms of the clients of every node, for /rooms and /who
+directory = RoomDirectory(on_emptied=lambda room: forget_room(room))
 DEFAULT_ROOM = "General"
+MAX_ROOM_NAME = 100     # Characters, so every room name fits in the log
 NAME = "SERVER"
-MAX_RETIRES = 5
+conn_ids = itertools.count(1)   # Id 0 is used for messages from the server
+ENGINES = ('threaded', 'asyncio')
+# Carries room messages, and shares rooms with other nodes if not local.
+# Looked up through a lambda as deliver is defined further down.
+backend = LocalBackend(lambda *args: deliver(*args))
+# Limits for the queue of frames waiting to be sent to each client
+outbound_settings = {'high_watermark': 2**20, 'low_watermark': 2**18,
+                     'policy': POLICIES[0], 'flush_delay': 0,
+                     'batch_bytes': 2**16}
+# Limits for the recent messages kept for each room and replayed on joining
+history_settings = {'max_messages': 100, 'max_bytes': 2**16,
+                    'total_bytes': 2**26, 'replay': 20}
+history = HistoryStore(**history_settings)
+# Where room messages are kept on disk, if they are. See open_message_log.
+log_settings = {'directory': None, 'segment_bytes': 2**24,
+                'retention_seconds': None, 'retention_bytes': None}
+message_log = None
+# Compression offered to clients, for frames of at least threshold bytes
+compression_settings = {'enabled': True, 'threshold': 512, 'level': 6}
+# Seconds from accepting a client to it sending its name, and the most
+# clients that may be connecting at once before others are turned away
+handshake_settings = {'timeout': 10, 'max_pending': 10000}
+# Seconds a client that answers pings may be quiet before it is pinged, and
+# before it is disconnected
+heartbeat_settings = {'interval': 30, 'timeout': 90}
+# Pings quiet clients and evicts the ones that stop answering. Started by
+# each engine, as the asyncio engine polls it from its event loop.
+heartbeats = HeartbeatMonitor(lambda conn: send_ping(conn),
+                              lambda conn: evict_client(conn),
+                              **heartbeat_settings)
+# Messages a second and bursts allowed from each client and in each room,
+# for chat and for commands, and what happens to a client over a limit
+rate_limit_settings = {'limits': {('chat', 'client'): (10, 20),
+                                  ('chat', 'room'): (200, 400),
+                                  ('command', 'client'): (2, 10),
+                                  ('command', 'room'): (50, 100)},
+                       'policy': DELAY}
+limiter = RateLimiter(**rate_limit_settings)
+# Files shared in rooms: where they are kept (a temporary directory if
+# None), the largest accepted (0 to turn files off), the most kept, the
+# largest sent to everyone in the room without being asked for, and the
+# most of a file sent between other frames. See open_spool.
+file_settings = {'directory': None, 'max_bytes': 2**26,
+                 'spool_bytes': 2**30, 'push_bytes': 2**18,
+                 'chunk_bytes': 2**17}
+spool = None
+# Unix socket a newer server can take over from this one on, and the
+# seconds to wait for what is queued for the clients to be written before
+# handing them over. See hand_off.
+handoff_settings = {'path': None, 'drain_timeout': 5}
+pending_handshakes = 0
+handshake_lock = threading.Lock()
+# Every client accepted and not yet removed, greeted or not
+open_connections = set()
+open_lock = threading.Lock()
+# Outbound queue totals of the clients that have been removed, so the
+# totals exported do not go down when a client leaves. Guarded by open_lock.
+removed_queue_stats = dict.fromkeys(
+    ('frames_sent', 'frames_dropped', 'send_calls', 'file_bytes_sent'), 0)
+
+
+def current_settings():
+    """
+    Returns every group of settings, so they can be passed to the worker
+    processes of a sharded server.
+
+    Returns:
+        (dict): Copies of the settings keyed by group
+    """
+    return {'outbound': dict(outbound_settings),
+            'history': dict(history_settings),
+            'log': dict(log_settings),
+            'compression': dict(compression_settings),
+            'handshake': dict(handshake_settings),
+            'heartbeat': dict(heartbeat_settings),
+            'rate_limit': {'limits': dict(rate_limit_settings['limits']),
+                           'policy': rate_limit_settings['policy']},
+            'files': dict(file_settings)}
+
+
+def apply_settings(settings: dict):
+    """
+    Uses settings returned by current_settings.
+
+    Parameters:
+        settings (dict): Settings keyed by group
+    """
+    outbound_settings.update(settings['outbound'])
+    history_settings.update(settings['history'])
+    history.configure(**history_settings)
+    log_settings.update(settings['log'])
+    compression_settings.update(settings['compression'])
+    handshake_settings.update(settings['handshake'])
+    heartbeat_settings.update(settings['heartbeat'])
+    heartbeats.configure(**heartbeat_settings)
+    rate_limit_settings.update(settings['rate_limit'])
+    limiter.configure(**rate_limit_settings)
+    file_settings.update(settings['files'])
+
+
+def queue_stats(key: str, combine=sum):
+    """
+    Combines a counter of the outbound queues of every connected client.
+
+    Parameters:
+        key (str): Name of the counter in OutboundQueue.stats
+        combine (function): Combines the values, such as sum or max
+
+    Returns:
+        (int): The combined value
+    """
+    values = [c.outbound.stats()[key] for c in client_list.connections()
+              if c.outbound is not None]
+    return combine(values) if values else 0
+
+
+def queue_total(key: str):
+    """
+    Sums a counter of the outbound queues of every client, whether still
+    connected or removed.
+
+    Parameters:
+        key (str): Name of the counter in removed_queue_stats
+
+    Returns:
+        (int): The total
+    """
+    with open_lock:
+        return queue_stats(key) + removed_queue_stats[key]
+
+
+def log_stats(key: str):
+    return message_log.stats[key] if message_log else 0
+
+
+def compression_stats(key: str):
+    """
+    Sums a counter of the compression used by every connected client.
+
+    Parameters:
+        key (str): Name of the counter in Compression.stats
+
+    Returns:
+        (int): The total
+    """
+    return sum(c.compression.stats()[key] for c in client_list.connections()
+               if c.compression is not None)
+
+
+# Metrics, read with /stats or from --metrics-port
+registry = Registry()
+connections_total = registry.counter(
+    'chatroom_connections_total', 'Clients that have connected')
+accepts_total = registry.counter(
+    'chatroom_accepts_total', 'Connections accepted, before their handshake')
+handshake_failures = registry.counter(
+    'chatroom_handshake_failures_total',
+    'Connections closed before finishing their handshake, by reason')
+messages_in = registry.counter(
+    'chatroom_messages_received_total', 'Chat messages recieved, by room')
+bytes_in = registry.counter(
+    'chatroom_message_bytes_received_total',
+    'Bytes of chat message text recieved, by room')
+messages_out = registry.counter(
+    'chatroom_messages_sent_total',
+    'Room messages sent to clients, by room')
+bytes_out = registry.counter(
+    'chatroom_message_bytes_sent_total',
+    'Bytes of room message text sent to clients, by room')
+fanout_seconds = registry.histogram(
+    'chatroom_fanout_seconds',
+    'Time to send a room message to every client in the room')
+command_seconds = registry.histogram(
+    'chatroom_command_seconds', 'Time to handle a message, by command')
+throttled = registry.counter(
+    'chatroom_throttled_total',
+    'Messages over a rate limit, by kind, the limit hit and what was done')
+files_shared = registry.counter(
+    'chatroom_files_shared_total', 'Files uploaded and shared in a room')
+files_sent = registry.counter(
+    'chatroom_files_sent_total',
+    'Files sent to clients, by whether they were pushed or asked for')
+handshake_seconds = registry.histogram(
+    'chatroom_handshake_seconds',
+    'Time from accepting a client to it being greeted')
+registry.gauge('chatroom_handshakes_pending',
+               'Clients accepted that have not finished their handshake',
+               lambda: pending_handshakes)
+registry.gauge('chatroom_connections', 'Clients connected',
+               lambda: len(client_list.connections()))
+registry.gauge('chatroom_heartbeat_connections',
+               'Clients connected that answer pings',
+               lambda: len(heartbeats))
+registry.gauge('chatroom_heartbeat_pings_total',
+               'Pings sent to clients that had gone quiet',
+               lambda: heartbeats.stats['pings'], kind='counter')
+registry.gauge('chatroom_heartbeat_evictions_total',
+               'Clients disconnected for not answering pings',
+               lambda: heartbeats.stats['evicted'], kind='counter')
+registry.gauge('chatroom_send_queue_bytes',
+               'Bytes waiting to be sent to all clients',
+               lambda: queue_stats('queued_bytes'))
+registry.gauge('chatroom_send_queue_max_bytes',
+               'Most bytes waiting to be sent to one client',
+               lambda: queue_stats('queued_bytes', max))
+registry.gauge('chatroom_send_queue_dropped_frames_total',
+               'Frames dropped for clients that fell behind',
+               lambda: queue_total('frames_dropped'), kind='counter')
+registry.gauge('chatroom_frames_sent_total', 'Frames written to clients',
+               lambda: queue_total('frames_sent'), kind='counter')
+registry.gauge('chatroom_send_calls_total',
+               'Socket writes made to send frames to clients, each writing'
+               ' a batch of frames', lambda: queue_total('send_calls'),
+               kind='counter')
+registry.gauge('chatroom_file_bytes_sent_total', 'Bytes of files sent to'
+               ' clients', lambda: queue_total('file_bytes_sent'),
+               kind='counter')
+registry.gauge('chatroom_spool_files', 'Files and uploads in the spool',
+               lambda: len(spool) if spool else 0)
+registry.gauge('chatroom_spool_bytes', 'Bytes of files and uploads in the'
+               ' spool', lambda: spool.total_bytes if spool else 0)
+registry.gauge('chatroom_history_bytes',
+               'Bytes used by the recent messages kept for all rooms',
+               lambda: history.stats()['bytes'])
+registry.gauge('chatroom_history_messages',
+               'Recent messages kept for all rooms',
+               lambda: history.stats()['messages'])
+registry.gauge('chatroom_history_rooms', 'Rooms with recent messages kept',
+               lambda: history.stats()['rooms'])
+registry.gauge('chatroom_history_room_bytes',
+               'Bytes used by the recent messages kept for each room',
+               lambda: {(('room', room),): size
+                        for room, size in history.room_sizes().items()})
+registry.gauge('chatroom_history_evicted_total',
+               'Recent messages dropped to stay within the history limits',
+               lambda: history.stats()['evicted'], kind='counter')
+registry.gauge('chatroom_log_records_total',
+               'Messages written to the message log',
+               lambda: log_stats('records'), kind='counter')
+registry.gauge('chatroom_log_commits_total',
+               'Writes to the message log, each synced to disk',
+               lambda: log_stats('commits'), kind='counter')
+registry.gauge('chatroom_log_commit_seconds_total',
+               'Total time spent writing and syncing the message log',
+               lambda: log_stats('commit_seconds'), kind='counter')
+registry.gauge('chatroom_log_bytes', 'Bytes kept in the message log',
+               lambda: message_log.size() if message_log else 0)
+registry.gauge('chatroom_compression_raw_bytes',
+               'Bytes of messages sent to connected clients using'
+               ' compression, before compressing',
+               lambda: compression_stats('raw_bytes'))
+registry.gauge('chatroom_compression_wire_bytes',
+               'Bytes of messages sent to connected clients using'
+               ' compression, as sent',
+               lambda: compression_stats('wire_bytes'))
+registry.gauge('chatroom_compression_seconds',
+               'CPU time spent compressing and decompressing messages of'
+               ' connected clients',
+               lambda: (compression_stats('compress_seconds')
+                        + compression_stats('decompress_seconds')))
+registry.gauge('chatroom_rooms', 'Rooms with clients in, on every node',
+               lambda: len(directory.counts()))
+registry.gauge('chatroom_directory_pages_total',
+               'Pages of /rooms and /who sent, by whether they were cached',
+               lambda: {(('result', k),): v
+                        for k, v in directory.stats.items()},
+               kind='counter')
+registry.gauge('chatroom_broker_messages_total',
+               'Room messages published to and delivered by the broker',
+               lambda: {(('direction', k),): v
+                        for k, v in getattr(backend, 'stats', {}).items()},
+               kind='counter')
+
+
+def forget_room(room: str):
+    """
+    Drops the counters kept for a room that has been emptied. Clients choose
+    room names, so otherwise every room ever used would be kept and
+    written out on every scrape.
+
+    Parameters:
+        room (str): The room
+    """
+    for metric in (messages_in, bytes_in, messages_out, bytes_out):
+        metric.remove(room=room)
+
 
 def accept_connection(sock: socket):
     """
-    Accepts a connection given a socket object. If the initial connection
-    times out, (None, None) is returned. If the connection to get the clients
-    name times out after MAX_RETIRES, then the connection is aborted.
+    Accepts a connection given a socket object. The client's handshake is
+    left to its own thread, so a slow client does not hold up the clients
+    connecting after it. If the initial connection times out, or too many
+    clients are already connecting, (None, None) is returned.
 
     Parameters:
         sock (socket): The socket to connect to
 
     Returns:
-        (socket, tuple): A tuple containing the socket object
-            and address of the connecting process. Or None, None
-            if the connection times out.
+        (Connection, tuple): A tuple containing the connection and address
+            of the connecting process. Or None, None if the connection
+            times out.
     """
     try:
         conn, addr = sock.accept()
     except socket.timeout:
         return (None, None)
-    retries = 0
-    while True:
-        try:
-            client_name = mp.recv_msg_protocol(conn)
-            client_list.addToList(conn,
-                                  client_name,
-                                  DEFAULT_ROOM)
-            send_help(conn)
-            return (conn, addr)
-        except socket.timeout:
-            if retries < MAX_RETIRES:
-                retries += 1
-                print('Retrying...')
-            else:
-                # If the user takes too long to respond with a name
-                # close the connection
-                print(f"[CLOSING] {addr} took too long to respond")
-                conn.close()
-                return (None, None)
-
-
-def handle_client(conn: socket, addr: tuple):
+    if not begin_handshake():
+        conn.close()
+        return (None, None)
+    return (Connection(conn, next(conn_ids)), addr)
+
+
+def begin_handshake():
+    """
+    Counts a newly accepted client as connecting, unless max_pending
+    clients already are. Shared by all server engines.
+
+    Returns:
+        (boolean): True if the handshake may go ahead
+    """
+    global pending_handshakes
+    accepts_total.inc()
+    with handshake_lock:
+        if pending_handshakes < handshake_settings['max_pending']:
+            pending_handshakes += 1
+            return True
+    handshake_failures.inc(reason='rejected')
+    return False
+
+
+def end_handshake(accepted: float, failure: str = None):
+    """
+    Counts a client as no longer connecting, recording how long its
+    handshake took or why it failed. Shared by all server engines.
+
+    Parameters:
+        accepted (float): time.monotonic() when it was accepted
+        failure (str): Why the handshake failed, or None if it finished
+    """
+    global pending_handshakes
+    with handshake_lock:
+        pending_handshakes -= 1
+    if failure:
+        handshake_failures.inc(reason=failure)
+    else:
+        handshake_seconds.observe(time.monotonic() - accepted)
+
+
+def track_connection(conn: Connection):
+    """
+    Counts a newly accepted client as open, so it is handed over if another
+    process takes over. Shared by all server engines.
+    """
+    with open_lock:
+        open_connections.add(conn)
+
+
+def untrack_connection(conn: Connection):
+    with open_lock:
+        open_connections.discard(conn)
+
+
+def tracked_connections():
+    with open_lock:
+        return list(open_connections)
+
+
+def handshake(conn: Connection, addr: tuple, accepted: float):
+    """
+    Waits for a newly accepted client to send its name and greets it. The
+    client is closed if it has not sent its name within the handshake
+    timeout of being accepted.
+
+    Parameters:
+        conn (Connection): The newly accepted client
+        addr (tuple): Its address
+        accepted (float): time.monotonic() when it was accepted
+
+    Returns:
+        (boolean): True if the client was greeted
+    """
+    failure = 'error'
+    try:
+        msg_header, client_name = conn.recv_frame(
+            accepted + handshake_settings['timeout'])
+        # From now on reads wait for as long as the client is quiet, as
+        # the heartbeats find clients that have gone away
+        conn.sock.settimeout(None)
+        conn.outbound = BlockingOutboundQueue(**outbound_settings)
+        ConnectionWriter(conn, conn.outbound).start()
+        greet_client(conn, msg_header, client_name)
+        failure = None
+        return True
+    except socket.timeout:
+        # If the user takes too long to respond with a name
+        # close the connection
+        failure = 'timeout'
+        print(f"[CLOSING] {addr} took too long to respond")
+    except (OSError, ValueError):
+        # Client left, or sent a frame that was too large, before
+        # giving its name
+        failure = 'closed'
+        print(f"[CLOSING] {addr} closed before sending a name")
+    finally:
+        end_handshake(accepted, failure)
+    untrack_connection(conn)
+    conn.close()
+    return False
+
+
+def greet_client(conn: Connection, msg_header: dict, client_name: str):
+    """
+    Finishes setting up a new client once its name has been recieved.
+    Agrees the protocol version, compression, heartbeats and files if the
+    client listed the ones it supports, then adds it to the client list and
+    sends the help message followed by the recent messages of the default
+    room.
+    Shared by all server engines.
+
+    Parameters:
+        conn (Connection): The newly connected client
+        msg_header (dict): Header of the client's first message
+        client_name (str): Name the client sent
+    """
+    versions = msg_header.get('versions') if msg_header else None
+    conn.version = mp.negotiate(versions)
+    compression = None
+    if compression_settings['enabled']:
+        compression = mp.negotiate_compression(
+            msg_header.get('compression') if msg_header else None,
+            conn.version)
+    # Pings are frame types, so only clients on version 2 can answer them
+    heartbeat = (heartbeat_settings['interval'] if conn.version >= 2
+                 and msg_header.get('heartbeat') else None)
+    conn.files = bool(spool is not None and conn.version >= 2
+                      and msg_header.get('files'))
+    if versions:
+        # The accept itself is never compressed
+        conn.sendall(mp.create_accept(
+            conn.version, NAME, compression, heartbeat,
+            file_settings['max_bytes'] if conn.files else None))
+    if compression:
+        conn.compression = Compression(compression_settings['threshold'],
+                                       compression_settings['level'])
+    if heartbeat:
+        heartbeats.add(conn)
+    client_list.addToList(conn, client_name, DEFAULT_ROOM)
+    directory.join(conn.id, client_name, DEFAULT_ROOM)
+    connections_total.inc()
+    backend.publish_join(conn.id, client_name, DEFAULT_ROOM)
+    send_help(conn)
+    replay_history(conn, DEFAULT_ROOM)
+
+
+def start_client(conn: Connection, addr: tuple, greeted: bool = False):
+    """
+    Starts the thread that serves a client on the threaded engine. If the
+    server can be taken over, the client is given a handoff lock for its
+    thread to hold.
+
+    Parameters:
+        conn (Connection): The client
+        addr (tuple): Its address
+        greeted (boolean): Whether it has already been greeted
+    """
+    track_connection(conn)
+    if handoff_settings['path']:
+        conn.handoff_lock = threading.Lock()
+    thread = threading.Thread(target=handle_client,
+                              args=(conn, addr, conn.accepted, greeted))
+    thread.start()
+
+
+def handle_client(conn: socket, addr: tuple, accepted: float = None,
+                  greeted: bool = False):
     """
     Handles the client connection in a separate thread to the one that
-    accepts the connection. This thread will be responsible for processing
-    what the client sends.
+    accepts the connection. This thread will be responsible for the
+    client's handshake and then for processing what the client sends. If
+    the client has a handoff lock the thread holds it throughout, see
+    Connection.
 
     Parameter:
         conn (socket): The socket that the connection is using
         addr (tuple) : The host and port tuple
+        accepted (float): time.monotonic() when the client was accepted
+        greeted (boolean): Whether it was greeted by a server this one
+            took over from, so there is no handshake
 
     Returns:
         None
     """
-    print(f'[NEW CONNECTION] {addr} has connected')
-    sendMsg(conn, f'{client_list.getName(conn)} has entered the chat')
+    if conn.handoff_lock is None:
+        serve_client(conn, addr, accepted, greeted)
+        return
+    with conn.handoff_lock:
+        try:
+            serve_client(conn, addr, accepted, greeted)
+        except HandedOff:
+            # Served by another process now
+            pass
+
+
+def serve_client(conn: socket, addr: tuple, accepted: float = None,
+                 greeted: bool = False):
+    """
+    Greets a client, unless it already has been, then processes what it
+    sends until it disconnects. See handle_client.
+    """
+    if not greeted:
+        if not handshake(conn, addr, accepted or time.monotonic()):
+            return
+        print(f'[NEW CONNECTION] {addr} has connected')
+        print(f'[CONNECTIONS] There are {len(client_list.connections())}'
+              ' connections')
+        sendMsg(conn, client_list.getName(conn) + ENTERED)
 
     connected = True
     while connected:
         try:
-            msg = mp.recv_msg_protocol(conn)
-
-            # If msg is not a special message then send to all.
-            # Otherwise handle request based on input
-            if not msg:
-                # Do nothing if header was invalid
-                pass
-            if msg == HELP:
-                send_help(conn)
-            elif msg == DISCONNECT:
-                connected = False
+            connected = handle_frame(conn, *conn.recv_frame())
+            if not connected:
                 disconnect(conn)
-            elif re.match(MOVE_ROOM + "*", msg):
-                updateRoom(conn, msg)
-            elif msg == LEAVE_ROOM:
-                leaveRoom(conn)
-            elif msg == ROOM_DETAILS:
-                sendRoomDetails(conn)
-            else:
-                sendMsg(conn, msg)
-        except socket.timeout:
-            # Ignore timeouts
-            pass
+            pause = conn.paused_until - time.monotonic()
+            if pause > 0:
+                # Over a rate limit, stop reading until back under it
+                with conn.unlocked():
+                    time.sleep(pause)
         except ConnectionResetError:
             # This error can be thrown when the client disconnects
             connected = False
@@ -115,18 +576,413 @@ def handle_client(conn: socket, addr: tuple):
             # Can happen if server shutsdown connction
             connected = False
             disconnect(conn)
+        except ValueError:
+            # Frame was too large or had a bad length, so the rest of the
+            # stream can't be read
+            connected = False
+            disconnect(conn)
+
 
+def handle_frame(conn: socket, msg_header: dict, msg: str):
+    """
+    Processes a frame from a client, noting that the client was heard from.
+    Pings are answered and pongs need nothing more, uploads are passed on
+    to the spool, anything else is a message. Shared by all server engines.
+
+    Parameters:
+        conn (socket): The client that sent the frame
+        msg_header (dict): Header of the frame, or None if it was invalid
+        msg (str): The message in the frame, bytes for a CHUNK
+
+    Returns:
+        (boolean): False if the client asked to disconnect
+    """
+    conn.last_heard = time.monotonic()
+    msg_type = msg_header.get('type', mp.MSG) if msg_header else mp.MSG
+    if msg_type == mp.PING:
+        conn.sendall(mp.create_ping(conn.version, pong=True))
+    elif msg_type == mp.CHUNK:
+        receive_chunk(conn, msg)
+    elif msg_type == mp.UPLOAD:
+        action = throttle(conn, SEND_FILE)
+        if action is not None:
+            conn.sendall(mp.create_control(conn.version, mp.UPLOAD_READY,
+                                           error='Sending too fast'))
+            return action == DROP
+        start_upload(conn, msg)
+    elif msg_type != mp.PONG:
+        command = command_of(msg)
+        action = throttle(conn, command)
+        if action is not None:
+            # Dropped, or the client is to be disconnected
+            return action == DROP
+        return handle_message(conn, msg, command)
+    return True
+
+
+def throttle(conn: socket, command: str):
+    """
+    Counts a message against the client's and its room's rate limits. Over
+    a limit, the delay policy lets the message through but sets when the
+    client may be read from again, which each engine waits for before
+    reading its next frame. Disconnecting is never limited.
+
+    Parameters:
+        conn (socket): The client that sent the message
+        command (str): What the message is, from command_of
 
-def sendRoomDetails(conn: socket):
+    Returns:
+        (str): None if the message should be handled, otherwise DROP if it
+            was dropped or the policy if the client is to be disconnected
+    """
+    if command in (DISCONNECT, 'invalid'):
+        return None
+    kind = 'chat' if command == 'chat' else 'command'
+    wait, scope = limiter.check(conn, client_list.getConnRoom(conn), kind)
+    if not wait:
+        conn.throttle_noticed = False
+        return None
+    policy = limiter.policy
+    throttled.inc(kind=kind, scope=scope, action=policy)
+    if policy == DELAY:
+        conn.paused_until = time.monotonic() + wait
+        return None
+    if policy != DROP:
+        print(f'[THROTTLING] Disconnecting {client_list.getName(conn)},'
+              f' over the {scope} {kind} limit')
+    elif not conn.throttle_noticed:
+        # Once for each run of messages over the limit
+        conn.throttle_noticed = True
+        limit = 'the room is' if scope == 'room' else 'you are'
+        conn.send_msg(f'Slow down, {limit} sending too fast. Messages are'
+                      ' being dropped', NAME)
+    return policy
+
+
+def send_ping(conn: socket):
+    conn.sendall(mp.create_ping(conn.version))
+
+
+def evict_client(conn: socket):
     """
-    Sends the list of clients and rooms to the given connection.
+    Disconnects a client that has stopped answering pings. Whatever is
+    reading from the connection then removes the client as if it had left.
+
+    Parameters:
+        conn (socket): The client
+    """
+    print(f'[EVICTING] {client_list.getName(conn)} stopped answering pings')
+    conn.abort()
+
+
+def start_upload(conn: socket, msg: str):
+    """
+    Starts recieving a file from a client, or carries on with one that was
+    cut off, and tells the client where in the file to send from. A client
+    sends one file at a time, so an upload it left unfinished is dropped
+    but kept in the spool to be resumed.
+
+    Parameters:
+        conn (socket): The client sending the file
+        msg (str): The UPLOAD frame, json holding the file's name and size
+            and the id of the upload to resume, if it is one
+    """
+    if conn.upload is not None:
+        conn.upload.close()
+        conn.upload = None
+    try:
+        if not conn.files:
+            raise ValueError('Files are not enabled')
+        request = json.loads(msg)
+        conn.upload = spool.begin(client_list.getName(conn),
+                                  str(request['name']), int(request['size']),
+                                  request.get('id'))
+    except (ValueError, KeyError, TypeError, OSError) as e:
+        conn.sendall(mp.create_control(conn.version, mp.UPLOAD_READY,
+                                       error=str(e)))
+        return
+    conn.sendall(mp.create_control(conn.version, mp.UPLOAD_READY,
+                                   id=conn.upload.id,
+                                   offset=conn.upload.received))
+    if conn.upload.complete:
+        # Nothing left to send, such as an empty file
+        receive_chunk(conn, b'')
+
+
+def receive_chunk(conn: socket, data: bytes):
+    """
+    Adds the next part of the file a client is sending to the spool, and
+    shares the file once all of it has arrived. Chunks that come after an
+    upload failed are ignored.
+
+    Parameters:
+        conn (socket): The client sending the file
+        data (bytes): The chunk
+    """
+    upload = conn.upload
+    if upload is None:
+        return
+    try:
+        if not upload.write(data):
+            return
+        conn.upload = None
+        info = spool.finish(upload, client_list.getConnRoom(conn))
+    except (ValueError, OSError) as e:
+        conn.upload = None
+        upload.close()
+        conn.send_msg(f'Could not recieve {upload.info["name"]}: {e}', NAME)
+        return
+    share_file(conn, info)
+
+
+def share_file(conn: socket, info: dict):
+    """
+    Tells the room a client has shared a file. Files of up to push_bytes
+    are sent straight away to the other clients in the room on this server
+    that can recieve them, larger ones only to clients that ask for them.
+
+    Parameters:
+        conn (socket): The client that shared it
+        info (dict): The file, from FileSpool.lookup
+    """
+    files_shared.inc()
+    sendMsg(conn, f'Shared {info["name"]} ({format_bytes(info["size"])}),'
+            f' {GET_FILE} {info["id"]} to download')
+    if info['size'] > file_settings['push_bytes']:
+        return
+    for c in client_list.connectionsInRoom(info['room']):
+        if c is not conn and c.files:
+            send_file(c, info, mode='push')
+
+
+def send_file(conn: socket, info: dict, offset: int = 0,
+              mode: str = 'get'):
+    """
+    Sends a file from the spool to a client. The FILE frame describing it
+    is queued with the client's other frames and the contents follow in
+    slices, sent with sendfile between them.
+
+    Parameters:
+        conn (socket): The client
+        info (dict): The file, from FileSpool.lookup
+        offset (int): Where in the file to start, to carry on with a
+            download that was cut off
+        mode (str): 'push' or 'get', for the metrics
+    """
+    file_id = info['id']
+    try:
+        transfer = FileTransfer(
+            info['path'], offset, info['size'],
+            lambda count: mp.create_file_data(file_id, count),
+            file_settings['chunk_bytes'])
+    except OSError:
+        # Removed from the spool since it was looked up
+        conn.send_msg(f'File {file_id} is no longer available', NAME)
+        return
+    conn.sendall(mp.create_control(conn.version, mp.FILE, file_id,
+                                   id=file_id, name=info['name'],
+                                   size=info['size'], offset=offset,
+                                   sender=info['sender']))
+    conn.send_file(transfer)
+    files_sent.inc(mode=mode)
+
+
+def sendFile(conn: socket, query: str = ''):
+    """
+    Sends a file shared in the client's room to the given connection, from
+    an offset if one is given.
+
+    Paramters:
+        conn (socket): Connection to send the file to
+        query (str): What followed the command, the file's id and an
+            optional offset
+    """
+    args = query.split()
+    try:
+        file_id = int(args[0])
+        offset = int(args[1]) if len(args) > 1 else 0
+    except (IndexError, ValueError):
+        conn.send_msg(f'Usage: {GET_FILE} Id [Offset]', NAME)
+        return
+    if not conn.files:
+        conn.send_msg('Your client cannot recieve files', NAME)
+        return
+    info = spool.lookup(file_id)
+    # Only clients in the room it was shared in may download it
+    if info is None or info['room'] != client_list.getConnRoom(conn):
+        conn.send_msg(f'There is no file {file_id} in this room', NAME)
+    elif not 0 <= offset <= info['size']:
+        conn.send_msg(f'{info["name"]} is only {info["size"]} bytes', NAME)
+    else:
+        send_file(conn, info, offset)
+
+
+def format_bytes(size: int):
+    for unit in ('bytes', 'KB', 'MB'):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'GB'
+    return f'{size:.0f} {unit}' if unit == 'bytes' else f'{size:.1f} {unit}'
+
+
+def command_of(msg: str):
+    """
+    Works out which command a message from a client is.
+
+    Parameters:
+        msg (str): The message
+
+    Returns:
+        (str): The command, such as HELP, 'chat' for a message to the room
+            or 'invalid' if the header was invalid
+    """
+    if not msg:
+        return 'invalid'
+    if msg in (HELP, DISCONNECT):
+        return msg
+    if re.match(MOVE_ROOM + "*", msg):
+        return MOVE_ROOM
+    if msg in (LEAVE_ROOM, STATS):
+        return msg
+    first = msg.split(' ', 1)[0]
+    if first in (ROOM_DETAILS, WHO, GET_FILE, SEND_FILE):
+        return first
+    return 'chat'
+
+
+def handle_message(conn: socket, msg: str, command: str = None):
+    """
+    Processes a single message from a client. If the message is not a
+    special message then it is sent to everyone in the room. Otherwise the
+    request is handled based on the input. The time taken is recorded for
+    each command. Shared by all server engines.
+
+    Parameters:
+        conn (socket): The client that sent the message
+        msg (str): The message that was sent
+        command (str): What the message is, if command_of has already been
+            called for it
+
+    Returns:
+        (boolean): False if the client asked to disconnect
+    """
+    start = time.perf_counter()
+    command = command or command_of(msg)
+    if command == HELP:
+        send_help(conn)
+    elif command == DISCONNECT:
+        command_seconds.observe(time.perf_counter() - start,
+                                command=DISCONNECT)
+        return False
+    elif command == MOVE_ROOM:
+        updateRoom(conn, msg)
+    elif command == LEAVE_ROOM:
+        leaveRoom(conn)
+    elif command == ROOM_DETAILS:
+        sendRoomDetails(conn, msg[len(ROOM_DETAILS):])
+    elif command == WHO:
+        sendWho(conn, msg[len(WHO):])
+    elif command == STATS:
+        sendStats(conn)
+    elif command == GET_FILE:
+        sendFile(conn, msg[len(GET_FILE):])
+    elif command == SEND_FILE:
+        # Clients that can send files never send the command itself
+        conn.send_msg('Your client cannot send files', NAME)
+    elif command == 'chat':
+        room = client_list.getConnRoom(conn)
+        messages_in.inc(room=room)
+        bytes_in.inc(len(msg.encode()), room=room)
+        sendMsg(conn, msg)
+    command_seconds.observe(time.perf_counter() - start, command=command)
+    return True
+
+
+def sendRoomDetails(conn: socket, query: str = ''):
+    """
+    Sends a page of the rooms, with the number of clients in each, to the
+    given connection. Includes the clients connected to other nodes.
 
     Paramters:
         conn (socket): Connection to send list to
+        query (str): What followed the command, an optional prefix of the
+            rooms to list and page number
+    """
+    prefix, page = split_page(query)
+    conn.send_msg(directory.rooms_page(prefix, page), NAME)
+
+
+def sendWho(conn: socket, query: str = ''):
+    """
+    Sends a page of the clients in a room to the given connection. The
+    client's own room is used if no room is named.
+
+    Paramters:
+        conn (socket): Connection to send list to
+        query (str): What followed the command, the room and an optional
+            page number
+    """
+    room, page = query.strip(), 1
+    if room not in directory:
+        # Unless the whole name is a room, it may end with a page number
+        room, page = split_page(query)
+    conn.send_msg(directory.who_page(room or client_list.getConnRoom(conn),
+                                     page), NAME)
+
+
+def is_admin(conn: socket):
+    """
+    Admin commands are only accepted from clients on the same machine as
+    the server.
+
+    Parameters:
+        conn (socket): The client to check
+
+    Returns:
+        (boolean): True if the client may use admin commands
+    """
+    try:
+        host = conn.sock.getpeername()[0]
+        return ipaddress.ip_address(host).is_loopback
+    except (OSError, ValueError, TypeError):
+        return False
+
+
+def sendStats(conn: socket):
+    """
+    Sends the server's metrics to the given connection as tables, the
+    counters first then the estimated percentiles of each histogram.
+
+    Paramters:
+        conn (socket): Connection to send the metrics to
     """
-    data = tabulate([list(e.values())[1:] for e in client_list.getList()],
-                    headers=client_list.getList()[0].keys())
-    mp.send_msg_protocol(conn, data, NAME)
+    if not is_admin(conn):
+        conn.send_msg(f'{STATS} is only available on the server', NAME)
+        return
+    # Only loaded when asked for, it takes longer to import than the rest
+    # of the server
+    from tabulate import tabulate
+    values = []
+    timings = []
+    for metric in registry.metrics():
+        if isinstance(metric, Histogram):
+            for key, s in sorted(metric.summary().items()):
+                timings.append([metric.name, format_key(key), s['count'],
+                                s['mean'] * 1000, s['p50'] * 1000,
+                                s['p99'] * 1000])
+        else:
+            for _, key, value in sorted(metric.samples()):
+                values.append([metric.name, format_key(key), value])
+    data = tabulate(values, headers=['Metric', 'Labels', 'Value'])
+    data += '\n\n' + tabulate(timings, floatfmt='.3f', headers=[
+        'Timing', 'Labels', 'Count', 'Mean ms', 'p50 ms', 'p99 ms'])
+    conn.send_msg(data, NAME)
+
+
+def format_key(key: tuple):
+    return ' '.join(f'{name}={value}' for name, value in key)
 
 
 def sendMsg(conn: socket, msg: str):
@@ -139,12 +995,10 @@ def sendMsg(conn: socket, msg: str):
         msg (str): The message to send
     """
     current_chat_room = client_list.getConnRoom(conn)
-    send_list = client_list.connectionsInRoom(current_chat_room)
-    send_list.remove(conn)
-    if send_list:
-        for c in send_list:
-            mp.send_msg_protocol(c, f'{client_list.getName(conn)}:\n {msg}',
-                                 NAME)
+    text = f'{client_list.getName(conn)}:\n {msg}'
+    if message_log:
+        message_log.append(current_chat_room, conn.id, text.encode())
+    backend.publish_chat(current_chat_room, text, conn.id)
 
 
 def disconnect(conn: socket):
@@ -156,15 +1010,56 @@ def disconnect(conn: socket):
         conn (socket): Connection to close
     """
     print(f'[DISCONNECTION] {client_list.getName(conn)} has disconnected')
-    # Note minus two as currnet thread is yet to close
-    print(f'[CONNECTIONS] There are {threading.activeCount() - 2}'
+    remove_client(conn)
+    print(f'[CONNECTIONS] There are {len(client_list.connections())}'
           ' connections')
-    leaveRoom(conn)
-    client_list.removeFromList(conn)
-    conn.close()
     sys.exit()  # Exit the current thread
 
 
+def remove_client(conn: socket):
+    """
+    Takes the connection out of its room, removes it from the client list
+    and closes it. Shared by all server engines.
+
+    Parameters:
+        conn (socket): Connection to remove
+    """
+    untrack_connection(conn)
+    heartbeats.remove(conn)
+    if conn.upload is not None:
+        # Kept in the spool, so the client can resume it
+        conn.upload.close()
+        conn.upload = None
+    leaveRoom(conn, replay=False)
+    with open_lock:
+        # Together, so the totals are never read with the client counted
+        # twice or not at all
+        client_list.removeFromList(conn)
+        if conn.outbound is not None:
+            stats = conn.outbound.stats()
+            for key in removed_queue_stats:
+                removed_queue_stats[key] += stats[key]
+    directory.leave(conn.id)
+    backend.publish_leave(conn.id)
+    conn.close()
+    if conn.compression is not None and conn.compression.raw_bytes:
+        report_compression(conn)
+
+
+def report_compression(conn: socket):
+    """
+    Prints how much compression saved for a connection and what it cost.
+
+    Parameters:
+        conn (socket): The connection
+    """
+    stats = conn.compression.stats()
+    cpu = stats['compress_seconds'] + stats['decompress_seconds']
+    print(f'[COMPRESSION] {conn.id}: {stats["raw_bytes"]} bytes sent as'
+          f' {stats["wire_bytes"]} (ratio {stats["ratio"]:.2f},'
+          f' {stats["frames"]} frames compressed), {cpu * 1000:.1f}ms CPU')
+
+
 def send_help(conn: socket):
     """
     Sends the help message to the inputted connection. This message tells
@@ -173,15 +1068,10 @@ def send_help(conn: socket):
     Parmeters:
         conn (socket): The connection to send the message to
     """
-    help_message = ('Welcome to ChatRooms. The following commands'
-                    ' are currently supported:\n')
-    help_message += HELP_MESSAGE + '\n'
-    help_message += DISSCONNECT_MESSAGE + '\n'
-    help_message += MOVE_ROOM_MESSAGE + '\n'
-    help_message += LEAVE_ROOM_MESSAGE + '\n'
-    help_message += ROOM_DETAILS_MESSGAE + '\n'
+    lines = HELP_LINES + FILE_HELP if conn.files else HELP_LINES
+    help_message = WELCOME_MESSAGE + ''.join(line + '\n' for line in lines)
 
-    mp.send_msg_protocol(conn, help_message, NAME)
+    conn.send_msg(help_message, NAME)
 
 
 def updateRoom(conn: socket, chat_room: str):
@@ -198,35 +1088,583 @@ def updateRoom(conn: socket, chat_room: str):
     if new_room == client_list.getConnRoom(conn):
         # If you're moving into the same room, do nothing
         pass
+    elif len(new_room) > MAX_ROOM_NAME:
+        msg = f'Room names can be at most {MAX_ROOM_NAME} characters.'
+        conn.send_msg(msg, NAME)
     elif not new_room == '':
-        leaveRoom(conn)
-        client_list.updateChatRoom(conn, new_room)
-        sendMsg(conn, f'{client_list.getName(conn)} has entered the chat')
+        # No need to replay the default room on the way through
+        leaveRoom(conn, replay=False)
+        move_client(conn, new_room)
+        sendMsg(conn, client_list.getName(conn) + ENTERED)
     else:
         msg = f'"{new_room}" is not a valid name.'
-        mp.send_msg_protocol(conn, msg, NAME)
+        conn.send_msg(msg, NAME)
 
 
-def leaveRoom(conn: socket):
+def leaveRoom(conn: socket, replay: bool = True):
     """
     Given a connection, it will leave it's current room and join the
     default room. If this function is called while in the DEFAULT_ROOM,
     it is assumed that you will be leaving it. So no need to send the
     "entered" message if that's the case.
+
+    Parameters:
+        conn (socket): The client leaving its room
+        replay (bool): Send the client the default room's recent messages
     """
-    sendMsg(conn, f'{client_list.getName(conn)} has left the chat')
+    sendMsg(conn, client_list.getName(conn) + LEFT)
     # If the client was already in the DEFAULT_ROOM, don't tell others
     # that you have entered (since you were already there).
     if not client_list.getConnRoom(conn) == DEFAULT_ROOM:
-        client_list.updateChatRoom(conn, DEFAULT_ROOM)
-        sendMsg(conn, f'{client_list.getName(conn)} has entered the chat')
+        move_client(conn, DEFAULT_ROOM, replay)
+        sendMsg(conn, client_list.getName(conn) + ENTERED)
 
 
-# Starts the server. Listens on the socket then awaits connections
-def main():
+def move_client(conn: socket, chat_room: str, replay: bool = True):
+    """
+    Changes the room of a connection in the client list, telling the other
+    workers if the server is sharded, and sends the client the room's
+    recent messages.
+
+    Parameters:
+        conn (socket): The client to move
+        chat_room (str): The room to move to
+        replay (bool): Send the client the room's recent messages
+    """
+    client_list.updateChatRoom(conn, chat_room)
+    directory.move(conn.id, chat_room)
+    backend.publish_move(conn.id, chat_room)
+    if replay:
+        replay_history(conn, chat_room)
+
+
+def replay_history(conn: socket, chat_room: str):
+    """
+    Sends a client joining a room the room's recent messages. They are
+    framed for the client's protocol version, marked as history, and sent
+    in a single write.
+
+    Parameters:
+        conn (socket): The client joining the room
+        chat_room (str): The room it joined
+    """
+    messages = history.recent(chat_room)
+    if messages:
+        conn.sendall(b''.join(
+            mp.encode_frame(body, NAME, conn.version, sender_id,
+                            mp.HISTORY, conn.compression, history=True)
+            for sender_id, body in messages))
+
+
+def deliver(chat_room: str, text: str, sender_id: int):
+    """
+    Sends a message published to a room to every client in the room on
+    this server, except the one that sent it, and keeps it in the room's
+    history. Called by the backend.
+
+    Parameters:
+        chat_room (str): Room the message was sent to
+        text (str): The message, already prefixed with the sender's name
+        sender_id (int): Id of the client that sent it
+    """
+    start = time.perf_counter()
+    # Encoded once, every recipient is sent the same frame
+    frame = SharedFrame(text, NAME, sender_id)
+    sent = 0
+    for c in client_list.connectionsInRoom(chat_room):
+        if c.id != sender_id:
+            frame.send_to(c)
+            sent += 1
+    if sent:
+        # Not counted for a room with nobody left in, whose counters may
+        # already have been dropped
+        messages_out.inc(sent, room=chat_room)
+        bytes_out.inc(sent * len(frame.body), room=chat_room)
+    history.append(chat_room, sender_id, frame.body)
+    fanout_seconds.observe(time.perf_counter() - start)
+
+
+def open_message_log(directory: str, replay: bool = True):
+    """
+    Starts keeping the messages sent to rooms by this server's clients in
+    a log on disk, using log_settings. The history of each room is filled
+    from the end of the log, so recent messages are still replayed to
+    joining clients after a restart.
+
+    Parameters:
+        directory (str): Directory of the log
+        replay (boolean): Fill the history from the log, not needed if it
+            was handed over by the server this one took over from
+    """
+    global message_log
+    message_log = MessageLog(
+        directory, segment_bytes=log_settings['segment_bytes'],
+        retention_seconds=log_settings['retention_seconds'],
+        retention_bytes=log_settings['retention_bytes'])
+    if message_log.stats['truncated']:
+        print(f'[STARTING] Cut {message_log.stats["truncated"]} bytes of an'
+              ' unfinished write from the end of the message log')
+    if not replay:
+        return
+    for _, chat_room, sender_id, body in message_log.replay(
+            last_bytes=history.total_bytes):
+        history.append(chat_room, sender_id, body)
+
+
+def open_spool(directory: str = None):
+    """
+    Starts accepting files, keeping them in a spool using file_settings.
+    Ids are given out from the backend's node id, like client ids, so
+    servers sharing a directory do not give out the same ones. Must be
+    called after use_backend.
+
+    Parameters:
+        directory (str): Directory to keep the files in, or None for a
+            temporary directory
+    """
+    global spool
+    first_id = (backend.node << NODE_ID_BITS) + 1
+    spool = FileSpool(directory, max_file_bytes=file_settings['max_bytes'],
+                      max_total_bytes=file_settings['spool_bytes'],
+                      first_id=first_id,
+                      last_id=first_id + 2**NODE_ID_BITS - 2)
+
+
+def use_backend(new_backend: RoomBackend):
+    """
+    Switches the backend that carries room messages. Client ids are then
+    started from the backend's node id, so they are unique across every
+    node sharing the backend.
+
+    Parameters:
+        new_backend (RoomBackend): The backend to use
+    """
+    global backend, conn_ids
+    backend = new_backend
+    conn_ids = itertools.count((backend.node << NODE_ID_BITS) + 1)
+
+
+def session_state(conn: Connection):
+    """
+    Describes a client for a process taking over from this one, which
+    carries on serving it from where this one stopped. Must only be called
+    once the client is no longer being read from. A file it is uploading
+    is left in the spool for the new process to carry on with.
+
+    Parameters:
+        conn (Connection): The client
+
+    Returns:
+        (dict): What the new process needs to know, see restore_session
+    """
+    state = {'id': conn.id, 'age': time.monotonic() - conn.accepted,
+             'name': client_list.getName(conn),
+             'room': client_list.getConnRoom(conn),
+             'version': conn.version,
+             'compression': conn.compression is not None,
+             'heartbeat': conn in heartbeats, 'files': conn.files,
+             'upload': None}
+    if conn.upload is not None:
+        info = conn.upload.info
+        state['upload'] = {key: info[key]
+                           for key in ('id', 'name', 'size', 'sender')}
+        conn.upload.close()
+        conn.upload = None
+    return state
+
+
+def send_sessions(channel: handoff.Channel, sessions: list):
+    """
+    Sends clients to the process taking over from this one, with their
+    sockets and what they have sent that has not been handled yet.
+    Shared by all server engines.
+
+    Parameters:
+        channel (Channel): Channel to the new process
+        sessions (list): (Connection, unhandled bytes) tuples
+    """
+    for start in range(0, len(sessions), handoff.MAX_FDS):
+        batch = sessions[start:start + handoff.MAX_FDS]
+        states = []
+        for conn, pending in batch:
+            state = session_state(conn)
+            state['pending'] = len(pending)
+            states.append(state)
+        channel.send({'type': 'sessions', 'sessions': states},
+                     b''.join(pending for _, pending in batch),
+                     [conn.fileno() for conn, _ in batch])
+
+
+def finish_hand_off(channel: handoff.Channel, started: float, clients: int):
+    """
+    Sends the process taking over from this one the recent messages of
+    each room and the next client id, then exits. The clients' sockets
+    belong to the new process now, so the process exits without any of
+    the clean up that would shut them down or remove the spool. Shared by
+    all server engines.
+
+    Parameters:
+        channel (Channel): Channel to the new process
+        started (float): time.monotonic() when the handoff started
+        clients (int): Clients handed over
+    """
+    messages = history.export()
+    channel.send({'type': 'history',
+                  'messages': [[chat_room, sender_id, len(body)]
+                               for chat_room, sender_id, body in messages]},
+                 b''.join(body for _, _, body in messages))
+    if message_log:
+        # Everything appended is written before the new process opens it
+        message_log.close()
+    channel.send({'type': 'done', 'next_id': next(conn_ids),
+                  'spool': {'directory': spool.directory,
+                            'temporary': spool.temporary}
+                  if spool else None})
+    print(f'[HANDOFF] Handed over {clients} clients in'
+          f' {(time.monotonic() - started) * 1000:.1f}ms')
+    sys.stdout.flush()
+    os._exit(0)
+
+
+def hand_off(channel: handoff.Channel, sock: socket):
+    """
+    Hands the listening socket and every client to a process taking over
+    from this one, then exits. Runs on the threaded engine's accept loop,
+    so no client is accepted meanwhile. Each client is taken between
+    frames, by taking its handoff lock once its thread is waiting for it,
+    and handed over once everything queued for it has been written, so the
+    new process carries on exactly where this one stopped. Files being
+    sent are dropped, the clients can ask for the rest, and clients whose
+    frames are not written within drain_timeout are disconnected.
+
+    Parameters:
+        channel (Channel): Channel to the new process
+        sock (socket): The listening socket
+    """
+    started = time.monotonic()
+    print('[HANDOFF] Handing over to a new server')
+    channel.send({'type': 'listener'}, fds=[sock.fileno()])
+    heartbeats.stop()
+    conns = tracked_connections()
+    for c in conns:
+        c.handoff_lock.acquire()
+    # Some may have left while their locks were being taken
+    still_open = set(tracked_connections())
+    conns = [c for c in conns if c in still_open]
+    for c in conns:
+        if c.outbound is not None:
+            c.outbound.drop_files()
+    deadline = started + handoff_settings['drain_timeout']
+    sessions = []
+    for c in conns:
+        if (c.outbound is None
+                or c.outbound.wait_idle(max(0, deadline - time.monotonic()))):
+            c.handed_off = True
+            sessions.append((c, c.decoder.take_pending()))
+        else:
+            print(f'[HANDOFF] Disconnecting {client_list.getName(c)},'
+                  ' its messages could not be sent in time')
+            c.abort()
+    send_sessions(channel, sessions)
+    finish_hand_off(channel, started, len(sessions))
+
+
+def take_over(channel: handoff.Channel):
+    """
+    Recieves the listening socket, clients and recent messages of the
+    server this process is taking over from. Returns once that server has
+    exited, so its message log is closed and nothing else is read from
+    the clients.
+
+    Parameters:
+        channel (Channel): Channel from handoff.connect
+
+    Returns:
+        (socket, list, dict): The listening socket, or None if the server
+            exited without sending it, (state, unhandled bytes, socket)
+            for each client, see restore_session, and the directory of
+            the server's spool and whether it was temporary, or None
+    """
+    global conn_ids
+    listener = None
+    sessions = []
+    done = {'next_id': None, 'spool': None}
+    for msg, data, fds in channel:
+        if msg['type'] == 'listener':
+            listener = socket.socket(fileno=fds[0])
+        elif msg['type'] == 'sessions':
+            offset = 0
+            for state, fd in zip(msg['sessions'], fds):
+                pending = data[offset:offset + state['pending']]
+                offset += state['pending']
+                sessions.append((state, pending, socket.socket(fileno=fd)))
+        elif msg['type'] == 'history':
+            offset = 0
+            for chat_room, sender_id, size in msg['messages']:
+                history.append(chat_room, sender_id,
+                               data[offset:offset + size])
+                offset += size
+        elif msg['type'] == 'done':
+            done = msg
+    channel.close()
+    if done['next_id'] is None:
+        print('[HANDOFF] The old server stopped part way through handing'
+              ' over')
+    ids = [state['id'] + 1 for state, _, _ in sessions]
+    next_id = max(ids + [done['next_id'] or 0])
+    if next_id:
+        conn_ids = itertools.count(next_id)
+    return (listener, sessions, done['spool'])
+
+
+def restore_session(conn: Connection, state: dict, pending: bytes):
+    """
+    Sets up a client handed over by the server this process took over
+    from as it was there. A client that had been greeted is put back in
+    its room without telling the room, and a file it was uploading is
+    carried on with. Shared by all server engines.
+
+    Parameters:
+        conn (Connection): The client, on the socket that was handed over
+        state (dict): Its state, from session_state
+        pending (bytes): What it sent that had not been handled yet
+
+    Returns:
+        (boolean): True if it had been greeted, False if it has still to
+            send its name
+    """
+    conn.accepted = time.monotonic() - state['age']
+    conn.version = state['version']
+    conn.decoder.feed(pending)
+    if state['name'] is None:
+        return False
+    if state['compression']:
+        # Kept even if compression is not offered now, as the client may
+        # send compressed frames
+        conn.compression = Compression(compression_settings['threshold'],
+                                       compression_settings['level'])
+    conn.files = state['files'] and spool is not None
+    client_list.addToList(conn, state['name'], state['room'])
+    directory.join(conn.id, state['name'], state['room'])
+    if state['heartbeat']:
+        heartbeats.add(conn)
+    upload = state['upload']
+    if upload is not None and conn.files:
+        try:
+            conn.upload = spool.begin(upload['sender'], upload['name'],
+                                      upload['size'], upload['id'])
+        except (ValueError, OSError):
+            pass
+    return True
+
+
+def adopt_sessions(sessions: list):
+    """
+    Carries on serving the clients handed over by the server this process
+    took over from, on the threaded engine. Every client is put back
+    before any is served, so the messages they had sent reach the others.
+
+    Parameters:
+        sessions (list): (state, unhandled bytes, socket) for each client,
+            from take_over
+    """
+    adopted = []
+    for state, pending, sock in sessions:
+        # The socket may have been non-blocking in the old process
+        sock.settimeout(None)
+        conn = Connection(sock, state['id'])
+        greeted = state['name'] is not None
+        if greeted:
+            conn.outbound = BlockingOutboundQueue(**outbound_settings)
+            ConnectionWriter(conn, conn.outbound).start()
+        elif not begin_handshake():
+            conn.close()
+            continue
+        restore_session(conn, state, pending)
+        adopted.append((conn, greeted))
+    for conn, greeted in adopted:
+        try:
+            addr = conn.sock.getpeername()
+        except OSError:
+            # Gone already, its thread will find out
+            addr = None
+        start_client(conn, addr, greeted)
+
+
+def parse_args(argv=None):
+    """
+    Parses the command line arguments of the server.
+
+    Parameters:
+        argv (list): Arguments to parse, defaults to sys.argv
+
+    Returns:
+        (Namespace): The parsed arguments
+    """
+    parser = argparse.ArgumentParser(description='ChatRoom server')
+    parser.add_argument('--engine', choices=ENGINES, default=ENGINES[0],
+                        help='threaded starts a thread per client, asyncio'
+                        ' serves every client from one event loop')
+    parser.add_argument('--host', default=None,
+                        help='Address to listen on (default: local ip)')
+    parser.add_argument('--port', type=int, default=None,
+                        help='Port to listen on (asked for if not given)')
+    parser.add_argument('--queue-high', type=int,
+                        default=outbound_settings['high_watermark'],
+                        help='Bytes queued for a client before it is'
+                        ' treated as a slow consumer')
+    parser.add_argument('--queue-low', type=int,
+                        default=outbound_settings['low_watermark'],
+                        help='Bytes a paused sender waits for the queue'
+                        ' to drain to')
+    parser.add_argument('--slow-consumer', choices=POLICIES,
+                        default=outbound_settings['policy'],
+                        help='What to do when a client falls behind')
+    parser.add_argument('--flush-delay', type=float,
+                        default=outbound_settings['flush_delay'] * 1000,
+                        help='Milliseconds to wait for more frames before'
+                        ' sending to a client')
+    parser.add_argument('--batch-bytes', type=int,
+                        default=outbound_settings['batch_bytes'],
+                        help='Most bytes sent to a client in one send')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes sharing the port, each'
+                        ' running the chosen engine')
+    parser.add_argument('--broker', default=None,
+                        help='host:port or Unix socket path of a broker'
+                        ' (python pubsub.py) to share rooms with other'
+                        ' servers through')
+    parser.add_argument('--history', type=int,
+                        default=history_settings['max_messages'],
+                        help='Recent messages kept for each room, 0 to keep'
+                        ' none')
+    parser.add_argument('--history-bytes', type=int,
+                        default=history_settings['max_bytes'],
+                        help='Most bytes of recent messages kept for each'
+                        ' room')
+    parser.add_argument('--history-total-bytes', type=int,
+                        default=history_settings['total_bytes'],
+                        help='Most bytes of recent messages kept for all'
+                        ' rooms together')
+    parser.add_argument('--replay', type=int,
+                        default=history_settings['replay'],
+                        help='Recent messages sent to a client joining a'
+                        ' room')
+    parser.add_argument('--log-dir', default=None,
+                        help='Directory to keep a log of room messages in,'
+                        ' so they survive restarts. With --workers, each'
+                        ' worker keeps its own log in a subdirectory')
+    parser.add_argument('--log-segment-bytes', type=int,
+                        default=log_settings['segment_bytes'],
+                        help='Size of each file of the message log')
+    parser.add_argument('--log-retention-hours', type=float, default=None,
+                        help='Remove logged messages older than this')
+    parser.add_argument('--log-retention-bytes', type=int, default=None,
+                        help='Remove the oldest logged messages once the'
+                        ' log is larger than this')
+    parser.add_argument('--spool-dir', default=None,
+                        help='Directory to keep shared files in (default: a'
+                        ' temporary directory). Servers sharing rooms'
+                        ' through a broker must share it for /get to find'
+                        ' files shared on another server')
+    parser.add_argument('--max-file-bytes', type=int,
+                        default=file_settings['max_bytes'],
+                        help='Largest file clients may share, 0 to turn'
+                        ' off sharing files')
+    parser.add_argument('--spool-bytes', type=int,
+                        default=file_settings['spool_bytes'],
+                        help='Most bytes of files kept, the oldest being'
+                        ' removed first')
+    parser.add_argument('--push-file-bytes', type=int,
+                        default=file_settings['push_bytes'],
+                        help='Files up to this size are sent to everyone'
+                        ' in the room, larger ones only on /get')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Port on 127.0.0.1 to serve metrics on in the'
+                        ' Prometheus text format. With --workers, worker n'
+                        ' uses the port plus n')
+    parser.add_argument('--handshake-timeout', type=float,
+                        default=handshake_settings['timeout'],
+                        help='Seconds a new client has to send its name')
+    parser.add_argument('--max-pending-handshakes', type=int,
+                        default=handshake_settings['max_pending'],
+                        help='Most clients connecting at once, others are'
+                        ' turned away until they have finished')
+    limits = rate_limit_settings['limits']
+    for kind, scope, flag, text in (
+            ('chat', 'client', '--chat-limit', 'Chat messages a client may'
+             ' send'),
+            ('chat', 'room', '--room-chat-limit', 'Chat messages the clients'
+             ' of a room may send between them'),
+            ('command', 'client', '--command-limit', 'Commands a client may'
+             ' send'),
+            ('command', 'room', '--room-command-limit', 'Commands the clients'
+             ' of a room may send between them')):
+        rate, burst = limits[(kind, scope)]
+        parser.add_argument(flag, type=parse_limit, default=(rate, burst),
+                            metavar='RATE[,BURST]',
+                            help=f'{text}, a second and at once. 0 for no'
+                            f' limit (default: {rate:g},{burst:g})')
+    parser.add_argument('--over-limit', choices=LIMIT_POLICIES,
+                        default=rate_limit_settings['policy'],
+                        help='What happens to a client over a limit: stop'
+                        ' reading from it for a while, drop its messages or'
+                        ' disconnect it')
+    parser.add_argument('--heartbeat-interval', type=float,
+                        default=heartbeat_settings['interval'],
+                        help='Seconds a client may be quiet before it is'
+                        ' pinged')
+    parser.add_argument('--heartbeat-timeout', type=float,
+                        default=heartbeat_settings['timeout'],
+                        help='Seconds a client may be quiet before it is'
+                        ' disconnected')
+    parser.add_argument('--compress-threshold', type=int,
+                        default=compression_settings['threshold'],
+                        help='Smallest message in bytes compressed for'
+                        ' clients that support compression')
+    parser.add_argument('--no-compression', action='store_true',
+                        help='Do not offer compression to clients')
+    parser.add_argument('--handoff', metavar='PATH', default=None,
+                        help='Unix socket a newer server can take over this'
+                        ' one on, keeping its port and clients. If a server'
+                        ' started with the same path is running, this one'
+                        ' takes over from it')
+    parser.add_argument('--handoff-drain-timeout', type=float,
+                        default=handoff_settings['drain_timeout'],
+                        help='Seconds to wait for messages queued for the'
+                        ' clients to be sent before handing them over')
+    args = parser.parse_args(argv)
+    if args.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error('--workers needs SO_REUSEPORT, which this platform'
+                     ' does not have')
+    if args.handoff and not handoff.SUPPORTED:
+        parser.error('--handoff needs Unix sockets that can pass file'
+                     ' descriptors, which this platform does not have')
+    if args.handoff and (args.workers > 1 or args.broker):
+        parser.error('--handoff cannot be used with --workers or --broker')
+    return args
+
+
+def bind_socket(host: str, port: int = None, reuse_port: bool = False):
+    """
+    Creates a socket bound to the given host. If no port is given the user
+    is asked for one until a free port is entered.
+
+    Parameters:
+        host (str): Address to bind to
+        port (int): Port to bind to, or None to ask the user
+        reuse_port (bool): Let other sockets bind to the same port
+
+    Returns:
+        (socket, tuple): The bound socket and its address
+    """
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    # Get host name on local network
-    host = socket.gethostbyname(socket.gethostname())
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if port is not None:
+        addr = (host, port)
+        sock.bind(addr)
+        return sock, addr
     port = 5000     # Default port is 5050
     addr = (host, port)
     success = False
@@ -245,19 +1683,46 @@ def main():
         except KeyboardInterrupt:
             print('[EXITING] Keyboard interrupt detected')
             exit()
-    sock.listen()
+    return sock, addr
+
+
+def serve_threaded(sock: socket, addr: tuple, sessions=()):
+    """
+    Runs the threaded engine. A new thread is started for every client
+    that connects. With a handoff path, a process asking to take over is
+    handed everything from the accept loop, which is woken for it.
+
+    Parameters:
+        sock (socket): The bound socket to listen on
+        addr (tuple): Address the socket is bound to
+        sessions (list): Clients handed over by the server this process
+            took over from, see take_over
+    """
+    sock.listen(socket.SOMAXCONN)
+    sock.settimeout(ACCEPT_TIMEOUT)
+    adopt_sessions(sessions)
+    heartbeats.start()
+    takeovers = []
+    wakeup, waker = socket.socketpair()
+
+    def request_hand_off(channel: handoff.Channel):
+        takeovers.append(channel)
+        waker.send(b'\0')
+
+    if handoff_settings['path']:
+        handoff.listen(handoff_settings['path'], request_hand_off)
     print(f'[STARTING] Server has started and is listening on {addr}')
     try:
         # Loops forever waiting from connections
-        while True:
+        while not takeovers:
+            ready, _, _ = select.select([sock, wakeup], [], [],
+                                        ACCEPT_TIMEOUT)
+            if sock not in ready:
+                continue
             conn, addr = accept_connection(sock)
             if conn:
-                thread = threading.Thread(target=handle_client,
-                                          args=(conn, addr))
-                thread.start()
-                # Minus one to ignore main thread
-                print(f'[CONNECTIONS] There are {threading.activeCount() - 1}'
-                      ' connections')
+                start_client(conn, addr)
+        hand_off(takeovers[0], sock)
     except KeyboardInterrupt:
         print('[EXITING] Keyboard interrupt detected')
     finally:
@@ -268,5 +1733,99 @@ def main():
         sock.close()
 
 
+# Starts the server. Listens on the socket then awaits connections
+def main():
+    args = parse_args()
+    outbound_settings.update(high_watermark=args.queue_high,
+                             low_watermark=args.queue_low,
+                             policy=args.slow_consumer,
+                             flush_delay=args.flush_delay / 1000,
+                             batch_bytes=args.batch_bytes)
+    history_settings.update(max_messages=args.history,
+                            max_bytes=args.history_bytes,
+                            total_bytes=args.history_total_bytes,
+                            replay=args.replay)
+    history.configure(**history_settings)
+    log_settings.update(
+        directory=args.log_dir, segment_bytes=args.log_segment_bytes,
+        retention_seconds=(args.log_retention_hours * 3600
+                           if args.log_retention_hours else None),
+        retention_bytes=args.log_retention_bytes)
+    compression_settings.update(enabled=not args.no_compression,
+                                threshold=args.compress_threshold)
+    handshake_settings.update(timeout=args.handshake_timeout,
+                              max_pending=args.max_pending_handshakes)
+    heartbeat_settings.update(interval=args.heartbeat_interval,
+                              timeout=args.heartbeat_timeout)
+    heartbeats.configure(**heartbeat_settings)
+    rate_limit_settings.update(
+        limits={('chat', 'client'): args.chat_limit,
+                ('chat', 'room'): args.room_chat_limit,
+                ('command', 'client'): args.command_limit,
+                ('command', 'room'): args.room_command_limit},
+        policy=args.over_limit)
+    limiter.configure(**rate_limit_settings)
+    file_settings.update(directory=args.spool_dir,
+                         max_bytes=args.max_file_bytes,
+                         spool_bytes=args.spool_bytes,
+                         push_bytes=args.push_file_bytes)
+    handoff_settings.update(path=args.handoff,
+                            drain_timeout=args.handoff_drain_timeout)
+    sock = None
+    sessions = []
+    old_spool = None
+    channel = handoff.connect(args.handoff) if args.handoff else None
+    if channel:
+        print('[HANDOFF] Taking over from the running server')
+        sock, sessions, old_spool = take_over(channel)
+        if sock:
+            addr = sock.getsockname()
+            print(f'[HANDOFF] Took over {addr} and {len(sessions)}'
+                  ' clients')
+    if sock is None:
+        # Get host name on local network
+        host = args.host or socket.gethostbyname(socket.gethostname())
+        sock, addr = bind_socket(host, args.port,
+                                 reuse_port=args.workers > 1)
+    broker = parse_address(args.broker) if args.broker else None
+    if args.workers > 1:
+        # The port is free, each worker binds its own socket to it
+        sock.close()
+        import sharding
+        sharding.serve_sharded(addr, args.workers, args.engine, broker,
+                               args.metrics_port)
+        return
+    if broker:
+        use_backend(BrokerBackend(broker, deliver, directory))
+    if args.metrics_port is not None:
+        serve_metrics(registry, args.metrics_port)
+        print(f'[STARTING] Metrics are served on port {args.metrics_port}')
+    if args.log_dir:
+        # The history came with the clients from the old server
+        open_message_log(args.log_dir, replay=not channel)
+    if file_settings['max_bytes']:
+        if file_settings['directory'] is None and old_spool:
+            # Carry on with the old server's files and uploads
+            open_spool(old_spool['directory'])
+            spool.temporary = old_spool['temporary']
+        else:
+            open_spool(file_settings['directory'])
+    try:
+        if args.engine == 'asyncio':
+            # Imported here so the threaded engine does not need asyncio
+            import async_server
+            async_server.serve(sock, addr, sessions)
+        else:
+            serve_threaded(sock, addr, sessions)
+    finally:
+        if message_log:
+            message_log.close()
+        if spool:
+            spool.close()
+
+
 if __name__ == '__main__':
-    main()
+    # Run main from the importable module so that the engines, which import
+    # server, share its settings and client list
+    import server
+    server.main()
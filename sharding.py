@@ -0,0 +1,126 @@
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+import server
+from pubsub import Broker, BrokerBackend
+
+
+def bind_reuse_port(host: str, port: int):
+    """
+    Creates a socket bound with SO_REUSEPORT, so that every worker can
+    listen on the same port and the kernel shares connections between them.
+
+    Parameters:
+        host (str): Address to bind to
+        port (int): Port to bind to
+
+    Returns:
+        (socket): The bound socket
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def run_worker(worker: int, addr: tuple, engine: str, broker,
+               settings: dict, metrics_port: int = None):
+    """
+    Entry point of a worker process. Connects to the broker, then serves
+    clients on the shared port with the chosen engine.
+
+    Parameters:
+        worker (int): Number of this worker
+        addr (tuple): Host and port to listen on
+        engine (str): Engine to serve clients with
+        broker (str or tuple): Address of the broker
+        settings (dict): The server's settings, from current_settings
+        metrics_port (int): Port to serve metrics on, or None
+    """
+    server.apply_settings(settings)
+    log_settings = server.log_settings
+    server.use_backend(BrokerBackend(broker, server.deliver,
+                                     server.directory))
+    sock = bind_reuse_port(*addr)
+    if metrics_port is not None:
+        server.serve_metrics(server.registry, metrics_port)
+    if log_settings['directory']:
+        # Only one process may write to a log
+        server.open_message_log(os.path.join(log_settings['directory'],
+                                             f'worker-{worker}'))
+    if server.file_settings['max_bytes']:
+        # Shared by every worker, so /get finds files shared on any of them
+        server.open_spool(server.file_settings['directory'])
+    print(f'[WORKER {worker}] Started with pid {os.getpid()} as node'
+          f' {server.backend.node}')
+    try:
+        if engine == 'asyncio':
+            import async_server
+            async_server.serve(sock, addr)
+        else:
+            server.serve_threaded(sock, addr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.backend.close()
+        if server.message_log:
+            server.message_log.close()
+        if server.spool:
+            server.spool.close()
+
+
+def serve_sharded(addr: tuple, workers: int, engine: str, broker=None,
+                  metrics_port: int = None):
+    """
+    Runs a server as several worker processes listening on the same port.
+    Room membership and chat messages are shared between the workers
+    through a broker, so clients in the same room see each other whichever
+    worker they are connected to. Unless the address of a broker shared
+    with other servers is given, one is run in this process on a Unix
+    socket. Unless a directory for shared files is given, the workers share
+    a temporary one.
+
+    Parameters:
+        addr (tuple): Host and port to listen on
+        workers (int): Number of worker processes
+        engine (str): Engine the workers serve clients with
+        broker (str or tuple): Address of a broker to use, or None
+        metrics_port (int): Port the first worker serves metrics on, the
+            others using the ports after it, or None
+    """
+    local_broker = None
+    if broker is None:
+        broker_dir = tempfile.mkdtemp(prefix='chatroom-')
+        local_broker = Broker(os.path.join(broker_dir, 'broker.sock'))
+        local_broker.start()
+        broker = local_broker.addr
+    spool_dir = None
+    if server.file_settings['directory'] is None:
+        spool_dir = tempfile.mkdtemp(prefix='chatroom-files-')
+        server.file_settings['directory'] = spool_dir
+    processes = [multiprocessing.Process(
+                     target=run_worker,
+                     args=(worker, addr, engine, broker,
+                           server.current_settings(),
+                           None if metrics_port is None
+                           else metrics_port + worker),
+                     daemon=True)
+                 for worker in range(workers)]
+    for process in processes:
+        process.start()
+    print(f'[STARTING] {workers} workers are listening on {addr}')
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        print('[EXITING] Keyboard interrupt detected')
+        for process in processes:
+            process.join()
+    finally:
+        if local_broker:
+            local_broker.close()
+            os.rmdir(broker_dir)
+        if spool_dir:
+            shutil.rmtree(spool_dir, ignore_errors=True)
@@ -0,0 +1,93 @@
+import os
+import queue
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from pubsub import (BrokerBackend, CHAT, JOIN, WELCOME,  # noqa: E402
+                    encode_event)
+
+
+class FakeDirectory:
+    def __init__(self):
+        self.removed = []
+
+    def join(self, client_id, name, room):
+        pass
+
+    def remove_node(self, node, bits):
+        self.removed.append(node)
+
+
+class BrokerBackendTest(unittest.TestCase):
+    """
+    Runs a BrokerBackend against a socket standing in for the broker, so
+    the test decides which events it is sent.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        path = os.path.join(self.dir.name, 'broker')
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen()
+        accepted = []
+
+        def accept():
+            # The backend waits for its node id before returning
+            sock, _ = listener.accept()
+            sock.sendall(encode_event(WELCOME, 1))
+            accepted.append(sock)
+        thread = threading.Thread(target=accept)
+        thread.start()
+        self.delivered = queue.Queue()
+        self.directory = FakeDirectory()
+        self.backend = BrokerBackend(path, self.deliver, self.directory)
+        thread.join()
+        listener.close()
+        self.broker = accepted[0]
+
+    def tearDown(self):
+        self.backend.close()
+        self.broker.close()
+        self.dir.cleanup()
+
+    def deliver(self, room, text, sender_id):
+        if text == 'boom':
+            raise RuntimeError('deliver failed')
+        self.delivered.put((room, text, sender_id))
+
+    def test_bad_events_are_skipped(self):
+        self.broker.sendall(encode_event(CHAT, 2, room='General'))
+        self.broker.sendall(encode_event(
+            CHAT, 2, room='General', text='boom', sender=5))
+        self.broker.sendall(encode_event(
+            CHAT, 2, room='General', text='hi', sender=5))
+        self.assertEqual(self.delivered.get(timeout=5),
+                         ('General', 'hi', 5))
+        self.assertEqual(self.backend.stats['bad_events'], 2)
+        self.assertTrue(self.backend.connected)
+
+    def test_lost_broker_falls_back_to_local_delivery(self):
+        self.broker.sendall(encode_event(
+            JOIN, 2, id=(2 << 24) + 1, name='bo', room='General'))
+        self.broker.close()
+        self._wait_for(lambda: self.directory.removed)
+        self.assertFalse(self.backend.connected)
+        self.assertEqual(self.directory.removed, [2])
+        self.backend.publish_chat('General', 'still here', 7)
+        self.assertEqual(self.delivered.get(timeout=5),
+                         ('General', 'still here', 7))
+
+    def _wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ChatRoomHelpers import FrameDecoder  # noqa: E402
+from ChatRoomHelpers import MessageProtocol as mp  # noqa: E402
+
+
+def v1_header(length) -> bytes:
+    """
+    A version 1 header claiming the message is length bytes long.
+    """
+    header = json.dumps({'content-length': length, 'name': 'x'}).encode()
+    return header.ljust(mp.header_size(1))
+
+
+class FrameDecoderTest(unittest.TestCase):
+
+    def decode(self, data: bytes, version: int = 1):
+        decoder = FrameDecoder(version)
+        decoder.feed(data)
+        return decoder.next_frame()
+
+    def test_frame(self):
+        msg_header, msg = self.decode(mp.create_frame('hello', 'x'))
+        self.assertEqual(msg_header['content-length'], 5)
+        self.assertEqual(bytes(msg), b'hello')
+
+    def test_split_frame(self):
+        frame = mp.create_frame('hello', 'x', 2, 7)
+        decoder = FrameDecoder(2)
+        decoder.feed(frame[:4])
+        self.assertIsNone(decoder.next_frame())
+        decoder.feed(frame[4:])
+        msg_header, msg = decoder.next_frame()
+        self.assertEqual(msg_header['sender'], 7)
+        self.assertEqual(bytes(msg), b'hello')
+
+    def test_negative_length(self):
+        # Would otherwise decode the same frame forever
+        with self.assertRaisesRegex(ValueError, 'Bad content-length'):
+            self.decode(v1_header(-256) + b'x' * 256)
+
+    def test_float_length(self):
+        with self.assertRaisesRegex(ValueError, 'Bad content-length'):
+            self.decode(v1_header(5.0) + b'hello')
+
+    def test_string_length(self):
+        with self.assertRaisesRegex(ValueError, 'Bad content-length'):
+            self.decode(v1_header('5') + b'hello')
+
+    def test_header_without_length(self):
+        header = json.dumps({'name': 'x'}).encode()
+        with self.assertRaisesRegex(ValueError, 'Bad content-length'):
+            self.decode(header.ljust(mp.header_size(1)))
+
+    def test_too_large(self):
+        with self.assertRaisesRegex(ValueError, 'Frame too large'):
+            self.decode(v1_header(FrameDecoder.max_frame_size + 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
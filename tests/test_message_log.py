@@ -0,0 +1,39 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from message_log import MessageLog, encode_record, read_records  # noqa: E402
+
+
+class EncodeRecordTest(unittest.TestCase):
+    def test_round_trip(self):
+        record = encode_record(12.5, 'Lobby', 7, b'hi')
+        self.assertEqual(list(read_records(memoryview(record))),
+                         [(0, len(record), 12.5, 'Lobby', 7, b'hi')])
+
+    def test_room_name_too_long(self):
+        with self.assertRaises(ValueError):
+            encode_record(0, 'x' * 2**16, 7, b'hi')
+
+    def test_sender_id_too_large(self):
+        with self.assertRaises(ValueError):
+            encode_record(0, 'Lobby', 2**32, b'hi')
+
+
+class MessageLogTest(unittest.TestCase):
+    def test_bad_record_is_not_appended(self):
+        with tempfile.TemporaryDirectory() as directory:
+            log = MessageLog(directory, fsync=False)
+            with self.assertRaises(ValueError):
+                log.append('x' * 2**16, 7, b'lost')
+            log.append('Lobby', 7, b'kept')
+            log.close()
+            log = MessageLog(directory, read_only=True)
+            self.assertEqual([r[1:] for r in log.replay()],
+                             [('Lobby', 7, b'kept')])
+
+
+if __name__ == '__main__':
+    unittest.main()
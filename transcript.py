@@ -0,0 +1,256 @@
+import tkinter as tk
+import zlib
+from collections import deque
+
+SEPARATOR = '\0'    # Between the messages of a stored block
+
+
+class TranscriptStore:
+    """
+    Every message of a session, numbered in the order they were added. The
+    newest are kept as they are, and every block_size messages are joined
+    and compressed into a block. Once the blocks take more than max_bytes
+    the oldest are dropped, so a client left running for days uses the same
+    memory as one running for an hour.
+
+    Parameters:
+        block_size (int): Messages compressed together
+        max_bytes (int): Most bytes of compressed blocks kept
+    """
+
+    def __init__(self, block_size: int = 256, max_bytes: int = 2**22):
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self._blocks = deque()  # (index of first message, compressed data)
+        self._recent = []       # Messages not yet compressed
+        self._recent_start = 0  # Index of the first of them
+        self.compressed_bytes = 0
+        self._cached = (None, [])   # Last block read, (start, messages)
+
+    @property
+    def first(self):
+        """
+        Index of the oldest message still kept.
+        """
+        return self._blocks[0][0] if self._blocks else self._recent_start
+
+    @property
+    def end(self):
+        """
+        Index the next message will be given.
+        """
+        return self._recent_start + len(self._recent)
+
+    def append(self, msg: str):
+        """
+        Adds a message.
+
+        Parameters:
+            msg (str): The message
+
+        Returns:
+            (int): Index of the message
+        """
+        self._recent.append(msg.replace(SEPARATOR, ''))
+        if len(self._recent) >= self.block_size:
+            data = zlib.compress(SEPARATOR.join(self._recent).encode())
+            self._blocks.append((self._recent_start, data))
+            self.compressed_bytes += len(data)
+            self._recent_start += len(self._recent)
+            self._recent = []
+            while self.compressed_bytes > self.max_bytes:
+                _, data = self._blocks.popleft()
+                self.compressed_bytes -= len(data)
+        return self.end - 1
+
+    def get(self, start: int, stop: int):
+        """
+        Returns the messages from index start up to stop. Messages that
+        have been dropped are left out.
+
+        Parameters:
+            start (int): Index of the first message
+            stop (int): Index after the last message
+
+        Returns:
+            (list): The messages, oldest first
+        """
+        start = max(start, self.first)
+        stop = min(stop, self.end)
+        messages = []
+        for block_start, data in self._blocks:
+            block_stop = block_start + self.block_size
+            if block_stop <= start or block_start >= stop:
+                continue
+            block = self._read_block(block_start, data)
+            messages.extend(block[max(start - block_start, 0):
+                                  stop - block_start])
+        if stop > self._recent_start:
+            messages.extend(self._recent[max(start - self._recent_start, 0):
+                                         stop - self._recent_start])
+        return messages
+
+    def _read_block(self, block_start: int, data: bytes):
+        """
+        Decompresses a block, keeping the last one read as scrolling back
+        usually reads the same block several times.
+        """
+        if self._cached[0] != block_start:
+            text = zlib.decompress(data).decode()
+            self._cached = (block_start, text.split(SEPARATOR))
+        return self._cached[1]
+
+
+class TranscriptView:
+    """
+    Shows a TranscriptStore in a Text widget. Only a window of at most
+    max_shown messages is in the widget at once. Scrolling to the top
+    pages older messages in from the store and scrolling to the bottom
+    pages newer ones back in, dropping messages from the other end, so the
+    widget never grows with the length of the session.
+
+    While the newest message is shown, new messages are added to the
+    widget, which follows them if it was scrolled to the bottom.
+
+    Parameters:
+        master (Widget): Widget to create the Text widget in
+        store (TranscriptStore): The messages
+        max_shown (int): Most messages in the widget
+        page_size (int): Messages paged in at a time
+    """
+
+    def __init__(self, master, store: TranscriptStore,
+                 max_shown: int = 500, page_size: int = 100):
+        self.store = store
+        self.max_shown = max_shown
+        self.page_size = page_size
+        self.text = tk.Text(master, wrap='word', state='disabled',
+                            cursor='arrow', relief='flat')
+        self.text.tag_configure('message', spacing1=2, spacing3=6,
+                                lmargin1=4, lmargin2=4)
+        self.scrollbar = None
+        self._start = store.end     # Index of the first message shown
+        self._lines = deque()       # Lines used by each message shown
+        self._paging = False        # A page is due to be added
+
+    @property
+    def _stop(self):
+        return self._start + len(self._lines)
+
+    def attach_scrollbar(self, scrollbar: tk.Scrollbar):
+        """
+        Connects a scrollbar, which also tells the view when it has been
+        scrolled to either end.
+        """
+        self.scrollbar = scrollbar
+        scrollbar.configure(command=self.text.yview)
+        self.text.configure(yscrollcommand=self.on_scroll)
+
+    def add(self, msg: str):
+        """
+        Adds a message to the store, and to the widget if the newest
+        messages are being shown.
+
+        Parameters:
+            msg (str): The message
+        """
+        showing_newest = self._stop == self.store.end
+        at_bottom = self.text.yview()[1] >= 1.0
+        self.store.append(msg)
+        if not showing_newest:
+            return
+        self._insert([msg], at_top=False)
+        while len(self._lines) > self.max_shown:
+            self._drop(at_top=True)
+        if at_bottom:
+            self.text.see('end')
+
+    def on_scroll(self, first: str, last: str):
+        """
+        Called by the Text widget as it scrolls. Pages messages in when an
+        end of the widget is reached and there are more in the store.
+        """
+        if self.scrollbar is not None:
+            self.scrollbar.set(first, last)
+        if self._paging:
+            return
+        if float(first) <= 0.0 and self._start > self.store.first:
+            self._paging = True
+            self.text.after_idle(self.page_older)
+        elif float(last) >= 1.0 and self._stop < self.store.end:
+            self._paging = True
+            self.text.after_idle(self.page_newer)
+
+    def page_older(self):
+        """
+        Adds the page of messages before those shown at the top, keeping
+        the same message at the top of the view.
+        """
+        self._paging = False
+        start = max(self.store.first, self._start - self.page_size)
+        messages = self.store.get(start, self._start)
+        if not messages:
+            return
+        top = self.text.index('@0,0')
+        added = self._insert(messages, at_top=True)
+        self._start = start
+        while len(self._lines) > self.max_shown:
+            self._drop(at_top=False)
+        line, column = top.split('.')
+        self.text.yview(f'{int(line) + added}.{column}')
+
+    def page_newer(self):
+        """
+        Adds the page of messages after those shown at the bottom.
+        """
+        self._paging = False
+        messages = self.store.get(self._stop, self._stop + self.page_size)
+        if not messages:
+            return
+        top = self.text.index('@0,0')
+        self._insert(messages, at_top=False)
+        removed = 0
+        while len(self._lines) > self.max_shown:
+            removed += self._drop(at_top=True)
+        line, column = top.split('.')
+        self.text.yview(f'{max(1, int(line) - removed)}.{column}')
+
+    def _insert(self, messages: list, at_top: bool):
+        """
+        Puts messages into the widget at the top or bottom.
+
+        Returns:
+            (int): Number of lines added
+        """
+        lines = [msg.count('\n') + 1 for msg in messages]
+        self.text.configure(state='normal')
+        self.text.insert('1.0' if at_top else 'end-1c',
+                         '\n'.join(messages) + '\n', 'message')
+        self.text.configure(state='disabled')
+        if at_top:
+            self._lines.extendleft(reversed(lines))
+        else:
+            if not self._lines:
+                self._start = self.store.end - len(messages)
+            self._lines.extend(lines)
+        return sum(lines)
+
+    def _drop(self, at_top: bool):
+        """
+        Takes the message at the top or bottom out of the widget. It stays
+        in the store.
+
+        Returns:
+            (int): Number of lines removed
+        """
+        self.text.configure(state='normal')
+        if at_top:
+            lines = self._lines.popleft()
+            self.text.delete('1.0', f'{lines + 1}.0')
+            self._start += 1
+        else:
+            lines = self._lines.pop()
+            total = sum(self._lines) + lines
+            self.text.delete(f'{total - lines + 1}.0', 'end-1c')
+        self.text.configure(state='disabled')
+        return lines